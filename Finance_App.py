@@ -1,17 +1,21 @@
 import sys
 import sqlite3
-import shutil
 import os
 import csv
+import re
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QLineEdit, QPushButton, QTableWidget, QTableWidgetItem,
                              QMessageBox, QComboBox, QDateEdit, QTabWidget, QTextEdit,
                              QAction, QFileDialog, QDialog, QFormLayout, QDialogButtonBox,
                              QStackedWidget, QGroupBox, QInputDialog, QListWidget, QCheckBox,
-                             QSpinBox
+                             QSpinBox, QProgressDialog, QSlider
                              )
-from PyQt5.QtCore import Qt, QDate, QTimer, QSize
+from PyQt5.QtCore import Qt, QDate, QTimer, QSize, QEventLoop
 from PyQt5.QtGui import QIcon, QColor, QPixmap, QPainter
 from PyQt5.QtChart import QChart, QChartView, QPieSeries, QBarSeries, QBarSet, QBarCategoryAxis, QValueAxis
 from PyQt5 import QtGui, QtWidgets
@@ -22,6 +26,30 @@ import base64
 from cryptography.fernet import Fernet
 import calendar
 from dateutil.relativedelta import relativedelta
+from money import Money
+from db_connection import ConnectionManager
+from ledger_repository import LedgerRepository
+from receipt_store import (ensure_receipt_schema, put_receipt, get_receipt,
+                           release_receipts, migrate_inline_receipts)
+from ledger_schema import (ensure_daily_balance_schema, rebuild_daily_balances,
+                           ensure_loan_summary_schema, rebuild_loan_summary,
+                           ensure_monthly_rollup_schema, rebuild_monthly_rollup,
+                           summary_triggers_suspended, SUMMARY_SCHEMAS)
+from secure_storage import (dump_database, load_database, load_database_file,
+                            ContainerHeader, is_container_file, read_header,
+                            write_container, decrypt_container, decrypt_container_to_file, convert_fernet_file,
+                            benchmark)
+from key_service import KeyService
+from change_journal import ChangeJournal, JournaledConnection
+from backup_repository import (collect_metadata, read_backup_info, backup_payload,
+                               BackupIntegrityError, KdfParams, CopyProgress, backup_database_file,
+                               backup_encrypted_snapshot, collect_garbage, compression_ratio)
+from chunk_store import DEFAULT_COMPRESSION, available_compressions
+from backup_catalog import BackupCatalog
+from undo_log import UndoLog, DEFAULT_MEMORY_BUDGET
+from recovery_log import RecoveryLog
+from backup_scheduler import BackupScheduler, change_counter
+from backup_retention import RetentionPolicy, BUCKETS
 
 class ProjectInfo:
     """项目信息元数据（集中管理所有项目相关信息）"""
@@ -271,15 +299,34 @@ class LoginDialog(QDialog):
                 self.master_conn.rollback()
 
 
+class DatabaseUpgradeError(Exception):
+    """用户数据库升级失败，不能在半升级的结构上继续使用"""
+
+
 class FinanceApp(QMainWindow):
+    # 交易表复合索引（数据库版本3）
+    TRANSACTION_INDEXES = [
+        ("idx_transactions_date_type", "date, type"),
+        ("idx_transactions_account_date", "account_id, date"),
+        ("idx_transactions_related_type", "related_id, type"),
+        ("idx_transactions_type_status", "type, status"),
+    ]
+
+    # 以分为单位存储的金额列（数据库版本4）
+    MONEY_COLUMNS = {
+        "transactions": ["amount"],
+        "accounts": ["balance"],
+        "budgets": ["amount"],
+    }
+
     def __init__(self):
         super().__init__()
         self.backup_dir = "backups"
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
         
-        # 设置自动备份数量限制，默认为30
-        self.max_backups = 30
+        # 备份分块的压缩方式
+        self.backup_compression = DEFAULT_COMPRESSION
         
         self.setWindowTitle(f"{ProjectInfo.NAME} {ProjectInfo.VERSION}")
         # self.setWindowTitle(f"{ProjectInfo.NAME} {ProjectInfo.VERSION} - 当前用户: {self.current_user}")
@@ -289,22 +336,43 @@ class FinanceApp(QMainWindow):
         # 初始化table属性
         self.table = None
         
+        # 数据库连接统一由连接管理器打开和关闭
+        self.db_manager = ConnectionManager()
+        
         # 初始化多用户数据库
         self.init_user_db()
         
+        # 旧备份按祖父-父-子策略保留（近期密集、远期稀疏）
+        self.retention_policy = self.load_retention_policy()
+        
+        # 备份在单独的线程中执行，自动备份完成后由backup_poll_timer收尾
+        # （登录时打开用户数据库就可能做基准备份，须在登录前创建）
+        self.backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")
+        self.pending_backup = None
+        self.issued_backup_paths = set()  # 本次运行分配过的备份路径（可能还在写入）
+        self.backup_poll_timer = QTimer()
+        self.backup_poll_timer.timeout.connect(self.check_pending_backup)
+        
+        # 备份索引：启动时在备份线程中与目录内容对齐（补录旧备份、去掉已删除的）
+        self.backup_catalog = BackupCatalog(self.backup_dir)
+        self.backup_executor.submit(self.backup_catalog.reconcile)
+        
+        # 时间点恢复日志（打开用户数据库时开始记录）
+        self.recovery_log = None
+        
         # 显示登录对话框
         self.show_login_dialog()
 
         # 设置窗口标题包含当前用户
         self.update_window_title()
 
-        # 设置自动备份定时器
+        # 自动备份：定时器每分钟询问一次调度器，数据库没有修改时不做任何备份I/O
         self.backup_timer = QTimer()
-        self.backup_timer.timeout.connect(self.auto_backup)
-        self.backup_timer.start(3600000)  # 每小时自动备份一次
+        self.backup_timer.timeout.connect(self.check_backup_schedule)
+        self.backup_timer.start(60000)
         
-        # 操作历史栈
-        self.operation_stack = []
+        # 撤销/重做历史（绑定到当前连接，第一次保存状态时创建）
+        self.undo_log = None
         
         # 提醒定时器
         self.reminder_timer = QTimer()
@@ -368,7 +436,7 @@ class FinanceApp(QMainWindow):
 
     def init_user_db(self):
         """初始化用户数据库"""
-        self.master_conn = sqlite3.connect('finance_master.db')
+        self.master_conn = self.db_manager.connect('finance_master.db')
         self.master_cursor = self.master_conn.cursor()
         
         # 创建用户表（添加IF NOT EXISTS以避免重复创建）
@@ -386,6 +454,11 @@ class FinanceApp(QMainWindow):
         columns = [column[1] for column in self.master_cursor.fetchall()]
         if 'password' not in columns:
             self.master_cursor.execute("ALTER TABLE users ADD COLUMN password TEXT")
+        # 加密用户的密钥派生参数（每个用户独立的salt）
+        if 'kdf_salt' not in columns:
+            self.master_cursor.execute("ALTER TABLE users ADD COLUMN kdf_salt BLOB")
+        if 'kdf_iterations' not in columns:
+            self.master_cursor.execute("ALTER TABLE users ADD COLUMN kdf_iterations INTEGER")
     
         # 创建配置表（用于存储最后选择的用户等设置）
         self.master_cursor.execute('''
@@ -397,12 +470,65 @@ class FinanceApp(QMainWindow):
 
         self.master_conn.commit()
         
+        # 密钥派生在后台线程执行，密钥在登录期间缓存
+        self.key_service = KeyService(self.master_conn)
+        
+        # 读取自定义的PRAGMA配置
+        self.load_pragma_profile()
+        
         # 检查是否有默认用户
         self.master_cursor.execute("SELECT COUNT(*) FROM users")
         if self.master_cursor.fetchone()[0] == 0:
             self.master_cursor.execute("INSERT INTO users (username) VALUES (?)", ("默认用户",))
             self.master_conn.commit()
 
+    def load_pragma_profile(self):
+        """
+        从主数据库读取自定义PRAGMA配置
+        
+        settings表中key为'pragma_profile'，value为JSON，例如:
+        {"main": {"cache_size": -65536, "synchronous": "FULL"}}
+        """
+        self.master_cursor.execute("SELECT value FROM settings WHERE key='pragma_profile'")
+        result = self.master_cursor.fetchone()
+        if not result:
+            return
+        try:
+            for profile, pragmas in json.loads(result[0]).items():
+                self.db_manager.configure(profile, **pragmas)
+        except (ValueError, AttributeError, TypeError) as e:
+            print(f"PRAGMA配置无效，使用默认配置: {str(e)}")
+
+    @property
+    def ledger(self):
+        """当前用户数据库的账本数据访问对象（连接切换后自动重建）"""
+        if getattr(self, '_ledger', None) is None or self._ledger.conn is not self.conn:
+            self._ledger = LedgerRepository(self.conn)
+        return self._ledger
+
+    def show_connection_stats(self):
+        """显示数据库连接打开/关闭耗时统计"""
+        report = self.db_manager.timing_report()
+        names = {"open": "打开", "close": "关闭"}
+        lines = [
+            f"{names[action]}: {count} 次，平均 {avg:.2f} ms，最长 {longest:.2f} ms"
+            for action, (count, avg, longest) in report.items()
+        ]
+        lines.append(f"当前打开的连接: {len(self.db_manager.open_connections)}")
+        QMessageBox.information(self, "连接统计", "\n".join(lines))
+
+    def show_crypto_benchmark(self):
+        """测试分块加解密在不同线程数下的吞吐量"""
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            results = self.wait_with_progress(executor.submit(benchmark, 64), "正在测试加解密速度...")
+        
+        lines = [f"测试数据: 64 MB，CPU核数: {os.cpu_count()}", ""]
+        lines += [
+            f"{workers} 线程: 加密 {encrypt_rate:.1f} MB/s，解密 {decrypt_rate:.1f} MB/s"
+            for workers, encrypt_rate, decrypt_rate in results
+        ]
+        QMessageBox.information(self, "加密性能测试", "\n".join(lines))
+
     def init_current_user_db(self, username):
         """初始化当前用户数据库"""
         self.current_user = username
@@ -413,30 +539,35 @@ class FinanceApp(QMainWindow):
         result = self.master_cursor.fetchone()
         password = result[0] if result else None
         self.db_encrypted = password is not None
+        self.change_journal = None
         
         if self.db_encrypted:
-            # 如果数据库加密，需要先解密
-            key = self.get_encryption_key(password)
-            self.cipher_suite = Fernet(key)
+            # 如果数据库加密，需要先解密（密钥在后台线程派生，界面显示进度）
+            self.kdf_params = self.key_service.user_params(username)
+            self.wait_with_progress(self.key_service.begin_session(username, password),
+                                    "正在解锁加密数据库...")
             
             # 检查数据库文件是否存在
             if os.path.exists(db_name):
                 try:
-                    with open(db_name, 'rb') as f:
-                        encrypted_data = f.read()
-                    decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                    
-                    # 创建临时数据库连接
-                    self.conn = sqlite3.connect(':memory:')
-                    self.conn.executescript(decrypted_data.decode('utf-8'))
+                    if not is_container_file(db_name):
+                        # 旧版Fernet整文件加密，转换为分块容器
+                        header = self.new_container_header()
+                        convert_fernet_file(db_name, self.legacy_cipher(),
+                                            self.container_key(header), header)
+                    self.conn = self.open_encrypted_snapshot(db_name, factory=JournaledConnection)
+                    # 上次会话在压缩前退出时，未写入快照的提交还在变更日志里
+                    self.replay_change_journal(db_name)
                 except Exception as e:
                     QMessageBox.critical(self, "错误", f"数据库解密失败: {str(e)}")
-                    self.conn = sqlite3.connect(':memory:')  # 创建空的内存数据库
+                    self.change_journal = None
+                    self.conn = self.db_manager.connect(':memory:')  # 创建空的内存数据库
             else:
-                self.conn = sqlite3.connect(':memory:')
+                self.conn = self.db_manager.connect(':memory:', factory=JournaledConnection)
+                self.change_journal = ChangeJournal(db_name)
         else:
-            # 非加密数据库直接连接
-            self.conn = sqlite3.connect(db_name)
+            # 非加密数据库直接连接（提交时把变更追加到时间点恢复日志）
+            self.conn = self.db_manager.connect(db_name, factory=JournaledConnection)
             
         self.cursor = self.conn.cursor()
         
@@ -445,7 +576,7 @@ class FinanceApp(QMainWindow):
             CREATE TABLE IF NOT EXISTS transactions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 type TEXT NOT NULL,  -- 'income' or 'expense' or 'loan' or 'repayment' or 'balance'
-                amount REAL NOT NULL,
+                amount INTEGER NOT NULL,  -- 金额，单位：分
                 category TEXT,
                 description TEXT,
                 date TEXT NOT NULL,
@@ -453,7 +584,8 @@ class FinanceApp(QMainWindow):
                 status TEXT,  -- 'pending' or 'settled'
                 account_id INTEGER DEFAULT 1,  -- 关联账户
                 tags TEXT,  -- 标签，逗号分隔
-                receipt_image TEXT,  -- 收据图片base64编码
+                receipt_image TEXT,  -- 旧版内嵌的收据图片base64编码（版本5起迁移到receipts表）
+                receipt_hash TEXT,  -- 收据图片哈希，关联receipts表
                 is_recurring INTEGER DEFAULT 0,  -- 是否为定期交易
                 recurring_freq TEXT,  -- 定期频率: daily, weekly, monthly, yearly
                 recurring_end TEXT,  -- 定期结束日期
@@ -464,6 +596,9 @@ class FinanceApp(QMainWindow):
 
         # 检查并升级数据库结构
         self.upgrade_database_schema()
+        
+        # 创建收据表
+        ensure_receipt_schema(self.conn)
 
         # 创建分类表
         self.cursor.execute('''
@@ -480,7 +615,7 @@ class FinanceApp(QMainWindow):
             CREATE TABLE IF NOT EXISTS accounts (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
-                balance REAL DEFAULT 0,
+                balance INTEGER DEFAULT 0,  -- 余额，单位：分
                 currency TEXT DEFAULT 'CNY',
                 description TEXT,
                 user_id INTEGER REFERENCES users(id)
@@ -492,7 +627,7 @@ class FinanceApp(QMainWindow):
             CREATE TABLE IF NOT EXISTS budgets (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 category TEXT NOT NULL,
-                amount REAL NOT NULL,
+                amount INTEGER NOT NULL,  -- 金额，单位：分
                 month TEXT NOT NULL,  -- YYYY-MM格式
                 user_id INTEGER REFERENCES users(id),
                 UNIQUE(category, month)
@@ -572,6 +707,75 @@ class FinanceApp(QMainWindow):
             except sqlite3.Error as e:
                 print(f"升级到版本2失败: {str(e)}")
         
+        if current_version < 3:
+            try:
+                self.upgrade_to_version_3()
+                current_version = 3
+            except sqlite3.Error as e:
+                print(f"升级到版本3失败: {str(e)}")
+        elif self.db_encrypted:
+            # 旧版加密文件（SQL文本导出）只包含表结构，加载后需要重建索引
+            self.create_transaction_indexes()
+        
+        if current_version < 4:
+            try:
+                self.upgrade_to_version_4()
+                current_version = 4
+            except sqlite3.Error as e:
+                # 金额仍是REAL（元），界面按整数分读取会到处出错，不能继续登录
+                print(f"升级到版本4失败: {str(e)}")
+                self.stop_change_journal()
+                self.db_manager.close(self.conn)
+                raise DatabaseUpgradeError(f"金额列转换为以分存储失败: {str(e)}") from e
+        
+        if current_version < 5:
+            try:
+                self.upgrade_to_version_5()
+                current_version = 5
+            except sqlite3.Error as e:
+                print(f"升级到版本5失败: {str(e)}")
+        
+        if current_version < 6:
+            try:
+                self.upgrade_to_version_6()
+                current_version = 6
+            except sqlite3.Error as e:
+                print(f"升级到版本6失败: {str(e)}")
+        
+        if current_version < 7:
+            try:
+                self.upgrade_to_version_7()
+                current_version = 7
+            except sqlite3.Error as e:
+                print(f"升级到版本7失败: {str(e)}")
+        
+        if current_version < 8:
+            try:
+                self.upgrade_to_version_8()
+                current_version = 8
+            except sqlite3.Error as e:
+                print(f"升级到版本8失败: {str(e)}")
+        
+        if current_version < 9:
+            try:
+                self.upgrade_to_version_9()
+                current_version = 9
+            except sqlite3.Error as e:
+                print(f"升级到版本9失败: {str(e)}")
+        
+        if current_version < 10:
+            try:
+                self.upgrade_to_version_10()
+                current_version = 10
+            except sqlite3.Error as e:
+                print(f"升级到版本10失败: {str(e)}")
+        
+        # 创建汇总表及其维护触发器：必须在所有迁移之后，重建交易表的迁移会删除表上的触发器
+        # （每日余额、借款汇总、按月分类汇总）
+        for ensure_schema in SUMMARY_SCHEMAS:
+            ensure_schema(self.conn)
+        self.conn.commit()
+        
         # 更新数据库版本
         try:
             self.cursor.execute("INSERT OR REPLACE INTO db_version (version) VALUES (?)", (current_version,))
@@ -582,6 +786,16 @@ class FinanceApp(QMainWindow):
 
         # 升级旧的借款记录，设置默认值
         self.upgrade_old_loans()
+        
+        # 加密用户：升级完成后开始记录变更日志
+        if self.db_encrypted and self.change_journal is not None:
+            self.start_change_journal()
+        
+        self.start_recovery_log()
+        
+        # 自动备份计划（上次会话保存的状态），以打开后的变更计数为基准
+        self.backup_scheduler = self.load_backup_schedule()
+        self.backup_scheduler.observe(change_counter(self.conn))
 
 
     def upgrade_old_loans(self):
@@ -632,6 +846,228 @@ class FinanceApp(QMainWindow):
         self.conn.commit()
 
 
+    def upgrade_to_version_3(self):
+        """升级到版本3：为交易表添加复合索引"""
+        self.create_transaction_indexes()
+        
+        # 收集统计信息，让查询规划器正确选择索引
+        self.cursor.execute("ANALYZE transactions")
+        self.conn.commit()
+
+
+    def upgrade_to_version_4(self):
+        """升级到版本4：金额列从REAL（元）改为INTEGER（分）"""
+        self.conn.commit()
+        self.cursor.execute("BEGIN")
+        try:
+            for table, money_columns in self.MONEY_COLUMNS.items():
+                self.convert_money_columns(table, money_columns)
+            # 重建交易表时表上的汇总触发器随旧表一起被删除，汇总表也还是按元统计的
+            self.restore_summary_tables()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def convert_money_columns(self, table, money_columns):
+        """
+        重建表，把指定的金额列换成INTEGER并按分换算
+        
+        SQLite不支持修改列类型，而REAL亲和性的列会把整数存回浮点，
+        所以需要按原表结构新建表、换算复制、再替换原表和索引。
+        换算后逐列核对行数和合计，不一致时抛出异常由调用方回滚。
+        """
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        columns = self.cursor.fetchall()
+        if not columns:
+            return
+        column_names = [column[1] for column in columns]
+        if all(column[2].upper() == 'INTEGER' for column in columns if column[1] in money_columns):
+            return  # 已经是整数分
+        
+        self.cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        create_sql = self.cursor.fetchone()[0]
+        self.cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+            (table,)
+        )
+        index_sqls = [row[0] for row in self.cursor.fetchall()]
+        
+        new_table = f"{table}_cents"
+        for column in money_columns:
+            create_sql = re.sub(rf"(\b{column}\s+)REAL\b", r"\1INTEGER", create_sql, flags=re.IGNORECASE)
+        create_sql = re.sub(rf"^\s*CREATE TABLE\s+[\"'`]?{table}[\"'`]?", f"CREATE TABLE {new_table}",
+                            create_sql, flags=re.IGNORECASE)
+        self.cursor.execute(create_sql)
+        
+        select_list = [
+            f"CAST(ROUND({name} * 100) AS INTEGER)" if name in money_columns else name
+            for name in column_names
+        ]
+        self.cursor.execute(f"""
+            INSERT INTO {new_table} ({', '.join(column_names)})
+            SELECT {', '.join(select_list)} FROM {table}
+        """)
+        
+        # 核对：行数一致，且每个金额列的分合计与原值换算后的合计一致
+        for column in money_columns:
+            self.cursor.execute(f"""
+                SELECT
+                    (SELECT COUNT(*) FROM {table}),
+                    (SELECT COUNT(*) FROM {new_table}),
+                    (SELECT IFNULL(SUM(CAST(ROUND({column} * 100) AS INTEGER)), 0) FROM {table}),
+                    (SELECT IFNULL(SUM({column}), 0) FROM {new_table})
+            """)
+            old_count, new_count, old_total, new_total = self.cursor.fetchone()
+            if old_count != new_count or old_total != new_total:
+                raise sqlite3.DatabaseError(
+                    f"{table}.{column} 换算校验失败: 行数 {old_count}/{new_count}, 合计 {old_total}/{new_total}"
+                )
+        
+        self.cursor.execute(f"DROP TABLE {table}")
+        self.cursor.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+        for index_sql in index_sqls:
+            self.cursor.execute(index_sql)
+
+
+    def upgrade_to_version_5(self):
+        """升级到版本5：收据图片从交易表迁移到按内容哈希去重的receipts表"""
+        try:
+            migrated, stored = migrate_inline_receipts(self.conn)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        
+        if migrated:
+            print(f"已迁移 {migrated} 条交易的收据图片，去重后存储 {stored} 张")
+            # 回收交易表中原base64数据占用的页
+            self.conn.execute("VACUUM")
+
+
+    def upgrade_to_version_6(self):
+        """升级到版本6：根据已有交易生成每日余额表"""
+        try:
+            ensure_daily_balance_schema(self.conn)
+            rebuild_daily_balances(self.conn)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def upgrade_to_version_7(self):
+        """升级到版本7：生成借款汇总表并校正借款状态"""
+        try:
+            ensure_loan_summary_schema(self.conn)
+            rebuild_loan_summary(self.conn)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def upgrade_to_version_8(self):
+        """升级到版本8：生成按月分类汇总表"""
+        try:
+            ensure_monthly_rollup_schema(self.conn)
+            rebuild_monthly_rollup(self.conn)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def upgrade_to_version_9(self):
+        """
+        升级到版本9：重建全部汇总表
+        
+        之前的版本在版本4迁移重建交易表后没有恢复汇总触发器，当次会话的改动
+        没有计入汇总表，之后登录虽然触发器恢复了，汇总值仍然是错的。
+        """
+        try:
+            self.restore_summary_tables()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+
+    def upgrade_to_version_10(self):
+        """
+        升级到版本10：借款汇总的更新触发器不再被自身同步状态的写入再次触发
+        
+        删除旧定义，随后的汇总表创建步骤按新定义重建。
+        """
+        self.cursor.execute("DROP TRIGGER IF EXISTS trg_loan_summary_loan_update")
+        self.conn.commit()
+
+
+    def restore_summary_tables(self):
+        """
+        创建缺失的汇总表和触发器，并按交易表全量重建汇总（调用方负责提交）
+        
+        用于重建了交易表的迁移之后：触发器随旧表删除，汇总值也可能已过时。
+        """
+        for ensure_schema in SUMMARY_SCHEMAS:
+            ensure_schema(self.conn)
+        rebuild_daily_balances(self.conn)
+        rebuild_loan_summary(self.conn)
+        rebuild_monthly_rollup(self.conn)
+
+
+    def rebuild_summary_tables(self):
+        """根据交易表全量重建所有汇总表（每日余额、借款汇总、按月分类汇总）"""
+        try:
+            balance_rows = rebuild_daily_balances(self.conn)
+            loans = rebuild_loan_summary(self.conn)
+            rollup_rows = rebuild_monthly_rollup(self.conn)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.statusBar().showMessage(f"❌ 重建汇总表失败: {str(e)}", 5000)
+            print(f"[rebuild_summary_tables] {str(e)}")
+            return
+        
+        self.load_data()
+        self.update_statistics()
+        self.statusBar().showMessage(
+            f"✅ 汇总表已重建: 余额 {balance_rows} 行，借款 {loans} 笔，月度汇总 {rollup_rows} 行", 5000
+        )
+
+
+    def create_transaction_indexes(self):
+        """创建交易表复合索引（已存在则跳过）"""
+        for index_name, columns in self.TRANSACTION_INDEXES:
+            self.cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON transactions({columns})"
+            )
+        self.conn.commit()
+
+
+    def check_query_plans(self):
+        """
+        用EXPLAIN QUERY PLAN检查热点查询
+        
+        返回值:
+            list: 仍在全表扫描transactions的查询 [(名称, 计划明细), ...]
+        """
+        return self.ledger.check_query_plans()
+
+
+    def show_query_plan_report(self):
+        """显示热点查询的索引使用情况"""
+        full_scans = self.check_query_plans()
+        if full_scans:
+            report = "\n".join(f"{name}: {detail}" for name, detail in full_scans)
+            QMessageBox.warning(self, "查询计划检查", f"以下查询仍存在全表扫描：\n{report}")
+        else:
+            QMessageBox.information(
+                self, "查询计划检查",
+                f"已检查 {len(LedgerRepository.HOT_PATH_QUERIES)} 个热点查询，全部命中索引"
+            )
+
     def upgrade_database_schema(self):
         """升级数据库结构，确保所有必要的列都存在"""
         # 获取当前表结构
@@ -643,6 +1079,7 @@ class FinanceApp(QMainWindow):
             ('account_id', 'INTEGER', 'DEFAULT 1'),
             ('tags', 'TEXT', ''),
             ('receipt_image', 'TEXT', ''),
+            ('receipt_hash', 'TEXT', ''),
             ('is_recurring', 'INTEGER', 'DEFAULT 0'),
             ('recurring_freq', 'TEXT', ''),
             ('recurring_end', 'TEXT', '')
@@ -662,25 +1099,175 @@ class FinanceApp(QMainWindow):
         
         self.conn.commit()
 
-    def get_encryption_key(self, password):
-        """从密码生成加密密钥"""
-        # 使用PBKDF2从密码派生密钥
-        from cryptography.hazmat.primitives import hashes
-        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-        from cryptography.hazmat.backends import default_backend
-        import base64
-        
-        # 使用固定的salt（实际应用中应该为每个用户生成唯一的salt）
-        salt = b'some_salt'
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-            backend=default_backend()
+    def wait_with_progress(self, future, label, fraction=None):
+        """
+        等待后台任务完成并返回结果，等待期间显示进度框，界面保持响应
+
+        参数:
+            future (concurrent.futures.Future): 后台任务
+            label (str): 进度框提示文字
+            fraction: 可调用对象，返回0~1之间的完成比例（未知时返回None）；
+                为None时显示忙碌进度框
+        """
+        if not future.done():
+            progress = QProgressDialog(label, None, 0, 100 if fraction else 0, self)
+            progress.setWindowTitle("请稍候")
+            progress.setWindowModality(Qt.WindowModal)
+            progress.setMinimumDuration(300)
+
+            def poll():
+                if future.done():
+                    loop.quit()
+                elif fraction and fraction() is not None:
+                    progress.setValue(int(fraction() * 100))
+
+            loop = QEventLoop()
+            timer = QTimer()
+            timer.timeout.connect(poll)
+            timer.start(30)
+            if not future.done():
+                loop.exec_()
+            timer.stop()
+            progress.close()
+        return future.result()
+
+    def container_key(self, header, password=None):
+        """
+        按容器文件头中的salt和迭代次数取得密钥
+
+        当前会话密码的密钥由key_service缓存；password用于校验用户输入的密码，不缓存。
+        """
+        return self.wait_with_progress(
+            self.key_service.derive(header.salt, header.iterations, password),
+            "正在派生密钥..."
         )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        return key
+
+    def legacy_cipher(self, password=None):
+        """旧版Fernet文件的解密器（固定salt，只用于读取和转换旧文件）"""
+        key = self.wait_with_progress(self.key_service.legacy_key(password), "正在派生密钥...")
+        return Fernet(base64.urlsafe_b64encode(bytes(key)))
+
+    def new_container_header(self):
+        """按当前用户的KDF参数生成容器文件头"""
+        salt, iterations = self.kdf_params
+        return ContainerHeader.new(salt=salt, iterations=iterations)
+
+    def write_encrypted_snapshot(self, path, conn=None):
+        """把数据库（默认当前连接）序列化为二进制快照，分块加密后写入path"""
+        header = self.new_container_header()
+        write_container(path, dump_database(conn or self.conn), self.container_key(header), header)
+
+    def open_encrypted_snapshot(self, path, password=None, factory=None):
+        """
+        解密path中的快照并加载到新的内存数据库
+
+        分块容器在内存中解密后直接反序列化，明文不落盘；没有Connection.deserialize的
+        Python版本才流式解密到临时文件，再用备份API载入。旧版Fernet文件整体解密后加载。
+
+        返回值:
+            sqlite3.Connection: 内存数据库连接（由db_manager跟踪）
+        """
+        conn = self.db_manager.connect(':memory:', factory=factory)
+        try:
+            if is_container_file(path):
+                key = self.container_key(read_header(path), password)
+                if hasattr(conn, "deserialize"):
+                    load_database(decrypt_container(path, key), conn)
+                else:
+                    fd, temp_path = tempfile.mkstemp(suffix='.db')
+                    os.close(fd)
+                    try:
+                        decrypt_container_to_file(path, key, temp_path)
+                        load_database_file(temp_path, conn)
+                    finally:
+                        os.remove(temp_path)
+            else:
+                cipher_suite = self.legacy_cipher(password)
+                with open(path, 'rb') as f:
+                    load_database(cipher_suite.decrypt(f.read()), conn)
+        except Exception:
+            self.db_manager.close(conn)
+            raise
+        return conn
+
+    def replay_change_journal(self, db_name):
+        """把与快照匹配的变更日志回放到刚加载的内存数据库"""
+        self.change_journal = ChangeJournal(db_name)
+        base_id = read_header(db_name).nonce_prefix
+        # 日志里已经包含汇总表的最终值，回放时不能再由触发器重复累加
+        with summary_triggers_suspended(self.conn):
+            count = self.change_journal.replay(self.conn, base_id, self.container_key)
+        self.conn.commit()
+        if count:
+            print(f"已从变更日志恢复 {count} 次提交")
+
+    def start_change_journal(self):
+        """
+        开始把加密会话的每次提交追加到变更日志
+
+        刚回放过的日志直接续写；没有可续写的日志（新数据库、恢复备份、更换密码等）
+        或数据库结构已升级时先把当前状态写成新快照。
+        """
+        if self.change_journal is None:
+            self.change_journal = ChangeJournal(f'finance_{self.current_user}.db')
+        header = self.new_container_header()
+        future = self.change_journal.start(self.conn, self.container_key(header), self.new_container_header)
+        self.wait_with_progress(future, "正在保存加密数据库...")
+
+    def stop_change_journal(self, discard=False):
+        """停止记录变更日志，discard为True时同时删除日志文件"""
+        if getattr(self, 'change_journal', None) is None:
+            return
+        if discard:
+            self.change_journal.discard()
+        else:
+            self.change_journal.close()
+        self.change_journal = None
+
+    def recovery_log_dir(self):
+        """当前用户的时间点恢复日志目录"""
+        return os.path.join(self.backup_dir, "pitr", self.current_user)
+
+    def start_recovery_log(self, rebase=False):
+        """
+        开始把当前连接的提交追加到时间点恢复日志
+
+        参数:
+            rebase (bool): 数据库刚被整体替换（恢复备份），之前的日志不能接着回放
+        """
+        self.stop_recovery_log()
+        if not isinstance(self.conn, JournaledConnection):
+            # 加密数据库解密失败时使用的空内存数据库，不记录
+            return
+        if self.db_encrypted:
+            kdf_params = KdfParams(*self.kdf_params)
+            self.recovery_log = RecoveryLog(self.recovery_log_dir(),
+                                            bytes(self.container_key(kdf_params)), kdf_params)
+        else:
+            self.recovery_log = RecoveryLog(self.recovery_log_dir())
+        self.recovery_log.attach(self.conn)
+        if self.recovery_log.start(rebase):
+            # 新的时间线需要一份基准备份，之后的时间点才能由 基准 + 日志 得到
+            self.conn.commit()
+            self.start_base_backup()
+
+    def start_base_backup(self):
+        """在后台做一次基准备份，不等待结果"""
+        def report(future):
+            if future.exception() is not None:
+                print(f"基准备份失败: {str(future.exception())}")
+        
+        self.start_backup("base").add_done_callback(report)
+
+    def stop_recovery_log(self, discard=False):
+        """停止记录时间点恢复日志，discard为True时同时删除日志文件"""
+        if getattr(self, 'recovery_log', None) is None:
+            return
+        if discard:
+            self.recovery_log.discard()
+        else:
+            self.recovery_log.close()
+        self.recovery_log = None
 
     def encrypt_database(self):
         """加密当前数据库"""
@@ -696,42 +1283,27 @@ class FinanceApp(QMainWindow):
         if not ok or not password:
             return
             
-        # 生成加密密钥
-        key = self.get_encryption_key(password)
-        cipher_suite = Fernet(key)
-        
-        # 导出数据库内容
+        # 把当前数据库序列化为二进制快照，关闭文件连接后用密文覆盖数据库文件
         db_name = f'finance_{self.current_user}.db'
-        temp_conn = sqlite3.connect(db_name)
-        temp_cursor = temp_conn.cursor()
-        
-        # 获取所有数据
-        temp_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table'")
-        schema = "\n".join([row[0] for row in temp_cursor.fetchall()])
-        
-        # 获取所有数据
-        data_dump = []
-        temp_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in temp_cursor.fetchall()]
-        
-        for table in tables:
-            temp_cursor.execute(f"SELECT * FROM {table}")
-            data = temp_cursor.fetchall()
-            columns = [desc[0] for desc in temp_cursor.description]
-            
-            for row in data:
-                values = ", ".join([f"'{str(v)}'" if v is not None else "NULL" for v in row])
-                data_dump.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({values});")
-        
-        temp_conn.close()
-        
-        # 合并模式和数据进行加密
-        full_dump = schema + "\n" + "\n".join(data_dump)
-        encrypted_data = cipher_suite.encrypt(full_dump.encode('utf-8'))
+        self.conn.commit()
+        # 明文的时间点恢复日志不能留在磁盘上，加密后重新开始（之前的时间点不再可恢复）
+        self.stop_recovery_log(discard=True)
+        snapshot = dump_database(self.conn)
+        self.db_manager.close(self.conn)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_name + suffix):
+                os.remove(db_name + suffix)
+        
+        # 之后改为在内存数据库上工作，提交时追加到变更日志
+        self.conn = self.db_manager.connect(':memory:', factory=JournaledConnection)
+        load_database(snapshot, self.conn)
+        self.cursor = self.conn.cursor()
         
-        # 保存加密数据
-        with open(db_name, 'wb') as f:
-            f.write(encrypted_data)
+        # 新密码使用新的salt
+        self.kdf_params = self.key_service.user_params(self.current_user, regenerate=True)
+        self.wait_with_progress(self.key_service.begin_session(self.current_user, password),
+                                "正在生成密钥...")
+        self.start_change_journal()
             
         # 更新用户密码
         self.master_cursor.execute(
@@ -741,7 +1313,7 @@ class FinanceApp(QMainWindow):
         self.master_conn.commit()
         
         self.db_encrypted = True
-        self.cipher_suite = cipher_suite
+        self.start_recovery_log(rebase=True)
         self.statusBar().showMessage("✅ 数据库已加密", 5000)
 
     def decrypt_database(self):
@@ -759,22 +1331,19 @@ class FinanceApp(QMainWindow):
             return
             
         try:
-            # 尝试解密
-            key = self.get_encryption_key(password)
-            cipher_suite = Fernet(key)
-            
             db_name = f'finance_{self.current_user}.db'
-            with open(db_name, 'rb') as f:
-                encrypted_data = f.read()
-                
-            decrypted_data = cipher_suite.decrypt(encrypted_data)
             
             # 验证密码是否正确
-            sqlite3.connect(':memory:').executescript(decrypted_data.decode('utf-8'))
+            temp_conn = self.open_encrypted_snapshot(db_name, password)
+            self.db_manager.close(temp_conn)
             
-            # 密码正确，移除加密
+            # 密码正确，移除加密：把内存中的当前数据写成普通数据库文件
+            self.conn.commit()
+            self.stop_change_journal(discard=True)
+            # 加密的时间点恢复日志解密后无法再取得密钥，一并删除
+            self.stop_recovery_log(discard=True)
             with open(db_name, 'wb') as f:
-                f.write(decrypted_data)
+                f.write(dump_database(self.conn))
                 
             # 移除用户密码
             self.master_cursor.execute(
@@ -784,7 +1353,7 @@ class FinanceApp(QMainWindow):
             self.master_conn.commit()
             
             self.db_encrypted = False
-            self.cipher_suite = None
+            self.key_service.clear()
             self.statusBar().showMessage("✅ 数据库已解密", 5000)
             
             # 重新连接数据库
@@ -861,7 +1430,12 @@ class FinanceApp(QMainWindow):
                 )
                 self.master_conn.commit()
         
-            self.init_current_user_db(username)
+            try:
+                self.init_current_user_db(username)
+            except DatabaseUpgradeError as e:
+                # 数据库保持升级前的状态，回到登录对话框
+                QMessageBox.critical(self, "错误", f"用户 {username} 的数据库升级失败，无法登录:\n{str(e)}")
+                return self.show_login_dialog()
         else:
             sys.exit()
 
@@ -937,6 +1511,12 @@ class FinanceApp(QMainWindow):
         undo_action.triggered.connect(self.undo_last_operation)
         edit_menu.addAction(undo_action)
         
+        # 重做操作
+        redo_action = QAction("重做", self)
+        redo_action.setShortcut("Ctrl+Y")
+        redo_action.triggered.connect(self.redo_last_operation)
+        edit_menu.addAction(redo_action)
+        
         # 分类管理
         category_action = QAction("管理分类", self)
         category_action.triggered.connect(self.manage_categories)
@@ -965,6 +1545,26 @@ class FinanceApp(QMainWindow):
         recurring_action.triggered.connect(self.manage_recurring_transactions)
         tools_menu.addAction(recurring_action)
         
+        # 查询计划检查
+        query_plan_action = QAction("检查查询计划", self)
+        query_plan_action.triggered.connect(self.show_query_plan_report)
+        tools_menu.addAction(query_plan_action)
+        
+        # 重建汇总表
+        rebuild_summary_action = QAction("重建汇总表", self)
+        rebuild_summary_action.triggered.connect(self.rebuild_summary_tables)
+        tools_menu.addAction(rebuild_summary_action)
+        
+        # 数据库连接统计
+        connection_stats_action = QAction("连接统计", self)
+        connection_stats_action.triggered.connect(self.show_connection_stats)
+        tools_menu.addAction(connection_stats_action)
+        
+        # 加解密吞吐量测试
+        crypto_benchmark_action = QAction("加密性能测试", self)
+        crypto_benchmark_action.triggered.connect(self.show_crypto_benchmark)
+        tools_menu.addAction(crypto_benchmark_action)
+        
         # 帮助菜单
         help_menu = menubar.addMenu("帮助")
         
@@ -1126,10 +1726,7 @@ class FinanceApp(QMainWindow):
         self.filter_category_combo.clear()
         self.filter_category_combo.addItem("所有分类")
         
-        self.cursor.execute("SELECT DISTINCT name FROM categories ORDER BY name")
-        categories = [row[0] for row in self.cursor.fetchall()]
-        
-        for category in categories:
+        for category in self.ledger.list_categories():
             self.filter_category_combo.addItem(category)
 
     def load_accounts(self):
@@ -1137,10 +1734,7 @@ class FinanceApp(QMainWindow):
         self.filter_account_combo.clear()
         self.filter_account_combo.addItem("所有账户")
         
-        self.cursor.execute("SELECT id, name FROM accounts ORDER BY name")
-        accounts = self.cursor.fetchall()
-        
-        for account_id, account_name in accounts:
+        for account_id, account_name in self.ledger.list_accounts():
             self.filter_account_combo.addItem(account_name, account_id)
 
     def create_data_table(self):
@@ -1269,10 +1863,7 @@ class FinanceApp(QMainWindow):
         while self.account_combo.count() > 1:
             self.account_combo.removeItem(1)
         
-        self.cursor.execute("SELECT id, name FROM accounts ORDER BY name")
-        accounts = self.cursor.fetchall()
-        
-        for account_id, account_name in accounts:
+        for account_id, account_name in self.ledger.list_accounts():
             self.account_combo.addItem(account_name, account_id)
 
     def load_account_combo_to(self, combo_box):
@@ -1281,10 +1872,7 @@ class FinanceApp(QMainWindow):
         combo_box.clear()
         combo_box.addItem("全部结余", -1)
         
-        self.cursor.execute("SELECT id, name FROM accounts ORDER BY name")
-        accounts = self.cursor.fetchall()
-        
-        for account_id, account_name in accounts:
+        for account_id, account_name in self.ledger.list_accounts():
             combo_box.addItem(account_name, account_id)
 
 
@@ -1314,13 +1902,12 @@ class FinanceApp(QMainWindow):
         
         if file_name:
             try:
-                # 压缩图片并转换为base64
+                # 压缩图片
                 img = Image.open(file_name)
                 img.thumbnail((800, 800))  # 限制图片大小
                 
                 buffered = io.BytesIO()
                 img.save(buffered, format="JPEG", quality=70)
-                img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
                 
                 # 显示缩略图
                 pixmap = QPixmap(file_name)
@@ -1329,8 +1916,8 @@ class FinanceApp(QMainWindow):
                 self.receipt_btn.setIconSize(QSize(100, 100))
                 self.receipt_btn.setText("收据已添加")
                 
-                # 保存base64编码
-                self.receipt_image_data = img_str
+                # 保存JPEG原始字节
+                self.receipt_image_data = buffered.getvalue()
             except Exception as e:
                 self.statusBar().showMessage(f"❌ 加载图片失败: {str(e)}", 5000)
                 self.receipt_image_data = None
@@ -1408,20 +1995,14 @@ class FinanceApp(QMainWindow):
     def update_loan_combo(self):
         """更新借款选择框"""
         self.loan_combo.clear()
-        self.cursor.execute("""
-            SELECT id, amount, description, date 
-            FROM transactions 
-            WHERE type='借款' AND status='pending'
-            ORDER BY date
-        """)
-        loans = self.cursor.fetchall()
+        loans = self.ledger.pending_loans()
         
         if not loans:
             self.loan_combo.addItem("无待还款借款", None)
         else:
             for loan in loans:
                 self.loan_combo.addItem(
-                    f"ID:{loan[0]} 金额:{loan[1]} 日期:{loan[3]} 描述:{loan[2]}", 
+                    f"ID:{loan[0]} 金额:{Money(loan[1])} 剩余:{Money(loan[4])} 日期:{loan[3]} 描述:{loan[2]}", 
                     loan[0]
                 )
 
@@ -1472,21 +2053,7 @@ class FinanceApp(QMainWindow):
         if not account_id:
             return
             
-        self.cursor.execute("""
-            SELECT 
-                SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-            FROM transactions
-            WHERE account_id=? AND type != 'balance'
-        """, (account_id,))
-        
-        balance = self.cursor.fetchone()[0] or 0
-        
-        self.cursor.execute("""
-            UPDATE accounts SET balance=? WHERE id=?
-        """, (balance, account_id))
+        self.ledger.refresh_account_balance(account_id)
         self.conn.commit()
 
     def delete_record(self):
@@ -1554,13 +2121,13 @@ class FinanceApp(QMainWindow):
         if msg.exec_() != QMessageBox.Ok:
             return
         
+        # 1. 保存当前状态以便撤销（撤销记录须在事务之外安装）
+        self.save_state_before_change()
+        
         try:
             # 开始事务
             self.conn.execute("BEGIN TRANSACTION")
             
-            # 1. 保存当前状态以便撤销
-            self.save_state_before_change()
-            
             # 2. 获取所有还款记录的关联借款ID（除了已收集的）
             self.cursor.execute(f"""
                 SELECT DISTINCT related_id FROM transactions 
@@ -1571,11 +2138,19 @@ class FinanceApp(QMainWindow):
             additional_loans = {row[0] for row in self.cursor.fetchall() if row[0] not in related_loans}
             related_loans.update(additional_loans)
             
-            # 3. 删除记录
+            self.cursor.execute(f"""
+                SELECT receipt_hash FROM transactions 
+                WHERE id IN ({','.join(['?']*len(record_ids))}) 
+                AND receipt_hash IS NOT NULL
+            """, record_ids)
+            receipt_hashes = [row[0] for row in self.cursor.fetchall()]
+            
+            # 3. 删除记录，并清理不再被引用的收据
             self.cursor.execute(f"""
                 DELETE FROM transactions 
                 WHERE id IN ({','.join(['?']*len(record_ids))})
             """, record_ids)
+            release_receipts(self.conn, receipt_hashes)
             
             # 4. 更新所有关联借款的状态
             for loan_id in related_loans:
@@ -1608,6 +2183,9 @@ class FinanceApp(QMainWindow):
             self.conn.rollback()
             self.statusBar().showMessage(f"❌ 系统错误：{str(e)}", 5000)
             print(f"[delete_record] System error: {str(e)}")
+        
+        finally:
+            self.finish_change()
 
 
     def edit_record(self):
@@ -1623,15 +2201,14 @@ class FinanceApp(QMainWindow):
         row = list(selected_rows)[0]
         record_id = int(self.table.item(row, 0).text())
         
-        # 获取记录详情（包含新增的remaining字段）
+        # 获取记录详情（借款的剩余金额直接读取loan_summary）
         self.cursor.execute("""
-            SELECT type, amount, category, description, date, account_id, tags, 
-                receipt_image, is_recurring, recurring_freq, recurring_end, status, related_id,
-                (SELECT t.amount - IFNULL(SUM(r.amount), 0) 
-                FROM transactions r 
-                WHERE r.type='还款' AND r.related_id=t.id)
+            SELECT t.type, t.amount, t.category, t.description, t.date, t.account_id, t.tags,
+                t.receipt_hash, t.is_recurring, t.recurring_freq, t.recurring_end, t.status, t.related_id,
+                ls.remaining
                 FROM transactions t
-                WHERE id=?
+                LEFT JOIN loan_summary ls ON ls.loan_id = t.id
+                WHERE t.id=?
         """, (record_id,))
         record = self.cursor.fetchone()
         
@@ -1664,7 +2241,7 @@ class FinanceApp(QMainWindow):
         layout.addRow("类型:", type_combo)
         
         # 金额
-        amount_edit = QLineEdit(f"{record[1]:.2f}")
+        amount_edit = QLineEdit(f"{Money(record[1]):.2f}")
         if current_type in ['余额', '账户结余']:
             amount_edit.setEnabled(False)  # 余额类型不可编辑金额
         layout.addRow("金额:", amount_edit)
@@ -1694,7 +2271,8 @@ class FinanceApp(QMainWindow):
         
         # 如果是借款，显示剩余金额
         if current_type == '借款':
-            remaining = record[-1] or record[1]  # 使用计算出的剩余金额或原始金额
+            # 汇总表中没有该借款时按原始金额显示（已还清时剩余为0）
+            remaining = Money(record[-1] if record[-1] is not None else record[1])
             remaining_label = QLabel(f"剩余待还金额: {remaining:.2f}")
             remaining_label.setStyleSheet("color: #d9534f; font-weight: bold;")
             layout.addRow(remaining_label)
@@ -1706,7 +2284,7 @@ class FinanceApp(QMainWindow):
             loan_info = self.cursor.fetchone()
             if loan_info:
                 loan_amount, loan_desc = loan_info
-                loan_label = QLabel(f"关联借款ID: {related_loan_id} (金额: {loan_amount:.2f}, 描述: {loan_desc})")
+                loan_label = QLabel(f"关联借款ID: {related_loan_id} (金额: {Money(loan_amount):.2f}, 描述: {loan_desc})")
                 loan_label.setWordWrap(True)
                 layout.addRow(loan_label)
                 
@@ -1765,7 +2343,7 @@ class FinanceApp(QMainWindow):
         if dialog.exec_() == QDialog.Accepted:
             # 获取修改后的值
             try:
-                amount = float(amount_edit.text())
+                amount = Money.parse(amount_edit.text())
             except ValueError:
                 self.statusBar().showMessage("❌ 金额必须是有效数字!", 5000)
                 return
@@ -1818,6 +2396,7 @@ class FinanceApp(QMainWindow):
             # 更新后续日期的余额记录
             if current_type in ["income", "expense", "借款", "还款"]:
                 self.update_future_balances(date)
+            self.finish_change()
             
             self.update_account_balances()
             self.statusBar().showMessage("✅ 记录已更新!", 5000)
@@ -1827,76 +2406,30 @@ class FinanceApp(QMainWindow):
 
     def update_loan_status(self, loan_id):
         """
-        更新借款状态（pending/settled）
-        基于已还款金额与借款金额的比较
+        显示借款当前状态（pending/settled）
+        状态由loan_summary上的触发器在还款增删改时自动更新，这里只读取结果
         
         参数:
-            loan_id (int): 要更新的借款记录ID
+            loan_id (int): 借款记录ID
         
         返回值:
-            bool: 更新成功返回True，失败返回False
+            bool: 找到借款返回True，失败返回False
         """
         try:
             if not loan_id or not isinstance(loan_id, int):
                 raise ValueError("无效的借款ID")
             
-            # 1. 获取借款原始金额和当前状态
-            self.cursor.execute("""
-                SELECT amount, status FROM transactions 
-                WHERE id=? AND type='借款'
-            """, (loan_id,))
-            loan_info = self.cursor.fetchone()
+            summary = self.ledger.loan_summary(loan_id)
             
-            if not loan_info:
+            if not summary:
                 self.statusBar().showMessage(f"❌ 未找到ID为 {loan_id} 的借款记录", 3000)
                 return False
             
-            loan_amount, current_status = loan_info
-            
-            # 2. 计算已还款总额
-            self.cursor.execute("""
-                SELECT COALESCE(SUM(amount), 0) 
-                FROM transactions 
-                WHERE type='还款' AND related_id=?
-            """, (loan_id,))
-            repaid_amount = self.cursor.fetchone()[0]
-            
-            # 3. 计算剩余未还金额
-            remaining_amount = loan_amount - repaid_amount
-            remaining_amount = max(0, remaining_amount)  # 确保不为负数
-            
-            # 4. 确定新状态
-            new_status = 'settled' if remaining_amount <= 0 else 'pending'
-            
-            # 5. 如果需要更新状态，则执行更新
-            if new_status != current_status:
-                self.cursor.execute("""
-                    UPDATE transactions 
-                    SET status=? 
-                    WHERE id=?
-                """, (new_status, loan_id))
-                self.conn.commit()
-                
-                # 6. 如果完全还清，更新关联的所有还款记录状态
-                if new_status == 'settled':
-                    self.cursor.execute("""
-                        UPDATE transactions 
-                        SET status='settled' 
-                        WHERE type='还款' AND related_id=?
-                    """, (loan_id,))
-                    self.conn.commit()
-                
-                # 更新相关账户余额
-                self.cursor.execute("SELECT account_id FROM transactions WHERE id=?", (loan_id,))
-                account_id = self.cursor.fetchone()[0]
-                if account_id:
-                    self.update_account_balance(account_id)
-                
-                self.statusBar().showMessage(
-                    f"✅ 借款ID {loan_id} 状态已更新: {new_status} (剩余: {remaining_amount:.2f})", 
-                    3000
-                )
-            
+            loan_amount, repaid_amount, remaining_amount, status = summary
+            self.statusBar().showMessage(
+                f"✅ 借款ID {loan_id} 当前状态: {status} (剩余: {remaining_amount:.2f})", 
+                3000
+            )
             return True
         
         except sqlite3.Error as e:
@@ -1941,6 +2474,7 @@ class FinanceApp(QMainWindow):
             UPDATE transactions SET status='settled' WHERE id=?
         ''', (record_id,))
         self.conn.commit()
+        self.finish_change()
         
         self.statusBar().showMessage("✅ 借款记录已标记为已结清!", 5000)
         self.load_data()
@@ -1958,17 +2492,15 @@ class FinanceApp(QMainWindow):
         record_id = int(self.table.item(row, 0).text())
         
         self.cursor.execute('''
-            SELECT receipt_image FROM transactions WHERE id=?
+            SELECT receipt_hash FROM transactions WHERE id=?
         ''', (record_id,))
-        receipt_data = self.cursor.fetchone()[0]
+        img_data = get_receipt(self.conn, self.cursor.fetchone()[0])
         
-        if not receipt_data:
+        if not img_data:
             self.statusBar().showMessage("❌ 该记录没有收据图片!", 5000)
             return
             
         try:
-            # 解码base64图片数据
-            img_data = base64.b64decode(receipt_data)
             img = Image.open(io.BytesIO(img_data))
             
             # 创建临时文件
@@ -1994,135 +2526,31 @@ class FinanceApp(QMainWindow):
         filter_account = self.filter_account_combo.currentData()
         filter_status = self.filter_status_combo.currentText()
         
-        # 构建基础查询
-        query = """
-            SELECT t.id, t.type, t.amount, t.category, t.description, t.date, 
-                CASE WHEN t.status IS NULL THEN '' ELSE t.status END,
-                CASE WHEN t.related_id IS NULL THEN '' ELSE t.related_id END,
-                a.name, t.tags,
-                CASE WHEN t.type='借款' THEN 
-                    (SELECT t.amount - IFNULL(SUM(r.amount), 0) 
-                    FROM transactions r 
-                    WHERE r.type='还款' AND r.related_id=t.id)
-                    ELSE NULL
-                END as remaining
-            FROM transactions t
-            LEFT JOIN accounts a ON t.account_id = a.id
-        """
-        
-        # 构建WHERE条件
-        conditions = []
-        params = []
-        
         # 日期条件（如果不是"全部时间"）
+        date_range = None
         if self.date_range_combo.currentIndex() != 0:  # 不是"全部时间"
-            date_from = self.date_from_edit.date().toString("yyyy-MM-dd")
-            date_to = self.date_to_edit.date().toString("yyyy-MM-dd")
-            conditions.append("t.date BETWEEN ? AND ?")
-            params.extend([date_from, date_to])
-        
-        # 类型筛选
-        if filter_type != "所有类型":
-            type_map = {
-                "收入": "income",
-                "支出": "expense",
-                "借款": "借款",
-                "还款": "还款"
-            }
-            conditions.append("t.type=?")
-            params.append(type_map[filter_type])
-        
-        # 分类筛选
-        if filter_category != "所有分类":
-            conditions.append("t.category=?")
-            params.append(filter_category)
-        
-        # 账户筛选
-        if filter_account:
-            conditions.append("t.account_id=?")
-            params.append(filter_account)
-        
-        # 状态筛选
-        if filter_status == "待还款":
-            conditions.append("t.status='pending'")
-        elif filter_status == "已结清":
-            conditions.append("t.status='settled'")
-        
-        # 搜索文本筛选
-        if search_text:
-            # 支持中文、拼音首字母和英文搜索
-            search_conditions = []
-            search_params = []
-            
-            # 1. 直接匹配描述
-            search_conditions.append("t.description LIKE ?")
-            search_params.append(f"%{search_text}%")
-            
-            # 2. 匹配金额
-            search_conditions.append("CAST(t.amount AS TEXT) LIKE ?")
-            search_params.append(f"%{search_text}%")
-            
-            # 3. 匹配分类
-            search_conditions.append("t.category LIKE ?")
-            search_params.append(f"%{search_text}%")
-            
-            # 4. 匹配标签
-            search_conditions.append("t.tags LIKE ?")
-            search_params.append(f"%{search_text}%")
-            
-            # 5. 匹配账户名
-            search_conditions.append("a.name LIKE ?")
-            search_params.append(f"%{search_text}%")
-            
-            # 6. 拼音首字母匹配
-            # 获取所有描述和分类的拼音首字母
-            self.cursor.execute("SELECT DISTINCT description FROM transactions")
-            descriptions = [row[0] for row in self.cursor.fetchall()]
-            
-            self.cursor.execute("SELECT DISTINCT category FROM transactions")
-            categories = [row[0] for row in self.cursor.fetchall()]
-            
-            # 检查是否有匹配的拼音首字母
-            pinyin_descriptions = [
-                desc for desc in descriptions 
-                if desc and self.get_pinyin_abbr(desc).startswith(search_text)
-            ]
-            
-            pinyin_categories = [
-                cat for cat in categories 
-                if cat and self.get_pinyin_abbr(cat).startswith(search_text)
-            ]
-            
-            if pinyin_descriptions or pinyin_categories:
-                pinyin_condition = []
-                pinyin_params = []
-                
-                if pinyin_descriptions:
-                    pinyin_condition.append("t.description IN (" + ",".join(["?"]*len(pinyin_descriptions)) + ")")
-                    pinyin_params.extend(pinyin_descriptions)
-                    
-                if pinyin_categories:
-                    if pinyin_descriptions:
-                        pinyin_condition.append("OR")
-                    pinyin_condition.append("t.category IN (" + ",".join(["?"]*len(pinyin_categories)) + ")")
-                    pinyin_params.extend(pinyin_categories)
-                
-                search_conditions.append("(" + " ".join(pinyin_condition) + ")")
-                search_params.extend(pinyin_params)
-            
-            conditions.append("(" + " OR ".join(search_conditions) + ")")
-            params.extend(search_params)
-        
-        # 组合所有条件
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
+            date_range = (
+                self.date_from_edit.date().toString("yyyy-MM-dd"),
+                self.date_to_edit.date().toString("yyyy-MM-dd"),
+            )
         
-        # 排序
-        query += " ORDER BY t.date ASC, t.id ASC"
+        type_map = {
+            "收入": "income",
+            "支出": "expense",
+            "借款": "借款",
+            "还款": "还款"
+        }
         
-        # 执行查询
-        self.cursor.execute(query, params)
-        records = self.cursor.fetchall()
+        # 支持中文、拼音首字母和英文搜索
+        records = self.ledger.filter_transactions(
+            date_range=date_range,
+            type_=type_map.get(filter_type),
+            category=filter_category if filter_category != "所有分类" else None,
+            account_id=filter_account,
+            status=LedgerRepository.STATUS_FILTERS.get(filter_status),
+            search_text=search_text,
+            abbr=self.get_pinyin_abbr,
+        )
         
         # 更新表格
         self.table.setRowCount(len(records))
@@ -2148,7 +2576,7 @@ class FinanceApp(QMainWindow):
                         # 添加剩余金额信息
                         remaining = record[10]  # 新增的remaining列
                         if remaining is not None:
-                            item.setText(f"借款 (剩余:{remaining:.2f})")
+                            item.setText(f"借款 (剩余:{Money(remaining):.2f})")
 
                     elif value == '还款':
                         item.setForeground(Qt.darkMagenta)
@@ -2177,8 +2605,8 @@ class FinanceApp(QMainWindow):
                 # 金额列右对齐
                 if col == 2:
                     try:
-                        # 将金额格式化为保留2位小数
-                        formatted_amount = "{:.2f}".format(float(value))
+                        # 将金额（分）格式化为保留2位小数的元
+                        formatted_amount = "{:.2f}".format(Money(value))
                         item.setText(formatted_amount)
                     except (ValueError, TypeError):
                         item.setText(str(value))
@@ -2195,11 +2623,8 @@ class FinanceApp(QMainWindow):
             if self.table.selectedItems():
                 selected_row = self.table.selectedItems()[0].row()
                 record_id = int(self.table.item(selected_row, 0).text())
-                self.cursor.execute('''
-                    SELECT receipt_image FROM transactions WHERE id=?
-                ''', (record_id,))
-                receipt_data = self.cursor.fetchone()[0]
-                self.view_receipt_btn.setEnabled(bool(receipt_data))
+                receipt_hash = self.ledger.receipt_hash_of(record_id)
+                self.view_receipt_btn.setEnabled(bool(receipt_hash))
             else:
                 self.view_receipt_btn.setEnabled(False)
         
@@ -2229,12 +2654,7 @@ class FinanceApp(QMainWindow):
         if not hasattr(self, 'table') or self.table is None:
             self.create_data_table()
 
-        # 更新所有借款状态
-        self.cursor.execute("SELECT id FROM transactions WHERE type='借款'")
-        loans = self.cursor.fetchall()
-        for loan_id, in loans:
-            self.update_loan_status(loan_id)
-
+        # 借款状态和剩余金额由loan_summary触发器维护，不需要逐笔重新计算
         self.apply_filters()  # 这里会应用颜色设置
         # 确保表格刷新
         self.table.viewport().update()
@@ -2272,22 +2692,9 @@ class FinanceApp(QMainWindow):
         """
         
         # 收支总额统计
-        self.cursor.execute("""
-            SELECT 
-                SUM(CASE WHEN type='income' THEN amount ELSE 0 END),
-                SUM(CASE WHEN type='expense' THEN amount ELSE 0 END),
-                SUM(CASE WHEN type='借款' THEN amount ELSE 0 END),
-                SUM(CASE WHEN type='还款' THEN amount ELSE 0 END)
-            FROM transactions
-            WHERE date BETWEEN ? AND ?
-            AND type != 'balance'  -- 排除余额记录
-        """, (date_from, date_to))
-        
-        total_income, total_expense, total_loans, total_repayments = self.cursor.fetchone()
-        total_income = total_income or 0
-        total_expense = total_expense or 0
-        total_loans = total_loans or 0
-        total_repayments = total_repayments or 0
+        total_income, total_expense, total_loans, total_repayments = (
+            self.ledger.period_totals(date_from, date_to)
+        )
         
         net_income = total_income + total_repayments - total_expense - total_loans
         
@@ -2308,20 +2715,7 @@ class FinanceApp(QMainWindow):
         """
         
         # 待还款统计
-        self.cursor.execute("""
-            SELECT SUM(t1.amount - IFNULL(t2.repaid, 0)) 
-            FROM transactions t1
-            LEFT JOIN (
-                SELECT related_id, SUM(amount) as repaid 
-                FROM transactions 
-                WHERE type='还款' 
-                GROUP BY related_id
-            ) t2 ON t1.id = t2.related_id
-            WHERE t1.type='借款' AND t1.status='pending'
-            AND t1.date BETWEEN ? AND ?
-        """, (date_from, date_to))
-        
-        pending_repayment = self.cursor.fetchone()[0] or 0
+        pending_repayment = self.ledger.pending_repayment(date_from, date_to)
         
         stats_html += f"""
         <h3>借款状态</h3>
@@ -2335,18 +2729,7 @@ class FinanceApp(QMainWindow):
         
         # 按类别统计
         if chart_type in ["收支趋势", "分类占比"]:
-            self.cursor.execute("""
-                SELECT 
-                    category,
-                    SUM(CASE WHEN type='income' THEN amount ELSE 0 END) as income,
-                    SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) as expense
-                FROM transactions
-                WHERE date BETWEEN ? AND ?
-                GROUP BY category
-                ORDER BY (income + expense) DESC
-            """, (date_from, date_to))
-            
-            category_stats = self.cursor.fetchall()
+            category_stats = self.ledger.category_stats(date_from, date_to)
             
             stats_html += """
             <h3>分类统计</h3>
@@ -2373,8 +2756,8 @@ class FinanceApp(QMainWindow):
             if chart_type == "分类占比":
                 series = QPieSeries()
                 for category, income, expense in category_stats:
-                    if expense > 0:  # 只显示支出分类
-                        series.append(category, expense)
+                    if expense > Money(0):  # 只显示支出分类
+                        series.append(category, float(expense))
                 
                 chart.addSeries(series)
                 chart.setTitle("支出分类占比")
@@ -2385,13 +2768,13 @@ class FinanceApp(QMainWindow):
                 # 收入柱
                 income_set = QBarSet("收入")
                 for category, income, expense in category_stats:
-                    income_set.append(income)
+                    income_set.append(float(income))
                 bar_series.append(income_set)
                 
                 # 支出柱
                 expense_set = QBarSet("支出")
                 for category, income, expense in category_stats:
-                    expense_set.append(expense)
+                    expense_set.append(float(expense))
                 bar_series.append(expense_set)
                 
                 chart.addSeries(bar_series)
@@ -2408,8 +2791,8 @@ class FinanceApp(QMainWindow):
                     max_value = max(max(income for _, income, _ in category_stats), 
                                 max(expense for _, _, expense in category_stats))
                 else:
-                    max_value = 100  # 设置一个默认值，避免空序列错误
-                axis_y.setRange(0, max_value * 1.1)
+                    max_value = Money(10000)  # 设置一个默认值（100元），避免空序列错误
+                axis_y.setRange(0, float(max_value) * 1.1)
                 chart.addAxis(axis_y, Qt.AlignLeft)
                 bar_series.attachAxis(axis_y)
                 
@@ -2417,14 +2800,7 @@ class FinanceApp(QMainWindow):
         
         # 借款还款明细
         if chart_type == "借款还款":
-            self.cursor.execute("""
-                SELECT id, amount, description, date, status
-                FROM transactions
-                WHERE type='借款' AND date BETWEEN ? AND ?
-                ORDER BY date ASC
-            """, (date_from, date_to))
-            
-            loans = self.cursor.fetchall()
+            loans = self.ledger.period_loans(date_from, date_to)
             
             if loans:
                 stats_html += """
@@ -2438,18 +2814,14 @@ class FinanceApp(QMainWindow):
                 repaid_amounts = []
                 
                 for loan in loans:
-                    loan_id, amount, desc, date, status = loan
+                    loan_id, amount, desc, date, status, repaid = loan
+                    amount = Money(amount)
+                    repaid = Money(repaid)
                     loan_ids.append(str(loan_id))
                     loan_amounts.append(amount)
                     
                     # 状态显示为中文
                     status_text = "待还款" if status == "pending" else "已结清" if status == "settled" else status
-
-                    self.cursor.execute("""
-                        SELECT SUM(amount) FROM transactions
-                        WHERE type='还款' AND related_id=?
-                    """, (loan_id,))
-                    repaid = self.cursor.fetchone()[0] or 0
                     repaid_amounts.append(repaid)
                     
                     stats_html += f"""
@@ -2471,13 +2843,13 @@ class FinanceApp(QMainWindow):
                 # 借款柱
                 loan_set = QBarSet("借款金额")
                 for amount in loan_amounts:
-                    loan_set.append(amount)
+                    loan_set.append(float(amount))
                 bar_series.append(loan_set)
                 
                 # 还款柱
                 repaid_set = QBarSet("已还款")
                 for repaid in repaid_amounts:
-                    repaid_set.append(repaid)
+                    repaid_set.append(float(repaid))
                 bar_series.append(repaid_set)
                 
                 chart.addSeries(bar_series)
@@ -2491,7 +2863,7 @@ class FinanceApp(QMainWindow):
                 # 设置Y轴
                 axis_y = QValueAxis()
                 max_value = max(max(loan_amounts), max(repaid_amounts))
-                axis_y.setRange(0, max_value * 1.1)
+                axis_y.setRange(0, float(max_value) * 1.1)
                 chart.addAxis(axis_y, Qt.AlignLeft)
                 bar_series.attachAxis(axis_y)
                 
@@ -2502,21 +2874,9 @@ class FinanceApp(QMainWindow):
             # 获取当前月份
             current_month = QDate.currentDate().toString("yyyy-MM")
             
-            # 获取预算数据
-            self.cursor.execute("""
-                SELECT category, amount FROM budgets
-                WHERE month=?
-            """, (current_month,))
-            budgets = {row[0]: row[1] for row in self.cursor.fetchall()}
-            
-            # 获取实际支出
-            self.cursor.execute("""
-                SELECT category, SUM(amount) 
-                FROM transactions 
-                WHERE type='expense' AND strftime('%Y-%m', date)=?
-                GROUP BY category
-            """, (current_month,))
-            expenses = {row[0]: row[1] for row in self.cursor.fetchall()}
+            # 获取预算数据和实际支出
+            budgets = self.ledger.budgets_for_month(current_month)
+            expenses = self.ledger.month_expenses_by_category(current_month)
             
             # 合并所有分类
             all_categories = set(budgets.keys()).union(set(expenses.keys()))
@@ -2533,10 +2893,10 @@ class FinanceApp(QMainWindow):
                 categories = []
                 
                 for category in sorted(all_categories):
-                    budget = budgets.get(category, 0)
-                    expense = expenses.get(category, 0)
+                    budget = budgets.get(category, Money(0))
+                    expense = expenses.get(category, Money(0))
                     diff = budget - expense
-                    percentage = (expense / budget * 100) if budget > 0 else 0
+                    percentage = (expense.cents / budget.cents * 100) if budget > Money(0) else 0
                     
                     row_class = "budget-over" if expense > budget else "budget-under"
                     
@@ -2562,13 +2922,13 @@ class FinanceApp(QMainWindow):
                 # 预算柱
                 budget_set = QBarSet("预算")
                 for amount in budget_data:
-                    budget_set.append(amount)
+                    budget_set.append(float(amount))
                 bar_series.append(budget_set)
                 
                 # 支出柱
                 expense_set = QBarSet("实际支出")
                 for amount in expense_data:
-                    expense_set.append(amount)
+                    expense_set.append(float(amount))
                 bar_series.append(expense_set)
                 
                 chart.addSeries(bar_series)
@@ -2582,7 +2942,7 @@ class FinanceApp(QMainWindow):
                 # 设置Y轴
                 axis_y = QValueAxis()
                 max_value = max(max(budget_data), max(expense_data))
-                axis_y.setRange(0, max_value * 1.1)
+                axis_y.setRange(0, float(max_value) * 1.1)
                 chart.addAxis(axis_y, Qt.AlignLeft)
                 bar_series.attachAxis(axis_y)
                 
@@ -2608,6 +2968,9 @@ class FinanceApp(QMainWindow):
             self.master_conn.commit()
         
         self.close_current_db()
+        
+        # 清零上一个用户的密钥缓存
+        self.key_service.clear()
         self.show_login_dialog()
         
         # 更新窗口标题
@@ -2620,72 +2983,113 @@ class FinanceApp(QMainWindow):
     def close_current_db(self):
         """关闭当前用户数据库"""
         if hasattr(self, 'conn'):
+            self.stop_recovery_log()
+            
+            # 记下是否还有未备份的修改，下次打开后按原计划补做备份
+            if getattr(self, 'backup_scheduler', None) is not None:
+                self.backup_scheduler.observe(change_counter(self.conn))
+                self.save_backup_schedule()
+            
             # 如果是加密数据库，保存加密数据
             if self.db_encrypted:
-                # 导出内存数据库到文件
-                db_name = f'finance_{self.current_user}.db'
-                with open(db_name, 'wb') as f:
-                    # 获取所有数据
-                    temp_conn = sqlite3.connect(':memory:')
-                    temp_cursor = temp_conn.cursor()
-                    
-                    # 获取所有数据
-                    temp_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table'")
-                    schema = "\n".join([row[0] for row in temp_cursor.fetchall()])
-                    
-                    # 获取所有数据
-                    data_dump = []
-                    temp_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                    tables = [row[0] for row in temp_cursor.fetchall()]
-                    
-                    for table in tables:
-                        temp_cursor.execute(f"SELECT * FROM {table}")
-                        data = temp_cursor.fetchall()
-                        columns = [desc[0] for desc in temp_cursor.description]
-                        
-                        for row in data:
-                            values = ", ".join([f"'{str(v)}'" if v is not None else "NULL" for v in row])
-                            data_dump.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({values});")
-                    
-                    temp_conn.close()
-                    
-                    # 合并模式和数据进行加密
-                    full_dump = schema + "\n" + "\n".join(data_dump)
-                    encrypted_data = self.cipher_suite.encrypt(full_dump.encode('utf-8'))
-                    f.write(encrypted_data)
+                if getattr(self, 'change_journal', None) is not None:
+                    # 每次提交都已追加到变更日志，磁盘上的快照+日志就是最新状态
+                    self.stop_change_journal()
+                else:
+                    # 把内存数据库加密写回文件
+                    self.write_encrypted_snapshot(f'finance_{self.current_user}.db')
             
-            self.conn.close()
+            self.db_manager.close(self.conn)
+
+    def check_backup_schedule(self):
+        """由backup_timer定期调用：有修改且到期（编辑已停顿）时开始自动备份"""
+        if self.pending_backup is not None and not self.pending_backup.done():
+            return
+        if self.backup_scheduler.due(change_counter(self.conn)):
+            self.auto_backup()
 
     def auto_backup(self):
-        """自动备份数据库"""
-        backup_file = self.backup_database("auto")
-        if backup_file:
+        """自动备份数据库（在后台线程执行，不等待结果）"""
+        if self.pending_backup is not None and not self.pending_backup.done():
+            print("上一次自动备份尚未完成，跳过")
+            return
+        try:
+            self.pending_backup = self.start_backup("auto")
+        except Exception as e:
+            print(f"自动备份失败: {str(e)}")
+            self.backup_scheduler.failed()
+            return
+        self.backup_scheduler.started()
+        self.save_backup_schedule()
+        self.backup_poll_timer.start(200)
+
+    def check_pending_backup(self):
+        """自动备份完成后清理旧备份并记录结果"""
+        future = self.pending_backup
+        if future is None or not future.done():
+            return
+        self.backup_poll_timer.stop()
+        self.pending_backup = None
+        try:
+            backup_file = future.result()
+            self.cleanup_old_backups()
             print(f"自动备份成功: {backup_file}")
-        else:
-            print("自动备份失败")
+        except Exception as e:
+            print(f"自动备份失败: {str(e)}")
+            self.backup_scheduler.failed()
 
     def setup_auto_backup_timer(self, interval_hours=1):
-        """设置自动备份定时器"""
-        if hasattr(self, 'backup_timer'):
-            self.backup_timer.stop()
+        """设置自动备份间隔（由调度器判断何时备份，定时器不需要重新设置）"""
+        self.backup_scheduler.interval = interval_hours * 3600
+        self.save_backup_schedule()
+
+    def load_backup_schedule(self):
+        """
+        从主数据库读取当前用户的自动备份计划
         
-        self.backup_timer = QTimer()
-        self.backup_timer.timeout.connect(self.auto_backup)
-        self.backup_timer.start(interval_hours * 3600000)  # 转换为毫秒
+        settings表中key为'backup_schedule_<用户>'，value为BackupScheduler.state()的JSON
+        """
+        self.master_cursor.execute("SELECT value FROM settings WHERE key=?",
+                                   (f"backup_schedule_{self.current_user}",))
+        result = self.master_cursor.fetchone()
+        if result:
+            try:
+                return BackupScheduler.from_state(json.loads(result[0]))
+            except (ValueError, TypeError) as e:
+                print(f"自动备份计划无效，使用默认值: {str(e)}")
+        return BackupScheduler()
+
+    def save_backup_schedule(self):
+        """保存自动备份计划（只在备份开始、修改设置和关闭数据库时调用）"""
+        self.master_cursor.execute(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            (f"backup_schedule_{self.current_user}", json.dumps(self.backup_scheduler.state()))
+        )
+        self.master_conn.commit()
 
     def manual_backup(self):
         """手动备份数据库"""
         backup_file = self.backup_database("manual")
         if backup_file:
-            self.statusBar().showMessage(f"✅ 手动备份成功: {os.path.basename(backup_file)}", 5000)
+            # 手动备份已包含当前的修改，自动备份重新计时
+            self.backup_scheduler.started()
+            self.save_backup_schedule()
+            message = f"✅ 手动备份成功: {os.path.basename(backup_file)}"
+            try:
+                new_bytes = read_backup_info(backup_file).metadata.get("new_bytes")
+            except (BackupIntegrityError, OSError):
+                new_bytes = None
+            if new_bytes is not None:
+                message += f"（新增 {new_bytes / 1024:.1f} KB）"
+            self.statusBar().showMessage(message, 5000)
 
 
     def set_auto_backup(self):
         """设置自动备份间隔"""
         intervals = {
-            "每小时": 3600000,
-            "每天": 86400000,
-            "每周": 604800000
+            "每小时": 1,
+            "每天": 24,
+            "每周": 168
         }
         
         interval, ok = QInputDialog.getItem(
@@ -2694,7 +3098,7 @@ class FinanceApp(QMainWindow):
         )
         
         if ok and interval:
-            self.backup_timer.setInterval(intervals[interval])
+            self.setup_auto_backup_timer(intervals[interval])
             self.statusBar().showMessage(f"✅ 已设置为{interval}自动备份", 5000)
 
     def restore_data(self):
@@ -2718,19 +3122,8 @@ class FinanceApp(QMainWindow):
             if reply == QMessageBox.Yes:
                 try:
                     self.close_current_db()
-                    
-                    if self.db_encrypted:
-                        # 对于加密数据库，需要先解密备份
-                        with open(file_name, 'rb') as f:
-                            encrypted_data = f.read()
-                        decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                        
-                        # 创建内存数据库
-                        self.conn = sqlite3.connect(':memory:')
-                        self.conn.executescript(decrypted_data.decode('utf-8'))
-                    else:
-                        shutil.copy2(file_name, f'finance_{self.current_user}.db')
-                        self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
+                    self.load_backup(file_name)
+                    self.start_recovery_log(rebase=True)
                     
                     self.cursor = self.conn.cursor()
                     self.load_data()
@@ -2738,8 +3131,10 @@ class FinanceApp(QMainWindow):
                     self.statusBar().showMessage("✅ 数据恢复成功!", 5000)
                 except Exception as e:
                     self.statusBar().showMessage(f"❌ 恢复失败: {str(e)}", 5000)
-                    self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
+                    self.conn = self.db_manager.connect(f'finance_{self.current_user}.db',
+                                                        factory=JournaledConnection)
                     self.cursor = self.conn.cursor()
+                    self.start_recovery_log(rebase=True)
 
     def show_restore_dialog(self):
         """显示恢复备份对话框"""
@@ -2756,54 +3151,18 @@ class FinanceApp(QMainWindow):
         backup_table.setSelectionBehavior(QTableWidget.SelectRows)
         backup_table.setEditTriggers(QTableWidget.NoEditTriggers)
         
-        # 加载备份文件
+        # 从备份索引加载列表（已按时间排序，最新的在前）
         backups = []
-        for f in os.listdir(self.backup_dir):
-            if f.startswith(f"finance_{self.current_user}_"):
-                file_path = os.path.join(self.backup_dir, f)
-                if os.path.isfile(file_path):
-                    # 解析备份信息
-                    parts = f.split('_')
-                    backup_type = parts[2]  # auto or manual
-                    timestamp = parts[3].split('.')[0]
-                    try:
-                        # 从文件名中提取年月日
-                        backup_date = datetime.strptime(timestamp, '%Y%m%d')
-                        backup_time = backup_date
-                    except ValueError:
-                        # 如果解析失败，使用文件修改时间
-                        backup_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-
-                    size = os.path.getsize(file_path) / 1024  # KB
-                    
-                    # 获取数据库版本信息（如果可能）
-                    version_info = "未知版本"
-                    try:
-                        if self.db_encrypted:
-                            with open(file_path, 'rb') as f_obj:
-                                encrypted_data = f_obj.read()
-                                decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                                temp_conn = sqlite3.connect(':memory:')
-                                temp_conn.executescript(decrypted_data.decode('utf-8'))
-                                temp_cursor = temp_conn.cursor()
-                                temp_cursor.execute("SELECT version FROM db_version ORDER BY version DESC LIMIT 1")
-                                version_result = temp_cursor.fetchone()
-                                version_info = f"数据库版本: {version_result[0]}" if version_result else "未知版本"
-                                temp_conn.close()
-                        else:
-                            temp_conn = sqlite3.connect(file_path)
-                            temp_cursor = temp_conn.cursor()
-                            temp_cursor.execute("SELECT version FROM db_version ORDER BY version DESC LIMIT 1")
-                            version_result = temp_cursor.fetchone()
-                            version_info = f"数据库版本: {version_result[0]}" if version_result else "未知版本"
-                            temp_conn.close()
-                    except:
-                        version_info = "无法获取版本信息"
-                    
-                    backups.append((file_path, backup_time, backup_type, size, version_info))
-
-        # 按时间排序，最新的在前
-        backups.sort(key=lambda x: x[1], reverse=True)
+        backup_metadata = {}
+        for entry in self.backup_catalog.list(self.current_user):
+            # 分块备份的文件只是清单，显示数据库本身的大小
+            size = (entry.size or 0) / 1024  # KB
+            if entry.legacy:
+                version_info = "旧版备份（无元数据）"
+            else:
+                backup_metadata[entry.path] = entry.metadata
+                version_info = f"数据库版本: {entry.db_version or '未知'}"
+            backups.append((entry.path, entry.created_at, entry.type, size, version_info))
         
         backup_table.setRowCount(len(backups))
         for row, (file_path, backup_time, backup_type, size, version_info) in enumerate(backups):
@@ -2822,7 +3181,8 @@ class FinanceApp(QMainWindow):
             backup_table.setItem(row, 1, time_item)
             
             # 备份类型
-            type_item = QTableWidgetItem("自动" if backup_type == "auto" else "手动")
+            type_names = {"auto": "自动", "manual": "手动", "before_restore": "恢复前", "base": "基准"}
+            type_item = QTableWidgetItem(type_names.get(backup_type, backup_type))
             backup_table.setItem(row, 2, type_item)
             
             # 大小
@@ -2843,7 +3203,7 @@ class FinanceApp(QMainWindow):
         # 备份类型筛选
         type_filter = QComboBox()
         type_filter.addItems(["所有类型", "自动", "手动"])
-        type_filter.currentTextChanged.connect(lambda text: self.filter_backup_table(backup_table, backups, text, date_from.date(), date_to.date()))
+        type_filter.currentTextChanged.connect(lambda text: self.filter_backup_table(backup_table, text, date_from.date(), date_to.date()))
         filter_layout.addWidget(QLabel("备份类型:"))
         filter_layout.addWidget(type_filter)
         
@@ -2852,14 +3212,14 @@ class FinanceApp(QMainWindow):
         date_from = QDateEdit()
         date_from.setDate(QDate.currentDate().addMonths(-1))
         date_from.setCalendarPopup(True)
-        date_from.dateChanged.connect(lambda: self.filter_backup_table(backup_table, backups, type_filter.currentText(), date_from.date(), date_to.date()))
+        date_from.dateChanged.connect(lambda: self.filter_backup_table(backup_table, type_filter.currentText(), date_from.date(), date_to.date()))
         date_layout.addWidget(QLabel("从:"))
         date_layout.addWidget(date_from)
         
         date_to = QDateEdit()
         date_to.setDate(QDate.currentDate())
         date_to.setCalendarPopup(True)
-        date_to.dateChanged.connect(lambda: self.filter_backup_table(backup_table, backups, type_filter.currentText(), date_from.date(), date_to.date()))
+        date_to.dateChanged.connect(lambda: self.filter_backup_table(backup_table, type_filter.currentText(), date_from.date(), date_to.date()))
         date_layout.addWidget(QLabel("到:"))
         date_layout.addWidget(date_to)
         
@@ -2874,7 +3234,33 @@ class FinanceApp(QMainWindow):
         layout.addWidget(preview_label)
         
         # 选中备份时更新预览
-        backup_table.itemSelectionChanged.connect(lambda: self.update_backup_preview(backup_table, preview_label))
+        backup_table.itemSelectionChanged.connect(
+            lambda: self.update_backup_preview(backup_table, preview_label, backup_metadata))
+        
+        # 时间点恢复：最早的基准备份到现在之间的任意时刻（按秒）
+        bases = self.point_in_time_bases()
+        if bases:
+            pitr_group = QGroupBox("时间点恢复")
+            pitr_layout = QHBoxLayout(pitr_group)
+            earliest = bases[0][0]
+            time_slider = QSlider(Qt.Horizontal)
+            time_slider.setRange(0, int(time.time() - earliest))
+            time_slider.setValue(time_slider.maximum())
+            time_label = QLabel()
+            
+            def update_time_label(offset):
+                target = datetime.fromtimestamp(earliest + offset)
+                time_label.setText(target.strftime('%Y-%m-%d %H:%M:%S'))
+            
+            time_slider.valueChanged.connect(update_time_label)
+            update_time_label(time_slider.value())
+            pitr_button = QPushButton("恢复到该时间点")
+            pitr_button.clicked.connect(
+                lambda: self.restore_to_point_in_time(earliest + time_slider.value(), dialog))
+            pitr_layout.addWidget(time_slider, 1)
+            pitr_layout.addWidget(time_label)
+            pitr_layout.addWidget(pitr_button)
+            layout.addWidget(pitr_group)
         
         # 按钮
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -2885,169 +3271,139 @@ class FinanceApp(QMainWindow):
         dialog.setLayout(layout)
         dialog.exec_()
 
-    def filter_backup_table(self, table, backups, filter_type, date_from, date_to):
-        """筛选备份表格"""
+    def filter_backup_table(self, table, filter_type, date_from, date_to):
+        """筛选备份表格（条件交给备份索引查询，只显示命中的行）"""
+        backup_type = {"自动": "auto", "手动": "manual"}.get(filter_type)
+        visible = {
+            entry.path for entry in self.backup_catalog.list(
+                self.current_user, backup_type,
+                date_from.toString("yyyy-MM-dd"), date_to.toString("yyyy-MM-dd")
+            )
+        }
         for row in range(table.rowCount()):
             file_path = table.item(row, 1).data(Qt.UserRole)
-            backup_info = next((b for b in backups if b[0] == file_path), None)
-            
-            if not backup_info:
-                continue
-            
-            _, backup_date, backup_type, _, _ = backup_info
-            show_row = True
-            
-            # 类型筛选
-            if filter_type == "自动" and backup_type != "auto":
-                show_row = False
-            elif filter_type == "手动" and backup_type != "manual":
-                show_row = False
-            
-            # 日期筛选 - 使用QDate比较
-            backup_qdate = QDate(backup_date.year, backup_date.month, backup_date.day)
-            if backup_qdate < date_from or backup_qdate > date_to:
-                show_row = False
-            
-            table.setRowHidden(row, not show_row)
+            table.setRowHidden(row, file_path not in visible)
 
-    def update_backup_preview(self, table, preview_label):
-        """更新备份预览信息"""
+    def update_backup_preview(self, table, preview_label, backup_metadata=None):
+        """更新备份预览信息（新格式备份直接使用文件头中的元数据）"""
         selected = table.selectedItems()
         if not selected:
             preview_label.setText("请选择一个备份查看详细信息")
             return
         
         file_path = selected[0].data(Qt.UserRole)
+        metadata = (backup_metadata or {}).get(file_path)
         
-        # 尝试获取数据库信息
-        try:
+        if metadata is None:
             if self.db_encrypted:
-                with open(file_path, 'rb') as f:
-                    encrypted_data = f.read()
-                    decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                    temp_conn = sqlite3.connect(':memory:')
-                    temp_conn.executescript(decrypted_data.decode('utf-8'))
-            else:
-                temp_conn = sqlite3.connect(file_path)
-            
-            temp_cursor = temp_conn.cursor()
-            
-            # 获取交易记录数量
-            temp_cursor.execute("SELECT COUNT(*) FROM transactions")
-            trans_count = temp_cursor.fetchone()[0]
-            
-            # 获取最早和最晚交易日期
-            temp_cursor.execute("SELECT MIN(date), MAX(date) FROM transactions WHERE type != 'balance'")
-            min_date, max_date = temp_cursor.fetchone()
-            
-            # 获取账户信息
-            temp_cursor.execute("SELECT COUNT(*) FROM accounts")
-            account_count = temp_cursor.fetchone()[0]
-            
-            # 获取数据库版本
-            temp_cursor.execute("SELECT version FROM db_version ORDER BY version DESC LIMIT 1")
-            version_result = temp_cursor.fetchone()
-            db_version = version_result[0] if version_result else "未知"
-            
-            temp_conn.close()
-            
-            preview_text = f"""
-            <b>备份文件:</b> {os.path.basename(file_path)}<br>
-            <b>数据库版本:</b> {db_version}<br>
-            <b>交易记录数:</b> {trans_count}<br>
-            <b>交易日期范围:</b> {min_date} 至 {max_date}<br>
-            <b>账户数量:</b> {account_count}
-            """
-            
-            preview_label.setText(preview_text)
-        except Exception as e:
-            preview_label.setText(f"无法读取备份文件: {str(e)}")
+                # 旧版加密备份没有元数据，读取需要解密整个文件
+                preview_label.setText(f"<b>备份文件:</b> {os.path.basename(file_path)}<br>旧版加密备份，没有元数据")
+                return
+            metadata = self.read_legacy_backup_metadata(file_path)
+            if metadata is None:
+                preview_label.setText("无法读取备份文件")
+                return
+        
+        min_date, max_date = metadata.get("date_range") or (None, None)
+        row_counts = metadata.get("row_counts", {})
+        preview_text = f"""
+        <b>备份文件:</b> {os.path.basename(file_path)}<br>
+        <b>数据库版本:</b> {metadata.get("db_version") or "未知"}<br>
+        <b>交易记录数:</b> {row_counts.get("transactions", 0)}<br>
+        <b>交易日期范围:</b> {min_date} 至 {max_date}<br>
+        <b>账户数量:</b> {metadata.get("account_count", 0)}
+        """
+        ratio = compression_ratio(metadata)
+        if ratio:
+            preview_text += (
+                f"<br><b>压缩:</b> {metadata.get('compression')}，"
+                f"压缩比 {ratio:.1f}:1（{metadata['payload_size'] / 1024:.1f} KB → "
+                f"{metadata['stored_bytes'] / 1024:.1f} KB），"
+                f"压缩耗时 {metadata.get('compress_seconds', 0):.2f} 秒，"
+                f"写入耗时 {metadata.get('store_seconds', 0):.2f} 秒"
+            )
+        if metadata.get("checksum"):
+            preview_text += f"<br><b>校验和:</b> {metadata['checksum'][:16]}…"
+        
+        preview_label.setText(preview_text)
+
+    def read_legacy_backup_metadata(self, file_path):
+        """旧版普通备份没有文件头，只读打开统计元数据"""
+        try:
+            temp_conn = self.db_manager.connect(file_path, profile="readonly")
+            try:
+                return collect_metadata(temp_conn)
+            finally:
+                self.db_manager.close(temp_conn)
+        except sqlite3.Error as e:
+            print(f"读取旧版备份失败: {str(e)}")
+            return None
 
 
     def save_state_before_change(self):
-        """保存当前数据库状态以便撤销"""
-        # 只保留最近的10次操作记录
-        if len(self.operation_stack) >= 10:
-            oldest_file = self.operation_stack.pop(0)
-            try:
-                os.remove(oldest_file)
-            except:
-                pass
-        
-        # 保存当前数据库状态
-        backup_file = f"temp_undo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        
-        if self.db_encrypted:
-            # 导出内存数据库
-            with open(backup_file, 'wb') as f:
-                # 获取所有数据
-                temp_conn = sqlite3.connect(':memory:')
-                temp_cursor = temp_conn.cursor()
-                
-                # 获取所有数据
-                temp_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table'")
-                schema = "\n".join([row[0] for row in temp_cursor.fetchall()])
-                
-                # 获取所有数据
-                data_dump = []
-                temp_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                tables = [row[0] for row in temp_cursor.fetchall()]
-                
-                for table in tables:
-                    temp_cursor.execute(f"SELECT * FROM {table}")
-                    data = temp_cursor.fetchall()
-                    columns = [desc[0] for desc in temp_cursor.description]
-                    
-                    for row in data:
-                        values = ", ".join([f"'{str(v)}'" if v is not None else "NULL" for v in row])
-                        data_dump.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({values});")
-                
-                temp_conn.close()
-                
-                # 合并模式和数据进行加密
-                full_dump = schema + "\n" + "\n".join(data_dump)
-                encrypted_data = self.cipher_suite.encrypt(full_dump.encode('utf-8'))
-                f.write(encrypted_data)
-        else:
-            shutil.copy2(f'finance_{self.current_user}.db', backup_file)
+        """开始记录一个可撤销的操作（只记录被改动行的原始内容）"""
+        # 连接被替换过（切换用户、恢复备份等）时，旧的历史不再适用
+        if self.undo_log is None or self.undo_log.conn is not self.conn:
+            self.undo_log = UndoLog(self.conn, memory_budget=self.load_undo_memory_budget())
+        self.undo_log.begin_step()
+
+    def finish_change(self):
+        """可撤销的操作结束：停止记录，之后的写入（刷新界面等）不再并入这个操作"""
+        undo_log = self.current_undo_log()
+        if undo_log is not None:
+            undo_log.end_step()
+
+    def load_undo_memory_budget(self):
+        """
+        从主数据库读取撤销历史的内存上限（字节）
         
-        self.operation_stack.append(backup_file)
+        settings表中key为'undo_memory_mb'，value为MB数，没有时使用默认值
+        """
+        self.master_cursor.execute("SELECT value FROM settings WHERE key='undo_memory_mb'")
+        result = self.master_cursor.fetchone()
+        if not result:
+            return DEFAULT_MEMORY_BUDGET
+        try:
+            return int(result[0]) * 1024 * 1024
+        except ValueError as e:
+            print(f"撤销内存上限配置无效，使用默认值: {str(e)}")
+            return DEFAULT_MEMORY_BUDGET
+
+    def current_undo_log(self):
+        """当前连接的撤销历史，没有时返回None"""
+        if self.undo_log is not None and self.undo_log.conn is self.conn:
+            return self.undo_log
+        return None
 
     def undo_last_operation(self):
         """撤销最后一次操作"""
-        if not self.operation_stack:
+        undo_log = self.current_undo_log()
+        if undo_log is None or not undo_log.can_undo():
             self.statusBar().showMessage("❌ 没有可撤销的操作!", 5000)
             return
         
-        backup_file = self.operation_stack.pop()
-        
         try:
-            self.close_current_db()
-            
-            if self.db_encrypted:
-                # 解密备份文件
-                with open(backup_file, 'rb') as f:
-                    encrypted_data = f.read()
-                decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                
-                # 创建内存数据库
-                self.conn = sqlite3.connect(':memory:')
-                self.conn.executescript(decrypted_data.decode('utf-8'))
-            else:
-                shutil.copy2(backup_file, f'finance_{self.current_user}.db')
-                self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
-            
-            self.cursor = self.conn.cursor()
+            undo_log.undo()
             self.load_data()
             self.update_statistics()
             self.statusBar().showMessage("✅ 已撤销最后一次操作!", 5000)
-            
-            # 删除临时文件
-            os.remove(backup_file)
         except Exception as e:
             self.statusBar().showMessage(f"❌ 撤销失败: {str(e)}", 5000)
-            self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
-            self.cursor = self.conn.cursor()
+
+    def redo_last_operation(self):
+        """重做最近撤销的操作"""
+        undo_log = self.current_undo_log()
+        if undo_log is None or not undo_log.can_redo():
+            self.statusBar().showMessage("❌ 没有可重做的操作!", 5000)
+            return
+        
+        try:
+            undo_log.redo()
+            self.load_data()
+            self.update_statistics()
+            self.statusBar().showMessage("✅ 已重做操作!", 5000)
+        except Exception as e:
+            self.statusBar().showMessage(f"❌ 重做失败: {str(e)}", 5000)
 
     def manage_categories(self):
         """管理分类"""
@@ -3233,7 +3589,7 @@ class FinanceApp(QMainWindow):
                 # 余额列右对齐
                 if col == 2:
                     item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-                    item.setText(f"{float(value):.2f}")
+                    item.setText(f"{Money(value):.2f}")
                 
                 self.account_table.setItem(row, col, item)
         
@@ -3282,7 +3638,7 @@ class FinanceApp(QMainWindow):
                 return
                 
             try:
-                balance = float(balance)
+                balance = Money.parse(balance)
             except ValueError:
                 self.statusBar().showMessage("❌ 余额必须是有效数字!", 5000)
                 return
@@ -3332,7 +3688,7 @@ class FinanceApp(QMainWindow):
         layout.addRow("账户名:", name_edit)
         
         # 余额
-        balance_edit = QLineEdit(f"{balance:.2f}")
+        balance_edit = QLineEdit(f"{Money(balance):.2f}")
         layout.addRow("余额:", balance_edit)
         
         # 货币
@@ -3364,7 +3720,7 @@ class FinanceApp(QMainWindow):
                 return
                 
             try:
-                new_balance = float(new_balance)
+                new_balance = Money.parse(new_balance)
             except ValueError:
                 self.statusBar().showMessage("❌ 余额必须是有效数字!", 5000)
                 return
@@ -3491,28 +3847,13 @@ class FinanceApp(QMainWindow):
         selected_month = self.budget_month_combo.currentData().toString("yyyy-MM")
         
         # 获取所有支出分类
-        self.cursor.execute("""
-            SELECT name FROM categories 
-            WHERE type='expense'
-            ORDER BY name
-        """)
-        categories = [row[0] for row in self.cursor.fetchall()]
+        categories = self.ledger.list_categories('expense')
         
         # 获取预算数据
-        self.cursor.execute("""
-            SELECT category, amount FROM budgets
-            WHERE month=?
-        """, (selected_month,))
-        budgets = {row[0]: row[1] for row in self.cursor.fetchall()}
+        budgets = self.ledger.budgets_for_month(selected_month)
         
         # 获取实际支出
-        self.cursor.execute("""
-            SELECT category, SUM(amount) 
-            FROM transactions 
-            WHERE type='expense' AND strftime('%Y-%m', date)=?
-            GROUP BY category
-        """, (selected_month,))
-        expenses = {row[0]: row[1] for row in self.cursor.fetchall()}
+        expenses = self.ledger.month_expenses_by_category(selected_month)
         
         # 设置表格
         self.budget_table.setRowCount(len(categories))
@@ -3523,18 +3864,18 @@ class FinanceApp(QMainWindow):
             self.budget_table.setItem(row, 0, category_item)
             
             # 预算列
-            budget = budgets.get(category, 0)
+            budget = budgets.get(category, Money(0))
             budget_item = QTableWidgetItem(f"{budget:.2f}")
             budget_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             self.budget_table.setItem(row, 1, budget_item)
             
             # 实际支出列
-            expense = expenses.get(category, 0)
+            expense = expenses.get(category, Money(0))
             expense_item = QTableWidgetItem(f"{expense:.2f}")
             expense_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             
             # 如果实际支出超过预算，标记为红色
-            if expense > budget and budget > 0:
+            if expense > budget and budget > Money(0):
                 expense_item.setForeground(Qt.red)
             
             self.budget_table.setItem(row, 2, expense_item)
@@ -3579,7 +3920,7 @@ class FinanceApp(QMainWindow):
                 self.cursor.execute("""
                     INSERT INTO budgets (category, amount, month)
                     VALUES (?, ?, ?)
-                """, (category, amount, selected_month))
+                """, (category, Money.from_yuan(amount), selected_month))
                 self.conn.commit()
                 
                 self.statusBar().showMessage("✅ 预算已添加!", 5000)
@@ -3603,19 +3944,19 @@ class FinanceApp(QMainWindow):
             SELECT amount FROM budgets
             WHERE category=? AND month=?
         """, (category, selected_month))
-        current_amount = self.cursor.fetchone()[0]
+        current_amount = Money(self.cursor.fetchone()[0])
         
         # 输入新预算金额
         amount, ok = QInputDialog.getDouble(
             dialog, "编辑预算", f"请输入{category}的新预算金额:",
-            value=current_amount, min=0.01, max=1000000, decimals=2
+            value=float(current_amount), min=0.01, max=1000000, decimals=2
         )
         
         if ok:
             self.cursor.execute("""
                 UPDATE budgets SET amount=?
                 WHERE category=? AND month=?
-            """, (amount, category, selected_month))
+            """, (Money.from_yuan(amount), category, selected_month))
             self.conn.commit()
             
             self.statusBar().showMessage("✅ 预算已更新!", 5000)
@@ -3676,6 +4017,11 @@ class FinanceApp(QMainWindow):
         execute_btn.clicked.connect(lambda: self.execute_recurring_transaction(dialog))
         button_layout.addWidget(execute_btn)
         
+        # 补记所有到期的定期交易
+        catch_up_btn = QPushButton("补记到期交易")
+        catch_up_btn.clicked.connect(lambda: self.catch_up_recurring_transactions(dialog))
+        button_layout.addWidget(catch_up_btn)
+        
         # 删除
         delete_btn = QPushButton("删除")
         delete_btn.clicked.connect(lambda: self.delete_recurring_transaction(dialog))
@@ -3722,7 +4068,7 @@ class FinanceApp(QMainWindow):
                 # 金额列右对齐
                 if col == 2:
                     item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-                    item.setText(f"{float(value):.2f}")
+                    item.setText(f"{Money(value):.2f}")
                 
                 self.recurring_table.setItem(row, col, item)
         
@@ -3741,7 +4087,7 @@ class FinanceApp(QMainWindow):
         # 获取交易详情
         self.cursor.execute("""
             SELECT type, amount, category, description, account_id, tags, 
-                   receipt_image, recurring_freq, recurring_end
+                   receipt_hash, recurring_freq, recurring_end
             FROM transactions
             WHERE id=?
         """, (trans_id,))
@@ -3771,13 +4117,12 @@ class FinanceApp(QMainWindow):
         self.save_state_before_change()
         
         # 添加新交易记录
-        self.cursor.execute('''
-            INSERT INTO transactions 
-            (type, amount, category, description, date, account_id, tags, 
-             receipt_image, is_recurring, recurring_freq, recurring_end)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
-        ''', (type_, amount, category, desc, next_date.toString("yyyy-MM-dd"), 
-              account_id, tags, receipt, freq, end_date))
+        self.ledger.insert_transactions([{
+            "type": type_, "amount": amount, "category": category, "description": desc,
+            "date": next_date.toString("yyyy-MM-dd"), "account_id": account_id, "tags": tags,
+            "receipt_hash": receipt, "is_recurring": 1, "recurring_freq": freq,
+            "recurring_end": end_date,
+        }])
         
         # 更新原定期交易的下次执行日期
         self.cursor.execute('''
@@ -3789,12 +4134,75 @@ class FinanceApp(QMainWindow):
         
         # 更新账户余额
         self.update_account_balance(account_id)
+        self.finish_change()
         
         self.statusBar().showMessage("✅ 定期交易已执行!", 5000)
         self.load_recurring_transactions()
         self.load_data()
         self.update_statistics()
 
+    def catch_up_recurring_transactions(self, dialog):
+        """
+        补记所有到期的定期交易
+        
+        从每个定期交易的下次执行日期开始，把截至今天（且不晚于结束日期）的每一期
+        都补记为普通交易，一次批量写入，然后把下次执行日期推到今天之后。
+        """
+        today = QDate.currentDate()
+        self.cursor.execute("""
+            SELECT id, type, amount, category, description, account_id, tags,
+                   receipt_hash, date, recurring_freq, recurring_end
+            FROM transactions
+            WHERE is_recurring=1 AND date <= ?
+        """, (today.toString("yyyy-MM-dd"),))
+        templates = self.cursor.fetchall()
+        
+        records = []
+        next_dates = []
+        for (trans_id, type_, amount, category, desc, account_id, tags,
+             receipt, date, freq, end_date) in templates:
+            run_date = QDate.fromString(date, "yyyy-MM-dd")
+            end_qdate = QDate.fromString(end_date, "yyyy-MM-dd") if end_date else None
+            
+            while run_date and run_date.isValid() and run_date <= today:
+                if end_qdate and run_date > end_qdate:
+                    break
+                records.append({
+                    "type": type_, "amount": amount, "category": category,
+                    "description": desc, "date": run_date.toString("yyyy-MM-dd"),
+                    "account_id": account_id, "tags": tags, "receipt_hash": receipt,
+                })
+                run_date = self.calculate_next_date(run_date, freq)
+            
+            if run_date and run_date.isValid():
+                next_dates.append((run_date.toString("yyyy-MM-dd"), trans_id))
+        
+        if not records:
+            self.statusBar().showMessage("没有需要补记的定期交易", 5000)
+            return
+        
+        # 保存当前状态以便撤销
+        self.save_state_before_change()
+        
+        try:
+            count = self.ledger.insert_transactions(records)
+            self.cursor.executemany("UPDATE transactions SET date=? WHERE id=?", next_dates)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.finish_change()
+            self.statusBar().showMessage(f"❌ 补记定期交易失败: {str(e)}", 5000)
+            return
+        
+        for account_id in {record["account_id"] for record in records}:
+            self.update_account_balance(account_id)
+        self.finish_change()
+        
+        self.statusBar().showMessage(f"✅ 已补记 {count} 笔定期交易!", 5000)
+        self.load_recurring_transactions()
+        self.load_data()
+        self.update_statistics()
+
     def calculate_next_date(self, last_date, freq):
         """计算下次执行日期"""
         if freq == "每日":
@@ -3829,11 +4237,15 @@ class FinanceApp(QMainWindow):
             self.save_state_before_change()
             
             # 删除记录
+            self.cursor.execute("SELECT receipt_hash FROM transactions WHERE id=?", (trans_id,))
+            receipt_hashes = [row[0] for row in self.cursor.fetchall()]
             self.cursor.execute('''
                 DELETE FROM transactions 
                 WHERE id=?
             ''', (trans_id,))
+            release_receipts(self.conn, receipt_hashes)
             self.conn.commit()
+            self.finish_change()
             
             self.statusBar().showMessage("✅ 定期交易已删除!", 5000)
             self.load_recurring_transactions()
@@ -3987,19 +4399,21 @@ class FinanceApp(QMainWindow):
                 # 写入标题行
                 writer.writerow([
                     "ID", "类型", "金额", "分类", "描述", "日期", 
-                    "状态", "关联ID", "账户", "标签", "收据图片"
+                    "状态", "关联ID", "账户", "标签", "收据哈希"
                 ])
                 
                 # 获取所有数据
                 self.cursor.execute("""
                     SELECT t.id, t.type, t.amount, t.category, t.description, t.date, 
-                           t.status, t.related_id, a.name, t.tags, t.receipt_image
+                           t.status, t.related_id, a.name, t.tags, t.receipt_hash
                     FROM transactions t
                     LEFT JOIN accounts a ON t.account_id = a.id
                     ORDER BY t.date, t.id
                 """)
                 
                 for row in self.cursor.fetchall():
+                    row = list(row)
+                    row[2] = str(Money(row[2]))  # 金额由分换算为元
                     writer.writerow(row)
                 
             self.statusBar().showMessage(f"✅ 数据已导出到 {file_name}", 5000)
@@ -4047,6 +4461,8 @@ class FinanceApp(QMainWindow):
             """)
             
             for row in self.cursor.fetchall():
+                row = list(row)
+                row[2] = Money(row[2]).to_decimal()  # 金额由分换算为元
                 ws.append(row)
             
             # 设置列宽
@@ -4064,25 +4480,11 @@ class FinanceApp(QMainWindow):
         today = QDate.currentDate().toString("yyyy-MM-dd")
         
         # 检查待还款借款
-        self.cursor.execute("""
-            SELECT id, amount, description, date 
-            FROM transactions 
-            WHERE type='借款' AND status='pending'
-            ORDER BY date
-        """)
-        pending_loans = self.cursor.fetchall()
+        pending_loans = self.ledger.pending_loans()
         
         # 检查预算超支
         current_month = QDate.currentDate().toString("yyyy-MM")
-        self.cursor.execute("""
-            SELECT b.category, b.amount, 
-                (SELECT SUM(amount) FROM transactions 
-                    WHERE type='expense' AND category=b.category 
-                    AND strftime('%Y-%m', date)=b.month) as expense
-            FROM budgets b
-            WHERE b.month=?
-        """, (current_month,))
-        budgets = self.cursor.fetchall()
+        over_budgets = self.ledger.over_budget_categories(current_month)
         
         # 检查定期交易
         self.cursor.execute("""
@@ -4098,10 +4500,8 @@ class FinanceApp(QMainWindow):
         if pending_loans:
             reminder_text += f"待还款借款: {len(pending_loans)}笔 "
             
-        if budgets:
-            over_budgets = [b for b in budgets if b[2] and b[2] > b[1]]
-            if over_budgets:
-                reminder_text += f"预算超支: {len(over_budgets)}个分类 "
+        if over_budgets:
+            reminder_text += f"预算超支: {len(over_budgets)}个分类 "
         
         if recurring_trans:
             reminder_text += f"待执行定期交易: {len(recurring_trans)}笔"
@@ -4118,7 +4518,11 @@ class FinanceApp(QMainWindow):
         today = QDate.currentDate()
         
         if index == 0:  # 全部时间
-            self.cursor.execute("SELECT MIN(date), MAX(date) FROM transactions")
+            # 拆成两个子查询，MIN/MAX各自直接读取date索引的两端
+            self.cursor.execute("""
+                SELECT (SELECT MIN(date) FROM transactions),
+                       (SELECT MAX(date) FROM transactions)
+            """)
             min_date, max_date = self.cursor.fetchone()
             if min_date and max_date:
                 self.date_from_edit.setDate(QDate.fromString(min_date, "yyyy-MM-dd"))
@@ -4152,8 +4556,12 @@ class FinanceApp(QMainWindow):
     def save_settings(self):
         """保存配置"""
         try:
-            # 保存日期范围配置
+            # 保存日期范围配置（值没有变化时不写入，否则空闲的会话也会被当作有修改而触发备份）
             index = self.date_range_combo.currentIndex()
+            self.cursor.execute("SELECT value FROM settings WHERE key='date_range'")
+            result = self.cursor.fetchone()
+            if result and result[0] == str(index):
+                return
             self.cursor.execute(
                 "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
                 ('date_range', str(index))
@@ -4163,7 +4571,7 @@ class FinanceApp(QMainWindow):
             pass
 
     def cleanup_old_temp_files(self, max_age_hours=24):
-        """清理超过指定时间的临时文件"""
+        """清理超过指定时间的临时文件（旧版本撤销功能遗留的temp_undo_*.db）"""
         import glob
         from datetime import datetime, timedelta
         
@@ -4205,18 +4613,17 @@ class FinanceApp(QMainWindow):
         self.backup_timer.stop()
         self.reminder_timer.stop()
         self.cleanup_timer.stop()
+        self.backup_poll_timer.stop()
+        
+        # 等待正在进行的备份写完
+        self.backup_executor.shutdown(wait=True)
         
         # 关闭数据库连接
         self.close_current_db()
         if hasattr(self, 'master_conn'):
-            self.master_conn.close()
-        
-        # 清理临时撤销文件
-        for file in self.operation_stack:
-            try:
-                os.remove(file)
-            except:
-                pass
+            self.db_manager.close(self.master_conn)
+        self.db_manager.close_all()
+        self.key_service.shutdown()
         
         event.accept()
 
@@ -4333,16 +4740,16 @@ class FinanceApp(QMainWindow):
         for row, (account_id, name, balance, income, expense) in enumerate(accounts):
             self.balance_table.setItem(row, 0, QTableWidgetItem(name))
             
-            balance_item = QTableWidgetItem(f"{balance or 0:.2f}")
+            balance_item = QTableWidgetItem(f"{Money(balance):.2f}")
             balance_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             self.balance_table.setItem(row, 1, balance_item)
             
-            income_item = QTableWidgetItem(f"{income or 0:.2f}")
+            income_item = QTableWidgetItem(f"{Money(income):.2f}")
             income_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             income_item.setForeground(Qt.darkGreen)
             self.balance_table.setItem(row, 2, income_item)
             
-            expense_item = QTableWidgetItem(f"{expense or 0:.2f}")
+            expense_item = QTableWidgetItem(f"{Money(expense):.2f}")
             expense_item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
             expense_item.setForeground(Qt.darkRed)
             self.balance_table.setItem(row, 3, expense_item)
@@ -4355,30 +4762,13 @@ class FinanceApp(QMainWindow):
         # 保存当前状态以便撤销
         self.save_state_before_change()
         
-        # 获取所有账户
-        self.cursor.execute("SELECT id, name FROM accounts")
-        accounts = self.cursor.fetchall()
-        
-        for account_id, account_name in accounts:
-            # 计算账户余额
-            self.cursor.execute("""
-                SELECT 
-                    SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                    SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-                FROM transactions
-                WHERE account_id=? AND type != 'balance'
-            """, (account_id,))
-            
-            balance = self.cursor.fetchone()[0] or 0
-            
-            # 更新账户余额
-            self.cursor.execute("""
-                UPDATE accounts SET balance=? WHERE id=?
-            """, (balance, account_id))
+        # 根据交易记录重建每日余额，再逐个账户写回余额
+        rebuild_daily_balances(self.conn)
+        for account_id, account_name in self.ledger.list_accounts():
+            self.ledger.refresh_account_balance(account_id)
         
         self.conn.commit()
+        self.finish_change()
         self.update_account_balances()  # 更新UI显示
         self.statusBar().showMessage("✅ 账户余额已重新计算并更新", 5000)
 
@@ -4395,17 +4785,7 @@ class FinanceApp(QMainWindow):
         
         for balance_date in balance_dates:
             # 计算新的总余额
-            self.cursor.execute("""
-                SELECT 
-                    SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                    SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-                FROM transactions
-                WHERE date <= ? AND type != 'balance'
-            """, (balance_date,))
-            
-            new_balance = self.cursor.fetchone()[0] or 0
+            new_balance = self.ledger.total_balance_at(balance_date)
             
             # 更新总余额记录
             self.cursor.execute("""
@@ -4429,17 +4809,7 @@ class FinanceApp(QMainWindow):
             
             for balance_date in balance_dates:
                 # 计算新的账户余额
-                self.cursor.execute("""
-                    SELECT 
-                        SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                        SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                        SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                        SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-                    FROM transactions
-                    WHERE date <= ? AND type != 'balance' AND account_id=?
-                """, (balance_date, account_id))
-                
-                new_balance = self.cursor.fetchone()[0] or 0
+                new_balance = self.ledger.account_balance_at(account_id, balance_date)
                 
                 # 更新账户余额记录
                 self.cursor.execute("""
@@ -4520,7 +4890,7 @@ class FinanceApp(QMainWindow):
                     img.thumbnail((800, 800))
                     buffered = io.BytesIO()
                     img.save(buffered, format="JPEG", quality=70)
-                    receipt_image_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
+                    receipt_image_data = buffered.getvalue()
                     
                     pixmap = QPixmap(file_name)
                     pixmap = pixmap.scaled(100, 100, Qt.KeepAspectRatio)
@@ -4603,20 +4973,14 @@ class FinanceApp(QMainWindow):
         # 更新关联借款选择框
         def update_loan_combo():
             loan_combo.clear()
-            self.cursor.execute("""
-                SELECT id, amount, description, date 
-                FROM transactions 
-                WHERE type='借款' AND status='pending'
-                ORDER BY date
-            """)
-            loans = self.cursor.fetchall()
+            loans = self.ledger.pending_loans()
             
             if not loans:
                 loan_combo.addItem("无待还款借款", None)
             else:
                 for loan in loans:
                     loan_combo.addItem(
-                        f"ID:{loan[0]} 金额:{loan[1]} 日期:{loan[3]} 描述:{loan[2]}", 
+                        f"ID:{loan[0]} 金额:{Money(loan[1])} 剩余:{Money(loan[4])} 日期:{loan[3]} 描述:{loan[2]}", 
                         loan[0]
                     )
         
@@ -4695,17 +5059,7 @@ class FinanceApp(QMainWindow):
             self.save_state_before_change()
             
             # 计算所有账户的总余额
-            self.cursor.execute("""
-                SELECT 
-                    SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                    SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-                FROM transactions
-                WHERE date <= ? AND type != 'balance'
-            """, (date,))
-            
-            amount = self.cursor.fetchone()[0] or 0
+            amount = self.ledger.total_balance_at(date)
             
             # 添加余额记录
             self.cursor.execute('''
@@ -4714,6 +5068,7 @@ class FinanceApp(QMainWindow):
                 VALUES (?, ?, ?, ?, ?, NULL)
             ''', ('balance', amount, "余额统计", f"截至 {date} 的总余额", date))
             self.conn.commit()
+            self.finish_change()
             
             self.statusBar().showMessage(f"✅ 总余额记录已添加: {amount:.2f} 元", 5000)
             
@@ -4728,17 +5083,7 @@ class FinanceApp(QMainWindow):
             self.save_state_before_change()
             
             # 计算特定账户的余额
-            self.cursor.execute("""
-                SELECT 
-                    SUM(CASE WHEN type='income' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='expense' THEN amount ELSE 0 END) +
-                    SUM(CASE WHEN type='还款' THEN amount ELSE 0 END) -
-                    SUM(CASE WHEN type='借款' THEN amount ELSE 0 END)
-                FROM transactions
-                WHERE date <= ? AND type != 'balance' AND account_id = ?
-            """, (date, account_id))
-            
-            amount = self.cursor.fetchone()[0] or 0
+            amount = self.ledger.account_balance_at(account_id, date)
             
             # 添加账户结余记录
             self.cursor.execute('''
@@ -4747,6 +5092,7 @@ class FinanceApp(QMainWindow):
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', ('balance', amount, "账户结余统计", f"截至 {date} 的账户结余", date, account_id))
             self.conn.commit()
+            self.finish_change()
             
             self.statusBar().showMessage(f"✅ 账户结余记录已添加: {amount:.2f} 元", 5000)
             
@@ -4761,8 +5107,8 @@ class FinanceApp(QMainWindow):
             return
         
         try:
-            amount = float(amount_text)
-            if amount <= 0:
+            amount = Money.parse(amount_text)
+            if amount <= Money(0):
                 self.statusBar().showMessage("❌ 金额必须大于0!", 5000)
                 return
         except ValueError:
@@ -4782,16 +5128,19 @@ class FinanceApp(QMainWindow):
         # 保存当前状态以便撤销
         self.save_state_before_change()
         
+        # 收据图片存入receipts表，交易只保存哈希引用
+        receipt_hash = put_receipt(self.conn, receipt_image_data) if receipt_image_data else None
+        
         # 根据类型处理
         if type_text == "借款":
             # 添加借款记录
             self.cursor.execute('''
                 INSERT INTO transactions 
                 (type, amount, category, description, date, status, account_id, tags, 
-                receipt_image, is_recurring, recurring_freq, recurring_end)
+                receipt_hash, is_recurring, recurring_freq, recurring_end)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', ('借款', amount, category, description, date, 'pending', account_id, tags,
-                receipt_image_data, is_recurring, recurring_freq, recurring_end))
+                receipt_hash, is_recurring, recurring_freq, recurring_end))
             self.conn.commit()
             
             self.statusBar().showMessage("✅ 借款记录已添加!", 5000)
@@ -4799,6 +5148,8 @@ class FinanceApp(QMainWindow):
         elif type_text == "还款":
             # 添加还款记录并关联借款
             if not loan_id:
+                self.conn.rollback()
+                self.finish_change()
                 self.statusBar().showMessage("❌ 没有可关联的借款!", 5000)
                 return
             
@@ -4818,10 +5169,10 @@ class FinanceApp(QMainWindow):
                         self.cursor.execute('''
                             INSERT INTO transactions 
                             (type, amount, category, description, date, related_id, account_id, tags, 
-                            receipt_image, is_recurring, recurring_freq, recurring_end)
+                            receipt_hash, is_recurring, recurring_freq, recurring_end)
                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                         ''', ('还款', remaining, category, description, date, loan_id, account_id, tags,
-                            receipt_image_data, 0, None, None))
+                            receipt_hash, 0, None, None))
                         
                         # 2. 添加收入记录（超额部分）
                         overpayment = amount - remaining
@@ -4837,37 +5188,25 @@ class FinanceApp(QMainWindow):
                         self.statusBar().showMessage(f"✅ 还款记录已添加，超额部分({overpayment:.2f}元)已记录为收入!", 5000)
                     except Exception as e:
                         self.conn.rollback()
+                        self.finish_change()
                         self.statusBar().showMessage(f"❌ 处理超额还款失败: {str(e)}", 5000)
                         return
                 else:
+                    self.conn.rollback()
+                    self.finish_change()
                     return
             else:
                 # 正常添加还款记录
                 self.cursor.execute('''
                     INSERT INTO transactions 
                     (type, amount, category, description, date, related_id, account_id, tags, 
-                    receipt_image, is_recurring, recurring_freq, recurring_end)
+                    receipt_hash, is_recurring, recurring_freq, recurring_end)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', ('还款', amount, category, description, date, loan_id, account_id, tags,
-                    receipt_image_data, 0, None, None))
-                
-                # 检查是否还清
-                self.cursor.execute('''
-                    SELECT SUM(amount) FROM transactions 
-                    WHERE type='还款' AND related_id=?
-                ''', (loan_id,))
-                total_repaid = self.cursor.fetchone()[0] or 0
-                
-                self.cursor.execute('''
-                    SELECT amount FROM transactions WHERE id=?
-                ''', (loan_id,))
-                loan_amount = self.cursor.fetchone()[0]
+                    receipt_hash, 0, None, None))
                 
-                if total_repaid >= loan_amount:
-                    # 标记借款为已结算
-                    self.cursor.execute('''
-                        UPDATE transactions SET status='settled' WHERE id=?
-                    ''', (loan_id,))
+                # 检查是否还清（借款状态已由触发器更新）
+                if self.ledger.remaining_loan_amount(loan_id) <= Money(0):
                     self.statusBar().showMessage("✅ 借款已全部还清!", 5000)
                 else:
                     self.statusBar().showMessage("✅ 还款记录已添加!", 5000)
@@ -4877,13 +5216,12 @@ class FinanceApp(QMainWindow):
         else:
             # 普通收入或支出
             db_type = 'income' if type_text == "收入" else 'expense'
-            self.cursor.execute('''
-                INSERT INTO transactions 
-                (type, amount, category, description, date, account_id, tags, 
-                receipt_image, is_recurring, recurring_freq, recurring_end)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (db_type, amount, category, description, date, account_id, tags,
-                receipt_image_data, is_recurring, recurring_freq, recurring_end))
+            self.ledger.insert_transactions([{
+                "type": db_type, "amount": amount, "category": category,
+                "description": description, "date": date, "account_id": account_id,
+                "tags": tags, "receipt_hash": receipt_hash, "is_recurring": is_recurring,
+                "recurring_freq": recurring_freq, "recurring_end": recurring_end,
+            }])
             self.conn.commit()
             
             self.statusBar().showMessage(f"✅ {type_text}记录已添加!", 5000)
@@ -4895,6 +5233,7 @@ class FinanceApp(QMainWindow):
         # 更新后续日期的余额记录
         if type_text in ["收入", "支出", "借款", "还款"]:
             self.update_future_balances(date)
+        self.finish_change()
         
         self.update_account_balances()
         self.load_data()
@@ -4909,47 +5248,79 @@ class FinanceApp(QMainWindow):
         else:
             self.setWindowTitle(f"{ProjectInfo.NAME} {ProjectInfo.VERSION}")
 
-    def backup_database(self, backup_type="auto"):
-        """执行数据库备份"""
-        timestamp = datetime.now().strftime('%Y%m%d')  # 只使用年月日部分
-        backup_name = f"{self.backup_dir}/finance_{self.current_user}_{backup_type}_{timestamp}.db"
+    def start_backup(self, backup_type="auto", progress=None):
+        """
+        在备份线程中开始一次数据库备份
+
+        普通数据库由工作线程用SQLite在线备份API分步复制，得到一致的副本，
+        复制期间界面和当前连接照常读写；加密数据库在界面线程取得内存快照
+        （内存数据库不能跨线程访问），加密和写文件在工作线程完成。
+
+        参数:
+            backup_type (str): auto、manual、before_restore等，写入文件名
+            progress (CopyProgress): 普通数据库的复制进度
+
+        返回值:
+            Future: 结果为备份文件路径
+        """
+        now = datetime.now()
+        # 分块存储中每份备份只占变化的部分，每次备份单独保留
+        backup_name = self.new_backup_path(backup_type, now)
+        # 备份头中的元数据，恢复对话框只读这部分
+        extra = {"user": self.current_user, "type": backup_type,
+                 "created_at": now.strftime('%Y-%m-%d %H:%M:%S')}
+        compression = self.backup_compression
+        
+        if self.db_encrypted:
+            # 对于加密数据库，快照和元数据在同一时刻取得
+            self.conn.commit()
+            metadata = collect_metadata(self.conn)
+            metadata.update(extra, snapshot_time=time.time())
+            snapshot = dump_database(self.conn)
+            kdf_params = KdfParams(*self.kdf_params)
+            key = bytes(self.container_key(kdf_params))
+            
+            def run():
+                written = backup_encrypted_snapshot(snapshot, backup_name, metadata, key, kdf_params,
+                                                    compression)
+                self.backup_catalog.add(backup_name, written)
+                return backup_name
+        else:
+            # 对于非加密数据库，工作线程自己打开连接在线复制
+            db_file = f'finance_{self.current_user}.db'
+            
+            def run():
+                # 在线复制得到的是复制开始之后某一时刻的状态，时间点恢复从这里开始回放
+                extra["snapshot_time"] = time.time()
+                written = backup_database_file(db_file, backup_name, extra, progress, compression)
+                self.backup_catalog.add(backup_name, written)
+                return backup_name
         
+        return self.backup_executor.submit(run)
+
+    def new_backup_path(self, backup_type, now):
+        """
+        新备份的文件路径（文件名包含到微秒的时间）
+
+        时钟精度较粗的系统上同一时刻可能有两份同类备份（如自动备份期间手动备份），
+        名称已分配过（前一份可能还在工作线程中写入）或文件已存在时加序号，不会覆盖。
+        """
+        base = (f"{self.backup_dir}/finance_{self.current_user}_{backup_type}_"
+                f"{now.strftime('%Y%m%d_%H%M%S_%f')}")
+        path = f"{base}.db"
+        seq = 1
+        while path in self.issued_backup_paths or os.path.exists(path):
+            path = f"{base}-{seq}.db"
+            seq += 1
+        self.issued_backup_paths.add(path)
+        return path
+
+    def backup_database(self, backup_type="auto"):
+        """执行数据库备份，等待完成（期间显示进度，界面保持响应）"""
         try:
-            if self.db_encrypted:
-                # 对于加密数据库，导出内存数据库
-                with open(backup_name, 'wb') as f:
-                    # 获取所有数据
-                    temp_conn = sqlite3.connect(':memory:')
-                    temp_cursor = temp_conn.cursor()
-                    
-                    # 获取所有数据
-                    temp_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table'")
-                    schema = "\n".join([row[0] for row in temp_cursor.fetchall()])
-                    
-                    # 获取所有数据
-                    data_dump = []
-                    temp_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                    tables = [row[0] for row in temp_cursor.fetchall()]
-                    
-                    for table in tables:
-                        temp_cursor.execute(f"SELECT * FROM {table}")
-                        data = temp_cursor.fetchall()
-                        columns = [desc[0] for desc in temp_cursor.description]
-                        
-                        for row in data:
-                            values = ", ".join([f"'{str(v)}'" if v is not None else "NULL" for v in row])
-                            data_dump.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({values});")
-                    
-                    temp_conn.close()
-                    
-                    # 合并模式和数据进行加密
-                    full_dump = schema + "\n" + "\n".join(data_dump)
-                    encrypted_data = self.cipher_suite.encrypt(full_dump.encode('utf-8'))
-                    f.write(encrypted_data)
-            else:
-                # 对于非加密数据库，直接复制文件
-                db_file = f'finance_{self.current_user}.db'
-                shutil.copy2(db_file, backup_name)
+            progress = CopyProgress()
+            future = self.start_backup(backup_type, progress)
+            backup_name = self.wait_with_progress(future, "正在备份数据库...", lambda: progress.fraction)
             
             # 清理旧备份
             self.cleanup_old_backups()
@@ -4959,26 +5330,164 @@ class FinanceApp(QMainWindow):
             self.statusBar().showMessage(f"❌ 备份失败: {str(e)}", 5000)
             return None
 
+    def load_backup(self, backup_file):
+        """把备份恢复为当前用户数据库（调用前当前连接须已关闭）"""
+        key_for = self.container_key if self.db_encrypted else None
+        with backup_payload(backup_file, key_for) as source:
+            if self.db_encrypted:
+                # 对于加密数据库，从备份文件加载到内存
+                self.conn = self.open_encrypted_snapshot(source, factory=JournaledConnection)
+                self.start_change_journal()
+            else:
+                # 对于非加密数据库，直接复制备份文件
+                self.db_manager.replace_database_file(source, f'finance_{self.current_user}.db')
+                self.conn = self.db_manager.connect(f'finance_{self.current_user}.db',
+                                                    factory=JournaledConnection)
+        
+        # 换成恢复的连接本身不算修改（内容已经在备份中），以新连接的变更计数为基准
+        self.backup_scheduler.reset(change_counter(self.conn))
+
     def cleanup_old_backups(self):
-        """清理超过限制的旧备份"""
-        # 获取所有备份文件
-        backups = []
-        for f in os.listdir(self.backup_dir):
-            if f.startswith(f"finance_{self.current_user}_"):
-                file_path = os.path.join(self.backup_dir, f)
-                if os.path.isfile(file_path):
-                    backups.append((file_path, os.path.getmtime(file_path)))
-        
-        # 按修改时间排序，最新的在前
-        backups.sort(key=lambda x: x[1], reverse=True)
-        
-        # 删除超过限制的旧备份
-        while len(backups) > self.max_backups:
-            old_file = backups.pop()
+        """按保留策略清理旧备份"""
+        # 保留策略只根据备份索引计算，不列目录
+        plan = self.retention_policy.plan(self.backup_catalog.list(self.current_user))
+        removed = False
+        for entry in plan.remove:
             try:
-                os.remove(old_file[0])
+                if os.path.exists(entry.path):
+                    os.remove(entry.path)
+                self.backup_catalog.remove(entry.path)
+                removed = True
             except Exception as e:
                 print(f"删除旧备份失败: {str(e)}")
+        
+        # 清理不再被引用的分块（与备份在同一线程中串行执行）
+        if removed:
+            self.backup_executor.submit(collect_garbage, self.backup_dir)
+            
+            # 最早的备份之前的恢复日志已经没有基准可用
+            if plan.keep and self.recovery_log is not None:
+                self.recovery_log.prune(min(entry.snapshot_time for entry, _ in plan.keep))
+
+    def load_retention_policy(self):
+        """
+        从主数据库读取备份保留策略
+        
+        settings表中key为'backup_retention'，value为RetentionPolicy.state()的JSON
+        """
+        self.master_cursor.execute("SELECT value FROM settings WHERE key='backup_retention'")
+        result = self.master_cursor.fetchone()
+        if result:
+            try:
+                return RetentionPolicy.from_state(json.loads(result[0]))
+            except (ValueError, TypeError) as e:
+                print(f"备份保留策略无效，使用默认值: {str(e)}")
+        return RetentionPolicy()
+
+    def save_retention_policy(self):
+        """保存备份保留策略"""
+        self.master_cursor.execute(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            ('backup_retention', json.dumps(self.retention_policy.state()))
+        )
+        self.master_conn.commit()
+
+    def point_in_time_bases(self):
+        """
+        可作为时间点恢复基准的备份（有恢复日志覆盖其之后的时间），最早的在前
+        
+        返回值:
+            list: [(基准时刻, BackupEntry)]
+        """
+        if self.recovery_log is None:
+            return []
+        bases = [
+            (entry.snapshot_time, entry) for entry in self.backup_catalog.list(self.current_user)
+            if not entry.legacy and self.recovery_log.timeline_start(entry.snapshot_time) is not None
+        ]
+        bases.sort(key=lambda item: item[0])
+        return bases
+
+    def restore_to_point_in_time(self, target_time, dialog):
+        """
+        把数据库恢复到target_time（时间戳）时的状态
+        
+        取该时刻所在时间线中不晚于它的最近一份备份作为基准，再回放恢复日志中
+        基准之后、target_time之前的提交。
+        """
+        timeline = self.recovery_log.timeline_start(target_time) if self.recovery_log else None
+        candidates = [
+            (snapshot_time, entry) for snapshot_time, entry in self.point_in_time_bases()
+            if timeline is not None and timeline <= snapshot_time <= target_time
+        ]
+        if not candidates:
+            self.statusBar().showMessage("❌ 该时间点没有可用的基准备份!", 5000)
+            return
+        base_time, base = candidates[-1]
+        
+        target_text = datetime.fromtimestamp(target_time).strftime('%Y-%m-%d %H:%M:%S')
+        reply = QMessageBox.question(
+            self, '确认恢复',
+            f'将数据库恢复到 {target_text} 的状态，确定要继续吗？',
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No
+        )
+        if reply != QMessageBox.Yes:
+            return
+        
+        # 先备份当前数据库
+        current_backup = self.backup_database("before_restore")
+        
+        recovery_log = self.recovery_log
+        try:
+            self.stop_recovery_log()
+            self.stop_change_journal()
+            self.db_manager.close(self.conn)
+            
+            start = time.perf_counter()
+            self.load_backup(base.path)
+            
+            # 日志里已经包含汇总表的最终值，回放时不能再由触发器重复累加；
+            # 显式开始事务，暂停触发器与回放的写入一起提交
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.conn.execute("BEGIN")
+            try:
+                with summary_triggers_suspended(self.conn):
+                    key_for = self.container_key if self.db_encrypted else None
+                    count = recovery_log.replay(self.conn, base_time, target_time, key_for)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            elapsed = time.perf_counter() - start
+            
+            # 恢复后的数据库开始新的时间线
+            self.start_recovery_log(rebase=True)
+            self.cursor = self.conn.cursor()
+            
+            self.load_data()
+            self.update_statistics()
+            self.update_account_balances()
+            
+            dialog.accept()
+            self.statusBar().showMessage(
+                f"✅ 已恢复到 {target_text}（基准备份 {base.created_at.strftime('%Y-%m-%d %H:%M:%S')}，"
+                f"回放 {count} 次提交，用时 {elapsed:.2f} 秒）", 5000)
+        except Exception as e:
+            self.statusBar().showMessage(f"❌ 时间点恢复失败: {str(e)}", 5000)
+            
+            if current_backup:
+                try:
+                    self.load_backup(current_backup)
+                    
+                    self.cursor = self.conn.cursor()
+                    self.statusBar().showMessage("✅ 已恢复原来的数据库", 5000)
+                except:
+                    self.statusBar().showMessage("❌ 恢复失败且无法恢复原数据库!", 5000)
+            
+            # 重新初始化数据库连接（数据库可能已被替换，日志开始新的时间线）
+            self.init_current_user_db(self.current_user)
+            self.start_recovery_log(rebase=True)
 
     def execute_restore(self, backup_table, dialog):
         """执行备份恢复"""
@@ -5009,20 +5518,14 @@ class FinanceApp(QMainWindow):
             try:
                 # 关闭当前数据库连接
                 if hasattr(self, 'conn'):
-                    self.conn.close()
+                    self.stop_recovery_log()
+                    self.stop_change_journal()
+                    self.db_manager.close(self.conn)
                 
-                if self.db_encrypted:
-                    # 对于加密数据库，从备份文件加载到内存
-                    with open(selected_backup, 'rb') as f:
-                        encrypted_data = f.read()
-                    decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                    
-                    self.conn = sqlite3.connect(':memory:')
-                    self.conn.executescript(decrypted_data.decode('utf-8'))
-                else:
-                    # 对于非加密数据库，直接复制备份文件
-                    shutil.copy2(selected_backup, f'finance_{self.current_user}.db')
-                    self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
+                start = time.perf_counter()
+                self.load_backup(selected_backup)
+                elapsed = time.perf_counter() - start
+                self.start_recovery_log(rebase=True)
                 
                 self.cursor = self.conn.cursor()
                 
@@ -5032,50 +5535,67 @@ class FinanceApp(QMainWindow):
                 self.update_account_balances()
                 
                 dialog.accept()
-                self.statusBar().showMessage("✅ 数据库已从备份恢复!", 5000)
+                self.statusBar().showMessage(f"✅ 数据库已从备份恢复!（解压和载入用时 {elapsed:.2f} 秒）", 5000)
             except Exception as e:
                 # 恢复失败，尝试恢复原来的数据库
                 self.statusBar().showMessage(f"❌ 恢复失败: {str(e)}", 5000)
                 
                 if current_backup:
                     try:
-                        if self.db_encrypted:
-                            with open(current_backup, 'rb') as f:
-                                encrypted_data = f.read()
-                            decrypted_data = self.cipher_suite.decrypt(encrypted_data)
-                            
-                            self.conn = sqlite3.connect(':memory:')
-                            self.conn.executescript(decrypted_data.decode('utf-8'))
-                        else:
-                            shutil.copy2(current_backup, f'finance_{self.current_user}.db')
-                            self.conn = sqlite3.connect(f'finance_{self.current_user}.db')
+                        self.load_backup(current_backup)
                         
                         self.cursor = self.conn.cursor()
                         self.statusBar().showMessage("✅ 已恢复原来的数据库", 5000)
                     except:
                         self.statusBar().showMessage("❌ 恢复失败且无法恢复原数据库!", 5000)
                         
-                # 重新初始化数据库连接
+                # 重新初始化数据库连接（数据库可能已被替换，日志开始新的时间线）
                 self.init_current_user_db(self.current_user)
+                self.start_recovery_log(rebase=True)
 
     def setup_auto_backup_settings(self):
         """设置自动备份参数"""
         dialog = QDialog(self)
         dialog.setWindowTitle("自动备份设置")
-        dialog.resize(400, 200)
+        dialog.resize(400, 400)
         
         layout = QFormLayout()
         
-        # 备份数量限制
-        backup_count_spin = QSpinBox()
-        backup_count_spin.setRange(1, 100)
-        backup_count_spin.setValue(self.max_backups)
-        layout.addRow("最大备份数量:", backup_count_spin)
+        # 保留策略：总是保留最新几份，另外每个时间段保留一份
+        retention_spins = {}
+        policy_state = self.retention_policy.state()
+        retention_spins["keep_last"] = QSpinBox()
+        layout.addRow("保留最新备份份数:", retention_spins["keep_last"])
+        for name, (label, _) in BUCKETS.items():
+            retention_spins[name] = QSpinBox()
+            layout.addRow(f"按{label}保留份数:", retention_spins[name])
+        for name, spin in retention_spins.items():
+            spin.setRange(0, 1000)
+            spin.setValue(policy_state[name])
+        retention_spins["keep_last"].setMinimum(1)  # 最新的备份总是保留
+        
+        def dialog_policy():
+            return RetentionPolicy(**{name: spin.value() for name, spin in retention_spins.items()})
+        
+        # 预览：按对话框中的策略计算会删除哪些备份，不实际删除
+        preview_button = QPushButton("预览清理结果")
+        preview_button.clicked.connect(lambda: QMessageBox.information(
+            dialog, "清理预览",
+            dialog_policy().plan(self.backup_catalog.list(self.current_user)).report()
+        ))
+        layout.addRow(preview_button)
+        
+        # 压缩方式（zstd需要安装zstandard库）
+        compression_combo = QComboBox()
+        compression_combo.addItems(available_compressions())
+        compression_combo.setCurrentText(self.backup_compression)
+        layout.addRow("压缩方式:", compression_combo)
         
-        # 备份间隔
+        # 备份间隔（显示当前计划的间隔）
         interval_combo = QComboBox()
         interval_combo.addItems(["每小时", "每天", "每周", "每月"])
-        interval_combo.setCurrentIndex(0)  # 默认每小时
+        current_hours = self.backup_scheduler.interval // 3600
+        interval_combo.setCurrentIndex({1: 0, 24: 1, 168: 2, 720: 3}.get(current_hours, 0))
         layout.addRow("备份间隔:", interval_combo)
         
         # 按钮
@@ -5087,7 +5607,9 @@ class FinanceApp(QMainWindow):
         dialog.setLayout(layout)
         
         if dialog.exec_() == QDialog.Accepted:
-            self.max_backups = backup_count_spin.value()
+            self.retention_policy = dialog_policy()
+            self.save_retention_policy()
+            self.backup_compression = compression_combo.currentText()
             
             # 设置备份间隔
             interval_mapping = {
@@ -5099,21 +5621,11 @@ class FinanceApp(QMainWindow):
             interval_hours = interval_mapping[interval_combo.currentText()]
             self.setup_auto_backup_timer(interval_hours)
             
-            self.statusBar().showMessage(f"✅ 自动备份设置已保存: 保留{self.max_backups}份备份，每{interval_combo.currentText()}备份一次", 5000)
+            self.statusBar().showMessage(f"✅ 自动备份设置已保存: 最多保留{self.retention_policy.max_kept()}份备份，每{interval_combo.currentText()}备份一次，压缩方式{self.backup_compression}", 5000)
 
     def get_remaining_loan_amount(self, loan_id):
         """计算指定借款的剩余未还金额"""
-        # 获取借款金额
-        self.cursor.execute("SELECT amount FROM transactions WHERE id=?", (loan_id,))
-        loan_amount = self.cursor.fetchone()[0]
-        
-        # 获取已还款总额
-        self.cursor.execute("SELECT SUM(amount) FROM transactions WHERE type='还款' AND related_id=?", (loan_id,))
-        repaid_amount = self.cursor.fetchone()[0] or 0
-        
-        # 计算剩余金额
-        remaining = loan_amount - repaid_amount
-        return max(0, remaining)  # 确保不为负数
+        return self.ledger.remaining_loan_amount(loan_id)
 
     def adjust_overpayment(self, repayment_id):
         """调整超额还款"""
@@ -5137,7 +5649,7 @@ class FinanceApp(QMainWindow):
         # 计算已还款总额（不包括当前还款记录）
         self.cursor.execute("""
             SELECT SUM(amount) FROM transactions 
-            WHERE type='还款' AND related_id=? AND id != ?
+            WHERE related_id=? AND type='还款' AND id != ?
         """, (loan_id, repayment_id))
         repaid_amount = self.cursor.fetchone()[0] or 0
         
@@ -5159,14 +5671,12 @@ class FinanceApp(QMainWindow):
             """, (adjusted_amount, repayment_id))
             
             # 2. 创建一条新的收入记录来处理超额部分
-            self.cursor.execute('''
-                INSERT INTO transactions 
-                (type, amount, category, description, date, account_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', ('income', overpayment, "退款", 
-                f"借款ID:{loan_id}还款超额退款", 
-                QDate.currentDate().toString("yyyy-MM-dd"),
-                self.get_account_id_for_loan(loan_id)))
+            self.ledger.insert_transactions([{
+                "type": 'income', "amount": overpayment, "category": "退款",
+                "description": f"借款ID:{loan_id}还款超额退款",
+                "date": QDate.currentDate().toString("yyyy-MM-dd"),
+                "account_id": self.get_account_id_for_loan(loan_id),
+            }])
             
             self.conn.commit()
             return True
@@ -5174,6 +5684,8 @@ class FinanceApp(QMainWindow):
             self.conn.rollback()
             self.statusBar().showMessage(f"❌ 调整超额还款失败: {str(e)}", 5000)
             return False
+        finally:
+            self.finish_change()
 
     def get_account_id_for_loan(self, loan_id):
         """获取借款记录关联的账户ID"""
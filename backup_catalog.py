@@ -0,0 +1,198 @@
+"""
+备份目录索引
+
+备份目录下的catalog.db记录每份备份的用户、类型、时间、大小、校验和、
+数据库版本和记录数。恢复对话框的列表、筛选和保留策略都直接查询索引，
+不再逐个列目录、解析文件名、打开备份文件。
+
+每次写入和删除备份时同步更新索引；reconcile()把索引与目录实际内容对齐，
+用于索引丢失或备份文件被手工增删的情况。
+"""
+import json
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+from backup_repository import BackupIntegrityError, read_backup_info
+
+CATALOG_NAME = "catalog.db"
+
+# finance_<用户>_<类型>_<年月日>[_<时分秒>[_<微秒>][-<序号>]].db；类型可能含下划线（before_restore），
+# 同一时刻的第二份备份带序号
+_BACKUP_NAME = re.compile(
+    r"^finance_(?P<user>.+?)_(?P<type>auto|manual|before_restore|[a-z]+)"
+    r"_(?P<date>\d{8})(?:_(?P<time>\d{6})(?:_(?P<usec>\d{6}))?(?:-(?P<seq>\d+))?)?\.db$"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    type TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    size INTEGER,
+    file_size INTEGER,
+    checksum TEXT,
+    db_version INTEGER,
+    row_counts TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backups_user_time ON backups(user, created_at);
+CREATE INDEX IF NOT EXISTS idx_backups_user_type_time ON backups(user, type, created_at);
+"""
+
+
+class BackupCatalog:
+    """
+    备份索引
+
+    每次操作打开一个短连接，可以同时在界面线程和备份线程中使用。
+
+    参数:
+        backup_dir (str): 备份目录
+    """
+
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, CATALOG_NAME)
+        with self._connect():
+            pass
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.executescript(_SCHEMA)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, path, metadata):
+        """
+        记录一份新写入的备份
+
+        参数:
+            path (str): 备份文件路径
+            metadata (dict): 写入备份头的元数据（至少包含user、type、created_at）
+        """
+        row = (
+            os.path.basename(path),
+            metadata["user"],
+            metadata["type"],
+            metadata["created_at"],
+            metadata.get("payload_size"),
+            os.path.getsize(path),
+            metadata.get("checksum"),
+            metadata.get("db_version"),
+            json.dumps(metadata.get("row_counts", {})),
+            json.dumps(metadata, ensure_ascii=False),
+        )
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    def remove(self, path):
+        """删除一条记录（备份文件已删除后调用）"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM backups WHERE name=?", (os.path.basename(path),))
+
+    def list(self, user, backup_type=None, date_from=None, date_to=None):
+        """
+        查询用户的备份，最新的在前
+
+        参数:
+            backup_type (str): 只返回该类型
+            date_from, date_to (str): 'YYYY-MM-DD'，包含两端
+
+        返回值:
+            list: BackupEntry
+        """
+        sql = "SELECT * FROM backups WHERE user=?"
+        params = [user]
+        if backup_type:
+            sql += " AND type=?"
+            params.append(backup_type)
+        if date_from:
+            sql += " AND created_at >= ?"
+            params.append(date_from)
+        if date_to:
+            # created_at为'YYYY-MM-DD HH:MM:SS'，当天的所有时刻都小于'YYYY-MM-DD~'
+            sql += " AND created_at < ?"
+            params.append(date_to + "~")
+        sql += " ORDER BY created_at DESC"
+        with self._connect() as conn:
+            return [BackupEntry(self.backup_dir, row) for row in conn.execute(sql, params)]
+
+    def reconcile(self):
+        """
+        使索引与备份目录一致：补录索引中没有的备份文件，删除文件已不存在的记录
+
+        返回值:
+            tuple: (补录数, 删除数)
+        """
+        on_disk = {
+            name for name in os.listdir(self.backup_dir)
+            if _BACKUP_NAME.match(name) and os.path.isfile(os.path.join(self.backup_dir, name))
+        }
+        with self._connect() as conn:
+            known = {row[0] for row in conn.execute("SELECT name FROM backups")}
+            stale = known - on_disk
+            conn.executemany("DELETE FROM backups WHERE name=?", [(name,) for name in stale])
+
+        added = 0
+        for name in on_disk - known:
+            metadata = _read_metadata(os.path.join(self.backup_dir, name))
+            if metadata is not None:
+                self.add(os.path.join(self.backup_dir, name), metadata)
+                added += 1
+        return added, len(stale)
+
+
+class BackupEntry:
+    """索引中的一份备份"""
+
+    __slots__ = ("path", "user", "type", "created_at", "size", "file_size",
+                 "checksum", "db_version", "row_counts", "metadata")
+
+    def __init__(self, backup_dir, row):
+        name, self.user, self.type, created_at, self.size, self.file_size, \
+            self.checksum, self.db_version, row_counts, metadata = row
+        self.path = os.path.join(backup_dir, name)
+        self.created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+        self.row_counts = json.loads(row_counts or "{}")
+        self.metadata = json.loads(metadata or "{}")
+
+    @property
+    def legacy(self):
+        """旧版备份（没有文件头，元数据只来自文件名和文件属性）"""
+        return bool(self.metadata.get("legacy"))
+
+    @property
+    def snapshot_time(self):
+        """备份内容对应的时刻（时间戳），早期备份没有记录时取创建时间"""
+        return self.metadata.get("snapshot_time") or self.created_at.timestamp()
+
+
+def _read_metadata(path):
+    # 补录时读取文件头；旧版备份从文件名和修改时间推断
+    match = _BACKUP_NAME.match(os.path.basename(path))
+    try:
+        info = read_backup_info(path)
+    except (BackupIntegrityError, OSError, ValueError) as e:
+        print(f"读取备份信息失败: {path}: {str(e)}")
+        info = None
+    if info is not None and "user" in info.metadata:
+        return info.metadata
+    if match is None:
+        return None
+
+    created = datetime.fromtimestamp(os.path.getmtime(path))
+    return {
+        "user": match.group("user"),
+        "type": match.group("type"),
+        "created_at": created.strftime('%Y-%m-%d %H:%M:%S'),
+        "payload_size": os.path.getsize(path),
+        "legacy": info is None,
+    }
@@ -0,0 +1,493 @@
+"""
+数据库备份文件
+
+每个备份文件以带校验的元数据头开始，之后是数据库内容（普通SQLite文件，
+或加密用户的分块加密容器）。恢复对话框只读文件头就能列出版本、记录数、
+日期范围等信息，不需要打开或解密整个备份。
+
+文件布局（整数均为大端）:
+    magic "FABAK" | 版本(1) | 标志(1) | 元数据长度(4) | 元数据JSON | 校验字段 | 数据
+校验字段：加密备份为 nonce(12) + AES-GCM标签(16)，元数据作为附加认证数据，
+只有持有密钥的一方能生成；普通备份没有密钥，为元数据的SHA-256（只防损坏）。
+数据部分的SHA-256记录在元数据的checksum中，恢复时边复制边校验。
+
+分块备份（标志FLAG_CHUNKED）的数据部分只是分块ID清单（JSON），数据库内容
+保存在备份目录下的去重分块存储（chunks/）中；此时checksum是重组后内容的SHA-256，
+清单本身的SHA-256记录在manifest_checksum中。加密的分块备份不公开明文内容的
+SHA-256（否则任何人都能用它验证对数据库内容的猜测），checksum改为备份密钥派生
+子密钥下的HMAC，checksum_type记为hmac-sha256，只有持有密钥才能校验。
+"""
+import hashlib
+import hmac
+import io
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from chunk_store import ChunkStore, DEFAULT_COMPRESSION
+from secure_storage import ContainerHeader, encrypt_stream
+
+BACKUP_MAGIC = b"FABAK"
+BACKUP_FORMAT_VERSION = 1
+FLAG_ENCRYPTED = 1
+FLAG_CHUNKED = 2
+
+# 分块存储在备份目录下的子目录名
+CHUNK_DIR = "chunks"
+
+_PREFIX = struct.Struct(">5sBBI")  # magic, 版本, 标志, 元数据长度
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+_DIGEST_SIZE = 32
+_COPY_BUFFER = 1024 * 1024
+
+# 加密分块备份checksum的类型（没有此字段的为明文内容的SHA-256）
+CHECKSUM_HMAC = "hmac-sha256"
+
+# 在线备份每步复制的页数（每步之间释放读锁，其它连接可以继续写入）
+BACKUP_PAGES_PER_STEP = 1024
+
+# 元数据中统计行数的表
+COUNTED_TABLES = ("transactions", "accounts", "categories", "budgets", "receipts")
+
+
+class BackupIntegrityError(ValueError):
+    """备份元数据或数据校验失败"""
+
+
+# salt和iterations与容器文件头同名，可以直接交给取密钥的函数
+KdfParams = namedtuple("KdfParams", "salt iterations")
+
+
+class BackupInfo(namedtuple("BackupInfo", "path metadata encrypted verified payload_offset chunked")):
+    """
+    备份文件头信息
+
+    verified为False表示加密备份的元数据未做认证（没有提供密钥）；
+    chunked为True表示数据部分是分块清单。
+    """
+
+    @property
+    def kdf_params(self):
+        return KdfParams(bytes.fromhex(self.metadata["kdf_salt"]), self.metadata["kdf_iterations"])
+
+
+def collect_metadata(conn):
+    """
+    统计写入备份头的数据库信息
+
+    返回值:
+        dict: db_version、row_counts、date_range、account_count等
+    """
+    cursor = conn.cursor()
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+    row_counts = {}
+    for table in COUNTED_TABLES:
+        if table in tables:
+            row_counts[table] = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    db_version = None
+    if "db_version" in tables:
+        result = cursor.execute("SELECT MAX(version) FROM db_version").fetchone()
+        db_version = result[0] if result else None
+
+    date_range = [None, None]
+    if "transactions" in tables:
+        date_range = list(cursor.execute(
+            "SELECT MIN(date), MAX(date) FROM transactions WHERE type != 'balance'"
+        ).fetchone())
+
+    return {
+        "db_version": db_version,
+        "row_counts": row_counts,
+        "date_range": date_range,
+        "account_count": row_counts.get("accounts", 0),
+    }
+
+
+def file_checksum(path):
+    """文件内容的SHA-256和大小"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_COPY_BUFFER), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def write_backup(path, payload_path, metadata, key=None):
+    """
+    写入备份文件：元数据头 + payload_path的内容
+
+    参数:
+        path (str): 备份文件路径
+        payload_path (str): 数据库内容（SQLite文件或加密容器）
+        metadata (dict): collect_metadata()的结果加上user、type、created_at等；
+            加密备份还需包含kdf_salt(hex)和kdf_iterations，用于之后取密钥校验
+        key (bytes): 加密备份的密钥，为None表示普通备份
+
+    返回值:
+        dict: 实际写入的元数据（补充了checksum、payload_size）
+    """
+    metadata = dict(metadata)
+    metadata["checksum"], metadata["payload_size"] = file_checksum(payload_path)
+    with open(payload_path, "rb") as src:
+        return _write_backup_file(path, metadata, key, 0, src)
+
+
+def write_chunked_backup(path, src, metadata, key=None, compression=DEFAULT_COMPRESSION):
+    """
+    写入分块备份：内容逐块压缩后存入分块存储，备份文件只保存清单
+
+    参数:
+        path (str): 备份文件路径，分块存储在同目录的chunks/下
+        src: 数据库内容的文件对象（SQLite文件或快照字节流，不是加密容器）
+        metadata (dict): 同write_backup
+        key (bytes): 加密备份的密钥，同时用于加密分块
+        compression (str): 新分块的压缩方式
+
+    返回值:
+        dict: 实际写入的元数据（补充了chunk_count、new_bytes、stored_bytes、
+            compression、compress_seconds、store_seconds等）
+    """
+    start = time.perf_counter()
+    store = chunk_store_for(path, key, compression)
+    result = store.put_stream(src)
+    manifest = json.dumps(result.chunk_ids).encode("utf-8")
+
+    metadata = dict(metadata)
+    if key is not None:
+        metadata["checksum_type"] = CHECKSUM_HMAC
+    metadata.update(
+        checksum=result.checksum if key is None else _checksum_mac(key, result.checksum),
+        payload_size=result.size,
+        chunk_count=len(result.chunk_ids),
+        new_bytes=result.new_bytes,
+        stored_bytes=result.stored_bytes,
+        compression=compression,
+        compress_seconds=round(result.compress_seconds, 3),
+        store_seconds=round(time.perf_counter() - start, 3),
+        manifest_checksum=hashlib.sha256(manifest).hexdigest(),
+    )
+    return _write_backup_file(path, metadata, key, FLAG_CHUNKED, io.BytesIO(manifest))
+
+
+def _write_backup_file(path, metadata, key, flags, payload):
+    # 文件头 + payload文件对象的内容，原子替换
+    metadata["encrypted"] = key is not None
+    meta_bytes = json.dumps(metadata, ensure_ascii=False, sort_keys=True).encode("utf-8")
+
+    if key is not None:
+        flags |= FLAG_ENCRYPTED
+    prefix = _PREFIX.pack(BACKUP_MAGIC, BACKUP_FORMAT_VERSION, flags, len(meta_bytes))
+    if key is not None:
+        nonce = os.urandom(_NONCE_SIZE)
+        auth = nonce + AESGCM(key).encrypt(nonce, b"", prefix + meta_bytes)
+    else:
+        auth = hashlib.sha256(prefix + meta_bytes).digest()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as dst:
+        dst.write(prefix + meta_bytes + auth)
+        shutil.copyfileobj(payload, dst, _COPY_BUFFER)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, path)
+    return metadata
+
+
+def _checksum_mac(key, checksum):
+    # 内容SHA-256在备份密钥派生子密钥下的HMAC
+    mac_key = hmac.new(key, b"backup-checksum", hashlib.sha256).digest()
+    return hmac.new(mac_key, bytes.fromhex(checksum), hashlib.sha256).hexdigest()
+
+
+def chunk_store_for(backup_path, key=None, compression=DEFAULT_COMPRESSION):
+    """备份文件所在目录的分块存储"""
+    return ChunkStore(os.path.join(os.path.dirname(backup_path) or ".", CHUNK_DIR), key, compression)
+
+
+def compression_ratio(metadata):
+    """备份内容大小与其分块在磁盘上所占大小之比；不是分块备份时为None"""
+    if not metadata.get("stored_bytes"):
+        return None
+    return metadata["payload_size"] / metadata["stored_bytes"]
+
+
+def is_backup_file(path):
+    """是否为带元数据头的备份（否则为旧版备份：裸SQLite文件或加密文件）"""
+    with open(path, "rb") as f:
+        return f.read(len(BACKUP_MAGIC)) == BACKUP_MAGIC
+
+
+def read_backup_info(path, key_for=None):
+    """
+    只读取备份文件头
+
+    参数:
+        path (str): 备份文件
+        key_for: 可调用对象，参数为KdfParams，返回密钥；提供时校验加密备份的元数据
+
+    返回值:
+        BackupInfo: 旧版备份（没有文件头）返回None
+
+    异常:
+        BackupIntegrityError: 元数据校验失败
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size or prefix[:len(BACKUP_MAGIC)] != BACKUP_MAGIC:
+            return None
+        _, version, flags, meta_len = _PREFIX.unpack(prefix)
+        if version != BACKUP_FORMAT_VERSION:
+            raise BackupIntegrityError(f"不支持的备份格式版本: {version}")
+
+        meta_bytes = f.read(meta_len)
+        encrypted = bool(flags & FLAG_ENCRYPTED)
+        auth = f.read(_NONCE_SIZE + _TAG_SIZE if encrypted else _DIGEST_SIZE)
+        if len(meta_bytes) < meta_len or len(auth) < (_NONCE_SIZE + _TAG_SIZE if encrypted else _DIGEST_SIZE):
+            raise BackupIntegrityError("备份文件头不完整")
+        payload_offset = f.tell()
+
+    verified = False
+    if not encrypted:
+        if hashlib.sha256(prefix + meta_bytes).digest() != auth:
+            raise BackupIntegrityError("备份元数据已损坏")
+        verified = True
+
+    try:
+        metadata = json.loads(meta_bytes.decode("utf-8"))
+    except ValueError:
+        raise BackupIntegrityError("备份元数据无法解析")
+
+    info = BackupInfo(path, metadata, encrypted, verified, payload_offset, bool(flags & FLAG_CHUNKED))
+    if encrypted and key_for is not None:
+        nonce, tag = auth[:_NONCE_SIZE], auth[_NONCE_SIZE:]
+        try:
+            AESGCM(key_for(info.kdf_params)).decrypt(nonce, tag, prefix + meta_bytes)
+        except InvalidTag:
+            raise BackupIntegrityError("备份元数据认证失败（密码不符或文件被修改）")
+        info = info._replace(verified=True)
+    return info
+
+
+def read_manifest(info):
+    """
+    读取分块备份的分块ID清单
+
+    异常:
+        BackupIntegrityError: 清单校验失败
+    """
+    with open(info.path, "rb") as f:
+        f.seek(info.payload_offset)
+        manifest = f.read()
+    if hashlib.sha256(manifest).hexdigest() != info.metadata.get("manifest_checksum"):
+        raise BackupIntegrityError("备份清单校验失败")
+    return json.loads(manifest.decode("utf-8"))
+
+
+def iter_backup_content(info, key=None):
+    """
+    逐块读出备份中的数据库内容（分块备份从分块存储重组），最后校验SHA-256
+
+    加密分块备份的checksum是HMAC，需要提供key才能校验。
+
+    异常:
+        BackupIntegrityError: 内容校验失败
+        ChunkMissingError: 分块缺失或损坏
+    """
+    digest = hashlib.sha256()
+    if info.chunked:
+        blocks = chunk_store_for(info.path, key).iter_content(read_manifest(info))
+    else:
+        blocks = _iter_file_blocks(info.path, info.payload_offset)
+    for block in blocks:
+        digest.update(block)
+        yield block
+    checksum = digest.hexdigest()
+    if info.metadata.get("checksum_type") == CHECKSUM_HMAC:
+        if key is None:
+            raise BackupIntegrityError("加密备份需要密钥才能校验")
+        checksum = _checksum_mac(key, checksum)
+    if not hmac.compare_digest(checksum, info.metadata.get("checksum") or ""):
+        raise BackupIntegrityError("备份数据校验失败")
+
+
+def _iter_file_blocks(path, offset):
+    with open(path, "rb") as src:
+        src.seek(offset)
+        yield from iter(lambda: src.read(_COPY_BUFFER), b"")
+
+
+def extract_payload(info, target_path, key=None):
+    """把备份的数据部分写入target_path，同时校验SHA-256"""
+    try:
+        with open(target_path, "wb") as dst:
+            for block in iter_backup_content(info, key):
+                dst.write(block)
+    except Exception:
+        os.remove(target_path)
+        raise
+
+
+@contextmanager
+def backup_payload(path, key_for=None):
+    """
+    取得备份中数据库内容所在的文件路径
+
+    新格式备份把数据部分解出到临时文件，退出时删除；旧版备份直接返回原路径。
+    加密的分块备份边从分块存储重组边重新加密写成容器，明文不落盘，内存中也只有
+    正在加密的几个块，因此调用方拿到的总是与整文件加密备份相同的格式。
+    """
+    info = read_backup_info(path, key_for)
+    if info is None:
+        yield path
+        return
+
+    target_path = path + ".restore"
+    try:
+        if info.chunked and info.encrypted:
+            if key_for is None:
+                raise BackupIntegrityError("加密备份需要密钥才能恢复")
+            key = key_for(info.kdf_params)
+            salt, iterations = info.kdf_params
+            with open(target_path, "wb") as dst:
+                encrypt_stream(_BlockReader(iter_backup_content(info, key)), dst, key,
+                               ContainerHeader.new(salt=salt, iterations=iterations))
+        else:
+            extract_payload(info, target_path)
+        yield target_path
+    finally:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+
+class _BlockReader:
+    """把产出字节块的迭代器包装成只读文件对象，read(size)除非到了末尾总是读满size字节"""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._buffer = bytearray()
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer += block
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class CopyProgress:
+    """sqlite3备份API的进度回调，fraction可以在其它线程读取"""
+
+    def __init__(self):
+        self.remaining = 0
+        self.total = 0
+
+    def __call__(self, status, remaining, total):
+        self.remaining = remaining
+        self.total = total
+
+    @property
+    def fraction(self):
+        if not self.total:
+            return None
+        return (self.total - self.remaining) / self.total
+
+
+def copy_database(source_path, target_path, progress=None, pages=BACKUP_PAGES_PER_STEP):
+    """
+    用SQLite在线备份API复制数据库文件
+
+    与直接复制文件不同，得到的是某个事务提交点上的一致副本（包括WAL中已提交的内容），
+    复制期间其它连接可以照常读写。连接在本函数内打开，可以在工作线程中调用。
+    """
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def backup_database_file(db_path, backup_path, extra_metadata, progress=None,
+                         compression=DEFAULT_COMPRESSION):
+    """
+    普通数据库的备份：在线复制 → 从副本统计元数据 → 存入分块存储并写清单
+
+    在工作线程中执行；元数据取自副本本身，与备份内容一致。
+
+    返回值:
+        dict: 写入的元数据
+    """
+    payload_path = backup_path + ".payload"
+    try:
+        copy_database(db_path, payload_path, progress)
+        conn = sqlite3.connect(payload_path)
+        try:
+            metadata = collect_metadata(conn)
+        finally:
+            conn.close()
+        metadata.update(extra_metadata)
+        with open(payload_path, "rb") as src:
+            return write_chunked_backup(backup_path, src, metadata, compression=compression)
+    finally:
+        if os.path.exists(payload_path):
+            os.remove(payload_path)
+
+
+def backup_encrypted_snapshot(snapshot, backup_path, metadata, key, kdf_params,
+                              compression=DEFAULT_COMPRESSION):
+    """
+    加密用户的备份：把已序列化的快照加密存入分块存储并写清单
+
+    参数:
+        snapshot (bytes): dump_database()的结果（在界面线程取得，保证一致）
+        metadata (dict): 在取快照的同时统计的元数据
+        key (bytes): kdf_params对应的密钥
+        kdf_params (KdfParams): 写入元数据，恢复时据此取密钥
+        compression (str): 新分块的压缩方式（先压缩再加密）
+    """
+    metadata = dict(metadata, kdf_salt=kdf_params.salt.hex(), kdf_iterations=kdf_params.iterations)
+    return write_chunked_backup(backup_path, io.BytesIO(snapshot), metadata, key, compression)
+
+
+def collect_garbage(backup_dir):
+    """
+    删除备份目录中不再被任何清单引用的分块
+
+    必须与写备份在同一线程中串行执行：备份写入分块之后、清单落盘之前，
+    这些分块还没有被引用。任何清单无法读取时不做清理。
+
+    返回值:
+        tuple: (删除的分块数, 释放的字节数)；放弃清理时为None
+    """
+    referenced = set()
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if not os.path.isfile(path) or name.endswith(".tmp"):
+            continue
+        try:
+            info = read_backup_info(path)
+            if info is not None and info.chunked:
+                referenced.update(read_manifest(info))
+        except (BackupIntegrityError, OSError, ValueError) as e:
+            print(f"读取备份清单失败，跳过分块清理: {name}: {str(e)}")
+            return None
+    return ChunkStore(os.path.join(backup_dir, CHUNK_DIR)).collect_garbage(referenced)
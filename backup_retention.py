@@ -0,0 +1,130 @@
+"""
+备份保留策略（祖父-父-子轮换）
+
+按时间粒度分桶保留备份：最近N个小时、N天、N周、N月、N年里，每个时间段保留该段内
+最新的一份；另外总是保留最新的keep_last份。每种粒度各自从最新的备份往前数，
+同一份备份可以同时满足多个粒度。这样近期备份密集、远期备份稀疏，备份数量有上限，
+又能恢复到数年前。
+
+策略只根据备份索引中的条目（时间、类型、大小）计算，不访问备份目录；
+plan()的结果可以先作为预览报告显示，再交给调用方删除。
+"""
+from collections import OrderedDict
+
+# 粒度: 名称 -> (显示名, 由时间计算所属时间段的函数)
+BUCKETS = OrderedDict([
+    ("hourly", ("小时", lambda t: (t.year, t.month, t.day, t.hour))),
+    ("daily", ("天", lambda t: (t.year, t.month, t.day))),
+    ("weekly", ("周", lambda t: tuple(t.isocalendar())[:2])),
+    ("monthly", ("月", lambda t: (t.year, t.month))),
+    ("yearly", ("年", lambda t: t.year)),
+])
+
+
+class RetentionPolicy:
+    """
+    各粒度保留的时间段数
+
+    参数:
+        keep_last (int): 无论时间，总是保留最新的几份
+        hourly, daily, weekly, monthly, yearly (int): 各粒度保留的时间段数，0表示不按该粒度保留
+    """
+
+    DEFAULTS = {"keep_last": 10, "hourly": 24, "daily": 30, "weekly": 26, "monthly": 24, "yearly": 10}
+
+    def __init__(self, keep_last=10, hourly=24, daily=30, weekly=26, monthly=24, yearly=10):
+        self.keep_last = keep_last
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+
+    @classmethod
+    def from_state(cls, state):
+        """由state()保存的字典恢复，缺少的项使用默认值"""
+        return cls(**{name: int(state.get(name, default)) for name, default in cls.DEFAULTS.items()})
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+    def max_kept(self):
+        """最多保留的备份份数（各项之和，实际通常更少）"""
+        return sum(self.state().values())
+
+    def plan(self, entries):
+        """
+        计算保留和删除哪些备份
+
+        参数:
+            entries (list): 有created_at（datetime）属性的备份条目，如BackupCatalog.list()的结果
+
+        返回值:
+            RetentionPlan
+        """
+        entries = sorted(entries, key=lambda entry: entry.created_at, reverse=True)
+        reasons = {id(entry): [] for entry in entries}
+
+        for entry in entries[:self.keep_last]:
+            reasons[id(entry)].append("最新")
+
+        for name, (label, period_of) in BUCKETS.items():
+            limit = getattr(self, name)
+            seen = set()
+            for entry in entries:
+                if len(seen) >= limit:
+                    break
+                period = period_of(entry.created_at)
+                if period in seen:
+                    continue
+                # 从新到旧遍历，时间段内第一次遇到的就是该段最新的备份
+                seen.add(period)
+                reasons[id(entry)].append(label)
+
+        keep = [(entry, reasons[id(entry)]) for entry in entries if reasons[id(entry)]]
+        remove = [entry for entry in entries if not reasons[id(entry)]]
+        return RetentionPlan(keep, remove)
+
+
+class RetentionPlan:
+    """
+    一次保留策略计算的结果
+
+    keep为[(条目, 保留原因列表)]，remove为要删除的条目，都是最新的在前。
+    """
+
+    def __init__(self, keep, remove):
+        self.keep = keep
+        self.remove = remove
+
+    def report(self, limit=20):
+        """
+        预览报告（不删除任何文件）
+
+        参数:
+            limit (int): 最多列出的待删除备份数
+
+        返回值:
+            str: 多行文本
+        """
+        lines = [f"共 {len(self.keep) + len(self.remove)} 份备份，保留 {len(self.keep)} 份，"
+                 f"删除 {len(self.remove)} 份"]
+        counts = OrderedDict((label, 0) for label in ["最新"] + [label for label, _ in BUCKETS.values()])
+        for _, reasons in self.keep:
+            for reason in reasons:
+                counts[reason] += 1
+        lines.append("保留原因: " + "，".join(f"{label} {count}" for label, count in counts.items()))
+        if self.keep:
+            lines.append(f"最早保留的备份: {self.keep[-1][0].created_at.strftime('%Y-%m-%d %H:%M:%S')}")
+
+        # 分块存储中的备份共用分块，清单文件的大小才是删除后一定释放的空间
+        freed = sum(getattr(entry, "file_size", 0) or 0 for entry in self.remove)
+        if self.remove:
+            lines.append(f"释放清单文件 {freed / 1024:.1f} KB（不再被引用的分块随后清理）")
+            lines.append("")
+            lines.append("将删除:")
+            for entry in self.remove[:limit]:
+                lines.append(f"  {entry.created_at.strftime('%Y-%m-%d %H:%M:%S')}  {getattr(entry, 'type', '')}")
+            if len(self.remove) > limit:
+                lines.append(f"  ……另外 {len(self.remove) - limit} 份")
+        return "\n".join(lines)
@@ -0,0 +1,131 @@
+"""
+自动备份调度
+
+定时器只负责定期询问调度器是否该备份，判断本身不读写文件：
+- 数据库的变更计数（PRAGMA data_version和连接自己的写入计数）自上次备份以来没有变化时
+  不备份，空闲的会话不产生任何备份I/O
+- 到期后等编辑停顿quiet_period秒再备份，连续的一批修改只产生一份备份；
+  一直在编辑时最多推迟max_delay秒
+- 上次备份时间、备份间隔和是否有未备份的修改由调用方持久化（state()/from_state()），
+  重启后按原来的计划继续，而不是重新计时
+"""
+import time
+
+# 默认备份间隔（秒）
+DEFAULT_INTERVAL = 3600
+
+# 到期后等待编辑停顿的时间（秒）
+DEFAULT_QUIET_PERIOD = 120
+
+# 到期后一直在编辑时最多推迟的时间（秒）
+DEFAULT_MAX_DELAY = 900
+
+# 备份失败后重试的间隔（秒）
+RETRY_DELAY = 300
+
+
+def change_counter(conn):
+    """
+    数据库的变更计数，值不变说明数据库没有被修改
+
+    PRAGMA data_version只反映其他连接的提交，本连接的写入由total_changes反映；
+    两者都只查询内存中的计数，不读数据库文件。
+    """
+    return conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes
+
+
+class BackupScheduler:
+    """
+    决定何时做自动备份
+
+    参数:
+        interval (float): 两次备份的最小间隔（秒）
+        last_run (float): 上次备份的时间戳，None表示从未备份
+        pending (bool): 是否有尚未备份的修改（上次会话退出时记录）
+        quiet_period, max_delay (float): 见模块说明
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, last_run=None, pending=False,
+                 quiet_period=DEFAULT_QUIET_PERIOD, max_delay=DEFAULT_MAX_DELAY):
+        self.interval = interval
+        self.last_run = last_run
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.retry_at = None
+        self._generation = None
+        # 上次会话留下的修改发生在上次备份之后、本次启动之前
+        self._dirty_since = (last_run or 0) if pending else None
+        self._last_change = self._dirty_since
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        """由state()保存的字典恢复"""
+        return cls(interval=state.get("interval", DEFAULT_INTERVAL),
+                   last_run=state.get("last_run"),
+                   pending=state.get("pending", False), **kwargs)
+
+    def state(self):
+        """需要持久化的状态（JSON可序列化）"""
+        return {"interval": self.interval, "last_run": self.last_run, "pending": self.pending}
+
+    @property
+    def pending(self):
+        """是否有尚未备份的修改"""
+        return self._dirty_since is not None
+
+    @property
+    def next_run(self):
+        """最早可以开始下一次备份的时间戳"""
+        next_run = (self.last_run or 0) + self.interval
+        if self.retry_at is not None:
+            next_run = max(next_run, self.retry_at)
+        return next_run
+
+    def observe(self, generation, now=None):
+        """
+        记录当前的变更计数
+
+        第一次调用只作为基准（打开数据库时的状态已由上次备份或pending覆盖）。
+        """
+        now = time.time() if now is None else now
+        if self._generation is None:
+            self._generation = generation
+            return
+        if generation != self._generation:
+            self._generation = generation
+            if self._dirty_since is None:
+                self._dirty_since = now
+            self._last_change = now
+
+    def due(self, generation, now=None):
+        """
+        是否应该开始一次自动备份
+
+        没有修改时总是False，也不改变任何状态。
+        """
+        now = time.time() if now is None else now
+        self.observe(generation, now)
+        if self._dirty_since is None or now < self.next_run:
+            return False
+        if now - self._last_change >= self.quiet_period:
+            return True
+        return now - max(self._dirty_since, self.next_run) >= self.max_delay
+
+    def started(self, now=None):
+        """一次备份已开始（它包含到此刻为止的所有修改）"""
+        self.last_run = time.time() if now is None else now
+        self.retry_at = None
+        self._dirty_since = None
+        self._last_change = None
+
+    def failed(self, now=None):
+        """备份失败：修改仍待备份，稍后重试"""
+        now = time.time() if now is None else now
+        if self._dirty_since is None:
+            self._dirty_since = now
+            self._last_change = now
+        self.retry_at = now + RETRY_DELAY
+
+    def reset(self, generation):
+        """连接被替换（恢复备份等）后以新连接的计数为基准，替换本身不算修改"""
+        self._generation = generation
@@ -0,0 +1,486 @@
+"""
+加密内存会话的追加式变更日志
+
+加密用户的数据库在内存中运行。每次提交时把本次事务改动的行（按表和rowid）加密后
+追加到日志文件，意外退出后用 快照 + 日志 恢复；再次登录时接着原来的日志追加，
+日志超过阈值时才在后台把当前数据库写成新快照，并切换到新的日志文件。
+
+日志文件布局（整数均为大端）:
+    magic "FAJNL" | 版本(1) | 基准快照ID(8) | 迭代次数(4) | salt长度(1) | salt | nonce前缀(8)
+    之后是若干记录：密文长度(4) | AES-GCM密文
+基准快照ID即快照容器文件头中的nonce前缀，日志只会回放到与之匹配的快照上。
+第i条记录的nonce为 nonce前缀 + i(4字节)，附加认证数据为 文件头 + i。同一个密钥加密
+很多个日志文件，每个文件的nonce前缀随机生成且有8字节，不同文件的nonce实际上不会重复。
+salt为空的日志不加密（普通用户的时间点恢复日志），记录为：长度(4) | 明文 | CRC32(4)。
+
+记录明文为UTF-8编码的JSON（BLOB值编码为{"$blob": base64}），与Python版本无关；
+记录格式改变时递增文件头中的版本号，旧版本的日志不会被误读。
+"""
+import base64
+import json
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from secure_storage import dump_database, is_container_file, read_header, write_container
+
+JOURNAL_MAGIC = b"FAJNL"
+JOURNAL_VERSION = 3
+
+# 每个日志文件随机生成的nonce前缀长度，与4字节记录序号组成12字节的AES-GCM nonce
+NONCE_PREFIX_SIZE = 8
+
+_HEADER_FIXED = struct.Struct(">5sB8sIB")  # magic, 版本, 基准快照ID, 迭代次数, salt长度
+_RECORD_LENGTH = struct.Struct(">I")
+_SEQ = struct.Struct(">I")
+_CRC = struct.Struct(">I")
+
+
+def encode_record(value):
+    """把记录内容（列表、数字、字符串、None和bytes的组合）编码为日志记录明文"""
+    return json.dumps(value, default=_encode_blob, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def decode_record(payload):
+    """encode_record的逆操作（元组解码为列表）"""
+    return json.loads(payload.decode("utf-8"), object_hook=_decode_blob)
+
+
+def _encode_blob(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$blob": base64.b64encode(bytes(value)).decode("ascii")}
+    raise TypeError(f"无法写入日志的值类型: {type(value).__name__}")
+
+
+def _decode_blob(obj):
+    if "$blob" in obj:
+        return base64.b64decode(obj["$blob"])
+    return obj
+
+
+class JournalHeader:
+    """日志文件头（salt和iterations与容器文件头同名，可直接用来取密钥）"""
+
+    def __init__(self, base_id, salt, iterations, nonce_prefix):
+        self.base_id = base_id
+        self.salt = salt
+        self.iterations = iterations
+        self.nonce_prefix = nonce_prefix
+
+    def to_bytes(self):
+        return (_HEADER_FIXED.pack(JOURNAL_MAGIC, JOURNAL_VERSION, self.base_id,
+                                   self.iterations, len(self.salt))
+                + self.salt + self.nonce_prefix)
+
+    @classmethod
+    def read(cls, f):
+        """读取文件头，不是日志文件或文件头不完整时返回None"""
+        fixed = f.read(_HEADER_FIXED.size)
+        if len(fixed) < _HEADER_FIXED.size:
+            return None
+        magic, version, base_id, iterations, salt_len = _HEADER_FIXED.unpack(fixed)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            return None
+        salt = f.read(salt_len)
+        nonce_prefix = f.read(NONCE_PREFIX_SIZE)
+        if len(salt) < salt_len or len(nonce_prefix) < NONCE_PREFIX_SIZE:
+            return None
+        return cls(base_id, salt, iterations, nonce_prefix)
+
+
+class _JournalFile:
+    """
+    一个正在追加的日志文件
+
+    key为None时写明文记录（文件头的salt须为空）；sync为False时每条记录只flush不fsync。
+    resume为(已有记录数, 有效内容的结束位置)时接着已有的日志文件追加，
+    之后写了一半或校验失败的内容被截掉。
+    """
+
+    def __init__(self, path, key, header, sync=True, resume=None):
+        self.path = path
+        self.header = header
+        self.header_bytes = header.to_bytes()
+        self.aead = AESGCM(key) if key is not None else None
+        self.sync = sync
+        if resume is None:
+            self.seq = 0
+            self.f = open(path, "wb")
+            self.f.write(self.header_bytes)
+        else:
+            self.seq, end = resume
+            self.f = open(path, "r+b")
+            self.f.truncate(end)
+            self.f.seek(end)
+        self._sync()
+
+    def append(self, payload):
+        if self.aead is not None:
+            nonce = self.header.nonce_prefix + _SEQ.pack(self.seq)
+            ciphertext = self.aead.encrypt(nonce, payload, self.header_bytes + _SEQ.pack(self.seq))
+            self.f.write(_RECORD_LENGTH.pack(len(ciphertext)) + ciphertext)
+        else:
+            self.f.write(_RECORD_LENGTH.pack(len(payload)) + payload + _CRC.pack(zlib.crc32(payload)))
+        if self.sync:
+            self._sync()
+        else:
+            self.f.flush()
+        self.seq += 1
+
+    def size(self):
+        return self.f.tell()
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+
+def read_journal(path, key_for):
+    """
+    读取日志文件
+
+    参数:
+        path (str): 日志文件
+        key_for: 可调用对象，参数为文件头（有salt、iterations属性），返回密钥；
+            明文日志不会调用
+
+    返回值:
+        tuple: (JournalHeader或None, 记录明文列表)。末尾写了一半的记录
+        （写入时进程退出）以及校验失败记录之后的内容都会被忽略。
+    """
+    header, records, _ = _scan_journal(path, key_for)
+    return header, records
+
+
+def _scan_journal(path, key_for):
+    # 同read_journal，另外返回最后一条有效记录的结束位置（续写日志时从这里开始）
+    with open(path, "rb") as f:
+        header = JournalHeader.read(f)
+        if header is None:
+            return None, [], 0
+        header_bytes = header.to_bytes()
+        aead = AESGCM(key_for(header)) if header.salt else None
+
+        records = []
+        seq = 0
+        end = f.tell()
+        while True:
+            length = f.read(_RECORD_LENGTH.size)
+            if len(length) < _RECORD_LENGTH.size:
+                break
+            length = _RECORD_LENGTH.unpack(length)[0]
+            if aead is not None:
+                ciphertext = f.read(length)
+                nonce = header.nonce_prefix + _SEQ.pack(seq)
+                try:
+                    records.append(aead.decrypt(nonce, ciphertext, header_bytes + _SEQ.pack(seq)))
+                    valid = True
+                except InvalidTag:
+                    valid = False
+            else:
+                payload = f.read(length)
+                crc = f.read(_CRC.size)
+                valid = len(crc) == _CRC.size and _CRC.unpack(crc)[0] == zlib.crc32(payload)
+                if valid:
+                    records.append(payload)
+            if not valid:
+                if f.read(1):
+                    print(f"[ChangeJournal] {path} 第{seq}条记录校验失败，忽略之后的记录")
+                break
+            seq += 1
+            end = f.tell()
+        return header, records, end
+
+
+class JournaledConnection(sqlite3.Connection):
+    """
+    commit()时把本次事务的变更追加到日志的连接（通过connect的factory参数使用）
+
+    journal为加密会话的ChangeJournal；change_listeners中的对象（如时间点恢复日志）
+    在提交后通过append(changes)收到同一份变更。两者都没有时与普通连接相同。
+    """
+
+    journal = None
+    change_listeners = ()
+
+    def commit(self):
+        journal = self.journal
+        listeners = self.change_listeners
+        changes = capture_changes(self) if journal is not None or listeners else None
+        super().commit()
+        if changes:
+            if journal is not None:
+                journal.append(changes, self)
+            for listener in listeners:
+                listener.append(changes)
+
+
+def install_capture(conn):
+    """在conn上创建记录变更行的TEMP表和TEMP触发器（已存在则跳过）"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS journal_changes (tbl TEXT NOT NULL, rid INTEGER NOT NULL)")
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM main.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+    )]
+    # 逐条execute：executescript会先隐式提交，已开始的事务里的改动不经commit()捕获就落盘
+    for table in tables:
+        conn.execute(f'''
+            CREATE TEMP TRIGGER IF NOT EXISTS jrn_{table}_insert AFTER INSERT ON main."{table}"
+            BEGIN INSERT INTO journal_changes VALUES ('{table}', NEW.rowid); END
+        ''')
+        conn.execute(f'''
+            CREATE TEMP TRIGGER IF NOT EXISTS jrn_{table}_update AFTER UPDATE ON main."{table}"
+            BEGIN
+                INSERT INTO journal_changes VALUES ('{table}', OLD.rowid);
+                INSERT INTO journal_changes SELECT '{table}', NEW.rowid WHERE NEW.rowid != OLD.rowid;
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TEMP TRIGGER IF NOT EXISTS jrn_{table}_delete AFTER DELETE ON main."{table}"
+            BEGIN INSERT INTO journal_changes VALUES ('{table}', OLD.rowid); END
+        ''')
+
+
+def capture_changes(conn):
+    """取出当前事务改动过的行（在提交前调用），没有改动时返回None"""
+    changed = conn.execute("SELECT DISTINCT tbl, rid FROM temp.journal_changes").fetchall()
+    if not changed:
+        return None
+
+    rowids = {}
+    for table, rowid in changed:
+        rowids.setdefault(table, []).append(rowid)
+
+    changes = []
+    for table, ids in rowids.items():
+        cursor = conn.execute(
+            f'SELECT rowid, * FROM main."{table}" '
+            f'WHERE rowid IN (SELECT rid FROM temp.journal_changes WHERE tbl=?)', (table,)
+        )
+        columns = [desc[0] for desc in cursor.description[1:]]
+        rows = [tuple(row) for row in cursor.fetchall()]
+        present = {row[0] for row in rows}
+        deleted = [rowid for rowid in ids if rowid not in present]
+        changes.append((table, columns, rows, deleted))
+    conn.execute("DELETE FROM temp.journal_changes")
+    return changes
+
+
+class ChangeJournal:
+    """
+    一个加密用户数据库文件对应的变更日志
+
+    - 两个日志槽位文件交替使用：压缩期间新旧日志同时追加，新快照落盘后才删除旧日志，
+      任何时刻退出都能用磁盘上的 快照 + 匹配的日志 恢复
+    - 登录时回放匹配的日志后接着它追加，不重写快照；只有日志超过阈值、没有可续写的
+      日志或回放之后数据库结构变了（升级等）时才压缩
+    - 变更捕获使用TEMP触发器和TEMP表，不会进入快照
+    """
+
+    # 当前日志超过该大小时在后台压缩为新快照
+    COMPACT_THRESHOLD = 4 * 1024 * 1024
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.slot_paths = (db_path + ".changes0", db_path + ".changes1")
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self.key = None
+        self.new_header = None
+        self._lock = threading.Lock()
+        self._files = []  # 正在追加的日志，压缩期间有两个
+        self._current_slot = None  # 与磁盘上的快照匹配的日志槽位
+        self._resume = None  # 回放的日志（文件头, 记录数, 有效内容结束位置），start()时接着追加
+        self._schema = None  # 回放后各表的定义
+        self._compaction = None
+        self._conn = None
+
+    def replay(self, conn, base_id, key_for):
+        """
+        把与快照base_id匹配的日志回放到conn（调用方负责暂停汇总触发器并提交）
+
+        回放后即开始捕获conn上的改动，start()之前（升级、默认值修正等）的改动
+        在start()时作为一条记录续写到同一个日志。
+
+        返回值:
+            int: 回放的记录数
+        """
+        count = 0
+        for slot, path in enumerate(self.slot_paths):
+            if not os.path.exists(path):
+                continue
+            header, records, end = _scan_journal(path, key_for)
+            if header is None or header.base_id != base_id:
+                continue
+            for payload in records:
+                apply_changes(conn, decode_record(payload))
+            self._current_slot = slot
+            self._resume = (header, len(records), end)
+            count = len(records)
+            break
+        install_capture(conn)
+        self._schema = _schema(conn)
+        return count
+
+    def start(self, conn, key, new_header):
+        """
+        开始记录conn上的提交
+
+        参数:
+            conn (JournaledConnection): 内存数据库连接
+            key (bytes): 加密快照和日志的密钥
+            new_header: 无参可调用对象，返回新的ContainerHeader（salt须与key一致）
+
+        返回值:
+            Future: 接着已有日志追加时为已完成的Future，否则为首次压缩（把当前状态
+            写成快照）的结果
+        """
+        self.key = key
+        self.new_header = new_header
+        self._conn = conn
+        install_capture(conn)
+        resume, self._resume = self._resume, None
+
+        header = new_header()
+        if (resume is not None and self._schema == _schema(conn)
+                and (resume[0].salt, resume[0].iterations) == (header.salt, header.iterations)):
+            journal_header, seq, end = resume
+            with self._lock:
+                self._files = [_JournalFile(self.slot_paths[self._current_slot], key, journal_header,
+                                            resume=(seq, end))]
+            conn.journal = self
+            # 回放之后捕获到的改动随这次提交追加到日志
+            conn.commit()
+            future = Future()
+            future.set_result(None)
+            return future
+
+        # 压缩写出的快照已包含之前捕获到的改动
+        conn.execute("DELETE FROM temp.journal_changes")
+        conn.commit()
+        if self._current_slot is None:
+            self._current_slot = self._matching_slot()
+        conn.journal = self
+        return self.compact(conn)
+
+    def _matching_slot(self):
+        # 与磁盘上快照匹配的日志槽位，新日志必须写到另一个槽位
+        if not os.path.exists(self.db_path) or not is_container_file(self.db_path):
+            return None
+        base_id = read_header(self.db_path).nonce_prefix
+        for slot, path in enumerate(self.slot_paths):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    header = JournalHeader.read(f)
+                if header is not None and header.base_id == base_id:
+                    return slot
+        return None
+
+    def append(self, changes, conn):
+        """追加一条提交记录（已落盘后返回），日志过大时触发后台压缩"""
+        payload = encode_record(changes)
+        with self._lock:
+            for journal_file in self._files:
+                journal_file.append(payload)
+            size = self._files[0].size() if self._files else 0
+        if size > self.COMPACT_THRESHOLD:
+            self.compact(conn)
+
+    def compact(self, conn):
+        """
+        在后台把conn的当前状态写成新快照并切换日志
+
+        序列化在调用线程完成（保证是提交点上的一致状态），加密和写盘在后台线程。
+        已有压缩在进行时直接返回它的Future。
+        """
+        with self._lock:
+            if self._compaction is not None and not self._compaction.done():
+                return self._compaction
+
+            header = self.new_header()
+            data = dump_database(conn)
+            slot = 1 if self._current_slot == 0 else 0
+            journal_header = JournalHeader(header.nonce_prefix, header.salt, header.iterations,
+                                           os.urandom(NONCE_PREFIX_SIZE))
+            new_file = _JournalFile(self.slot_paths[slot], self.key, journal_header)
+            self._files.append(new_file)
+            self._compaction = self.executor.submit(self._finish_compaction, data, header, new_file, slot)
+            return self._compaction
+
+    def _finish_compaction(self, data, header, new_file, slot):
+        try:
+            write_container(self.db_path, data, self.key, header)
+        except Exception as e:
+            print(f"[ChangeJournal] 压缩失败: {str(e)}")
+            with self._lock:
+                self._files.remove(new_file)
+                new_file.close()
+                os.remove(new_file.path)
+            raise
+
+        # 新快照已落盘，旧日志不再需要
+        with self._lock:
+            for journal_file in self._files:
+                if journal_file is not new_file:
+                    journal_file.close()
+            self._files = [new_file]
+            self._current_slot = slot
+            for path in self.slot_paths:
+                if path != new_file.path and os.path.exists(path):
+                    os.remove(path)
+
+    def wait(self):
+        """等待正在进行的压缩完成"""
+        if self._compaction is not None:
+            try:
+                self._compaction.result()
+            except Exception:
+                pass
+
+    def close(self):
+        """停止记录：等待压缩完成并关闭日志文件（磁盘上的快照 + 日志即为最新状态）"""
+        self.wait()
+        with self._lock:
+            for journal_file in self._files:
+                journal_file.close()
+            self._files = []
+        if self._conn is not None:
+            self._conn.journal = None
+            self._conn = None
+        self.executor.shutdown(wait=True)
+
+    def discard(self):
+        """关闭并删除日志文件（数据库文件已被整体替换时调用）"""
+        self.close()
+        for path in self.slot_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _schema(conn):
+    # 日志记录的是表中的行，只有表的定义和存储位置（重建过的表rootpage不同，
+    # 重建期间的写入没有被捕获）影响能否续写；触发器和索引的变化不影响
+    return conn.execute(
+        "SELECT name, rootpage, sql FROM main.sqlite_master WHERE type='table' ORDER BY name"
+    ).fetchall()
+
+
+def apply_changes(conn, changes):
+    for table, columns, rows, deleted in changes:
+        if deleted:
+            conn.executemany(f'DELETE FROM main."{table}" WHERE rowid=?', [(rowid,) for rowid in deleted])
+        if rows:
+            column_list = ", ".join(["rowid"] + [f'"{name}"' for name in columns])
+            placeholders = ", ".join(["?"] * (len(columns) + 1))
+            conn.executemany(
+                f'INSERT OR REPLACE INTO main."{table}" ({column_list}) VALUES ({placeholders})', rows
+            )
@@ -0,0 +1,244 @@
+"""
+备份的去重分块存储
+
+数据库按定长分块（SQLite页大小的整数倍）切分，每个不同的分块按内容哈希只保存一份，
+每次备份只记录分块ID列表（清单）。相邻两次备份之间大多数页没有变化，
+新备份只需写入变化的分块，因此可以保留数百份备份。
+
+目录布局: <root>/<ID前两位>/<ID>
+
+加密用户的分块ID是以密钥计算的HMAC（不泄露明文哈希），去重按分块ID（即文件路径）
+进行。分块用AES-GCM加密，每次写入随机生成nonce，保存在密文前：被清理后重新写入的
+分块可能换了压缩方式，加密的内容不同，不能沿用同一个nonce。
+
+分块先压缩再加密，第一个字节记录压缩方式；分块ID按压缩前的内容计算，
+所以更换压缩方式不影响去重。
+"""
+import hashlib
+import hmac
+import lzma
+import os
+import time
+import zlib
+from collections import namedtuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 64 KiB，是所有SQLite页大小（512~65536）的整数倍，分块边界总是落在页边界上
+CHUNK_SIZE = 64 * 1024
+
+_NONCE_SIZE = 12
+
+# 压缩方式: 名称 -> (写在分块开头的标记, 压缩函数, 解压函数)
+_CODECS = {
+    "none": (0, bytes, bytes),
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+if zstandard is not None:
+    # 压缩器对象不能跨线程共用，每次新建
+    _CODECS["zstd"] = (
+        3,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+_DECOMPRESSORS = {marker: decompress for marker, _, decompress in _CODECS.values()}
+
+DEFAULT_COMPRESSION = "zstd" if zstandard is not None else "zlib"
+
+# put_stream()的结果
+StoreResult = namedtuple("StoreResult", "chunk_ids checksum size new_bytes stored_bytes compress_seconds")
+
+
+def available_compressions():
+    """当前环境可用的压缩方式名称"""
+    return list(_CODECS)
+
+
+class ChunkMissingError(ValueError):
+    """清单引用的分块不存在或已损坏"""
+
+    def __init__(self, chunk_id, reason="分块不存在"):
+        super().__init__(f"{reason}: {chunk_id}")
+        self.chunk_id = chunk_id
+
+
+class ChunkStore:
+    """
+    按内容寻址的分块目录
+
+    参数:
+        root (str): 分块目录
+        key (bytes): 加密用户的密钥；为None时分块明文保存，ID为SHA-256
+        compression (str): 新写入分块的压缩方式，见available_compressions()
+    """
+
+    def __init__(self, root, key=None, compression=DEFAULT_COMPRESSION):
+        if compression not in _CODECS:
+            raise ValueError(f"不支持的压缩方式: {compression}")
+        self.root = root
+        self.compression = compression
+        self.compress_seconds = 0.0  # 最近一次put_stream()的压缩耗时
+        self._aead = None
+        self._id_key = None
+        if key is not None:
+            # 由同一密钥派生两个子密钥，分别用于分块ID和加密
+            key = bytes(key)
+            self._id_key = hmac.new(key, b"chunk-id", hashlib.sha256).digest()
+            self._aead = AESGCM(hmac.new(key, b"chunk-data", hashlib.sha256).digest())
+
+    @property
+    def encrypted(self):
+        return self._aead is not None
+
+    def chunk_id(self, data):
+        """分块内容对应的ID（十六进制）"""
+        if self._id_key is not None:
+            return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+        return hashlib.sha256(data).hexdigest()
+
+    def path_for(self, chunk_id):
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def has(self, chunk_id):
+        return os.path.exists(self.path_for(chunk_id))
+
+    def put(self, data):
+        """
+        保存一个分块，已存在时不重复写入
+
+        返回值:
+            tuple: (分块ID, 实际写入的字节数；已存在时为0)
+        """
+        chunk_id = self.chunk_id(data)
+        path = self.path_for(chunk_id)
+        if os.path.exists(path):
+            return chunk_id, 0
+
+        data = self._compress(data)
+        if self._aead is not None:
+            nonce = os.urandom(_NONCE_SIZE)
+            data = nonce + self._aead.encrypt(nonce, data, bytes.fromhex(chunk_id))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return chunk_id, len(data)
+
+    def get(self, chunk_id):
+        """
+        读取分块内容并校验
+
+        异常:
+            ChunkMissingError: 分块不存在、已损坏或密钥不符
+        """
+        try:
+            with open(self.path_for(chunk_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise ChunkMissingError(chunk_id)
+
+        if self._aead is not None:
+            try:
+                data = self._aead.decrypt(data[:_NONCE_SIZE], data[_NONCE_SIZE:], bytes.fromhex(chunk_id))
+            except InvalidTag:
+                raise ChunkMissingError(chunk_id, "分块认证失败")
+        decompress = _DECOMPRESSORS.get(data[0]) if data else None
+        if decompress is None:
+            raise ChunkMissingError(chunk_id, "不支持的分块压缩方式")
+        try:
+            data = decompress(data[1:])
+        except Exception:
+            # 各压缩库的异常类型不同（zlib.error、LZMAError、ZstdError）
+            raise ChunkMissingError(chunk_id, "分块内容已损坏")
+        if self.chunk_id(data) != chunk_id:
+            raise ChunkMissingError(chunk_id, "分块内容已损坏")
+        return data
+
+    def _compress(self, data):
+        # 压缩后没有变小的分块按原样保存
+        marker, compress, _ = _CODECS[self.compression]
+        start = time.perf_counter()
+        compressed = compress(data)
+        self.compress_seconds += time.perf_counter() - start
+        if len(compressed) >= len(data):
+            return bytes([_CODECS["none"][0]]) + data
+        return bytes([marker]) + compressed
+
+    def put_stream(self, src, chunk_size=CHUNK_SIZE):
+        """
+        把文件对象的内容逐块读取、压缩后保存，不需要把整个文件读入内存
+
+        返回值:
+            StoreResult: 分块ID列表、内容SHA-256和大小、新写入的字节数、
+                所引用分块在磁盘上的总大小（含已存在的分块）、压缩耗时
+        """
+        chunk_ids = []
+        digest = hashlib.sha256()
+        size = 0
+        written = 0
+        stored = 0
+        self.compress_seconds = 0.0
+        for block in iter(lambda: src.read(chunk_size), b""):
+            chunk_id, new_bytes = self.put(block)
+            chunk_ids.append(chunk_id)
+            digest.update(block)
+            size += len(block)
+            written += new_bytes
+            stored += new_bytes or os.path.getsize(self.path_for(chunk_id))
+        return StoreResult(chunk_ids, digest.hexdigest(), size, written, stored, self.compress_seconds)
+
+    def iter_content(self, chunk_ids):
+        """按清单顺序逐块读出内容"""
+        for chunk_id in chunk_ids:
+            yield self.get(chunk_id)
+
+    def iter_ids(self):
+        """目录中所有分块的ID"""
+        if not os.path.isdir(self.root):
+            return
+        for prefix in os.listdir(self.root):
+            subdir = os.path.join(self.root, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith(".tmp"):
+                    yield name
+
+    def collect_garbage(self, referenced):
+        """
+        删除没有被任何清单引用的分块
+
+        参数:
+            referenced (set): 仍在使用的分块ID
+
+        返回值:
+            tuple: (删除的分块数, 释放的字节数)
+        """
+        removed = 0
+        freed = 0
+        for chunk_id in list(self.iter_ids()):
+            if chunk_id in referenced:
+                continue
+            path = self.path_for(chunk_id)
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                print(f"删除分块失败: {str(e)}")
+        return removed, freed
+
+    def disk_usage(self):
+        """分块目录占用的字节数"""
+        return sum(os.path.getsize(self.path_for(chunk_id)) for chunk_id in self.iter_ids())
@@ -0,0 +1,178 @@
+"""数据库连接工厂：所有SQLite连接统一从这里打开，并应用PRAGMA配置"""
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class ConnectionManager:
+    """
+    SQLite连接管理
+
+    - 按配置名（main/memory/readonly）对新连接应用PRAGMA
+    - 记录每次打开、关闭连接的耗时
+    - 跟踪当前打开的连接，退出时可以统一关闭
+    """
+
+    # 文件超过该大小时才启用内存映射
+    MMAP_MIN_FILE_SIZE = 16 * 1024 * 1024
+
+    # 打开/关闭耗时超过该值（毫秒）时打印提示
+    SLOW_MS = 200
+
+    DEFAULT_PROFILES = {
+        # 用户数据库和主数据库
+        "main": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -32768,  # 负数表示KiB，即32MB页缓存
+            "mmap_size": 256 * 1024 * 1024,
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,
+        },
+        # 加密用户的内存数据库
+        "memory": {
+            "cache_size": -32768,
+            "temp_store": "MEMORY",
+        },
+        # 只读打开备份文件（immutable，不加锁也不生成-wal/-shm文件）
+        "readonly": {
+            "cache_size": -8192,
+            "temp_store": "MEMORY",
+            "query_only": "ON",
+        },
+    }
+
+    def __init__(self, profiles=None):
+        self.profiles = {name: dict(pragmas) for name, pragmas in self.DEFAULT_PROFILES.items()}
+        for name, pragmas in (profiles or {}).items():
+            self.configure(name, **pragmas)
+        self.open_connections = {}  # id(conn) -> (连接, 路径, 配置名)
+        self.timings = []  # (操作, 路径, 毫秒)
+
+    def configure(self, profile, **pragmas):
+        """修改（或新增）一个PRAGMA配置，值为None表示不设置该项"""
+        self.profiles.setdefault(profile, {}).update(pragmas)
+
+    def connect(self, path, profile=None, factory=None):
+        """
+        打开数据库连接
+
+        参数:
+            path (str): 数据库文件路径或':memory:'
+            profile (str): PRAGMA配置名，默认按路径选择main或memory
+            factory: sqlite3.Connection的子类（例如需要在提交时做额外处理的连接）
+
+        返回值:
+            sqlite3.Connection: 已应用PRAGMA的连接
+        """
+        if profile is None:
+            profile = "memory" if path == ":memory:" else "main"
+
+        start = time.perf_counter()
+        factory = factory or sqlite3.Connection
+        if profile == "readonly":
+            uri = Path(path).absolute().as_uri() + "?mode=ro&immutable=1"
+            conn = sqlite3.connect(uri, uri=True, factory=factory)
+        else:
+            conn = sqlite3.connect(path, factory=factory)
+        self.apply_profile(conn, path, profile)
+        elapsed = self._record("open", path, start)
+
+        self.open_connections[id(conn)] = (conn, path, profile)
+        if elapsed > self.SLOW_MS:
+            print(f"[ConnectionManager] 打开 {path} 耗时 {elapsed:.1f} ms")
+        return conn
+
+    def apply_profile(self, conn, path, profile):
+        """对连接应用PRAGMA配置"""
+        pragmas = self.profiles.get(profile, {})
+        for name, value in pragmas.items():
+            if value is None:
+                continue
+            if name == "mmap_size" and not self._is_large_file(path):
+                continue
+            conn.execute(f"PRAGMA {name}={value}")
+
+    def close(self, conn):
+        """关闭连接（WAL模式下提交挂起的检查点）"""
+        if conn is None:
+            return
+        _, path, _ = self.open_connections.pop(id(conn), (None, "?", None))
+        start = time.perf_counter()
+        conn.close()
+        elapsed = self._record("close", path, start)
+        if elapsed > self.SLOW_MS:
+            print(f"[ConnectionManager] 关闭 {path} 耗时 {elapsed:.1f} ms")
+
+    def close_all(self):
+        """关闭所有仍未关闭的连接（程序退出时调用）"""
+        for conn, _, _ in list(self.open_connections.values()):
+            self.close(conn)
+
+    @contextmanager
+    def open(self, path, profile=None):
+        """with语句中使用的临时连接，退出时自动关闭"""
+        conn = self.connect(path, profile)
+        try:
+            yield conn
+        finally:
+            self.close(conn)
+
+    def checkpoint(self, conn):
+        """
+        把WAL中的内容写回主数据库文件
+
+        直接复制数据库文件（备份、撤销快照）之前必须调用，
+        否则最近提交的数据还在-wal文件里，复制出来的文件会缺数据。
+        """
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"[ConnectionManager] 检查点失败: {str(e)}")
+
+    def replace_database_file(self, source, target):
+        """
+        用source文件覆盖target数据库（恢复备份、撤销时使用）
+
+        调用前target上的连接必须已经关闭。残留的-wal/-shm文件属于旧数据库，
+        如果不删除，重新打开时SQLite会把旧日志回放到新文件上。
+        """
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.remove(target + suffix)
+            except FileNotFoundError:
+                pass
+        shutil.copy2(source, target)
+
+    def timing_report(self):
+        """
+        汇总连接打开/关闭耗时
+
+        返回值:
+            dict: {操作: (次数, 平均毫秒, 最大毫秒)}
+        """
+        report = {}
+        for action in ("open", "close"):
+            values = [ms for op, _, ms in self.timings if op == action]
+            if values:
+                report[action] = (len(values), sum(values) / len(values), max(values))
+        return report
+
+    def _record(self, action, path, start):
+        elapsed = (time.perf_counter() - start) * 1000
+        self.timings.append((action, path, elapsed))
+        # 只保留最近的记录，避免长时间运行时无限增长
+        if len(self.timings) > 1000:
+            del self.timings[:-1000]
+        return elapsed
+
+    def _is_large_file(self, path):
+        if path == ":memory:":
+            return False
+        try:
+            return os.path.getsize(path) >= self.MMAP_MIN_FILE_SIZE
+        except OSError:
+            return False
@@ -0,0 +1,121 @@
+"""加密用户的密钥服务：per-user KDF参数、后台派生和会话内密钥缓存"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from secure_storage import DEFAULT_ITERATIONS, SALT_SIZE, derive_key
+
+# 旧版Fernet文件使用的固定KDF参数，只用于读取和转换旧文件
+LEGACY_SALT = b'some_salt'
+LEGACY_ITERATIONS = 100000
+
+
+class KeyService:
+    """
+    密钥派生与缓存
+
+    - 每个用户的salt和迭代次数保存在主数据库users表（kdf_salt、kdf_iterations列）
+    - PBKDF2在后台线程执行（hashlib在计算期间释放GIL），调用方拿到Future，
+      界面线程可以一边等待一边刷新进度提示
+    - 当前会话密码派生出的密钥按(salt, 迭代次数)缓存，进程内有效；
+      切换用户时clear()把缓存的密钥清零；缓存和会话密码由锁保护，
+      派生线程不会在清零之后再存入密钥
+    """
+
+    def __init__(self, master_conn):
+        self.master_conn = master_conn
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kdf")
+        self.username = None
+        self._lock = threading.Lock()  # 保护_password和_keys
+        self._password = None
+        self._keys = {}  # (salt, iterations) -> bytearray
+
+    def user_params(self, username, regenerate=False):
+        """
+        读取用户的KDF参数，没有时生成随机salt并写入主数据库
+
+        返回值:
+            tuple: (salt, iterations)
+        """
+        cursor = self.master_conn.cursor()
+        cursor.execute("SELECT kdf_salt, kdf_iterations FROM users WHERE username=?", (username,))
+        row = cursor.fetchone()
+        if row and row[0] and not regenerate:
+            return bytes(row[0]), row[1] or DEFAULT_ITERATIONS
+
+        salt = os.urandom(SALT_SIZE)
+        cursor.execute(
+            "UPDATE users SET kdf_salt=?, kdf_iterations=? WHERE username=?",
+            (salt, DEFAULT_ITERATIONS, username)
+        )
+        self.master_conn.commit()
+        return salt, DEFAULT_ITERATIONS
+
+    def begin_session(self, username, password):
+        """
+        登录加密用户：记住会话密码，并在后台派生该用户参数对应的密钥
+
+        返回值:
+            Future: 结果为密钥
+        """
+        self.clear()
+        with self._lock:
+            self.username = username
+            self._password = password
+        salt, iterations = self.user_params(username)
+        return self.derive(salt, iterations)
+
+    def derive(self, salt, iterations, password=None):
+        """
+        后台派生密钥
+
+        password为None或等于会话密码时结果会被缓存，已缓存时直接返回已完成的Future；
+        其它密码（例如解密前校验用户输入）每次重新派生，不进入缓存。
+        """
+        with self._lock:
+            session_password = self._password
+            cache_key = (bytes(salt), iterations)
+            cached = self._keys.get(cache_key)
+        if password is not None and password != session_password:
+            return self.executor.submit(_derive, password, salt, iterations)
+        if session_password is None:
+            raise ValueError("没有已登录的加密会话")
+
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+
+        return self.executor.submit(self._derive_and_store, cache_key, session_password)
+
+    def legacy_key(self, password=None):
+        """旧版Fernet文件的原始密钥（Fernet密钥是它的urlsafe base64编码）"""
+        return self.derive(LEGACY_SALT, LEGACY_ITERATIONS, password)
+
+    def _derive_and_store(self, cache_key, password):
+        # 在工作线程中写入缓存，Future完成时缓存已经可用
+        key = _derive(password, *cache_key)
+        # 派生期间会话已结束（切换了用户）时不再缓存；检查和存入在同一次加锁内完成
+        with self._lock:
+            if self._password == password:
+                self._keys[cache_key] = key
+        return key
+
+    def clear(self):
+        """清零并丢弃所有缓存的密钥，结束当前会话"""
+        with self._lock:
+            for key in self._keys.values():
+                key[:] = bytes(len(key))
+            self._keys.clear()
+            self._password = None
+            self.username = None
+
+    def shutdown(self):
+        """程序退出时调用"""
+        self.clear()
+        self.executor.shutdown(wait=False)
+
+
+def _derive(password, salt, iterations):
+    # 返回可变的bytearray，clear()时可以原地清零
+    return bytearray(derive_key(password, salt, iterations))
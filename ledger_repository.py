@@ -0,0 +1,487 @@
+"""账本数据访问层：交易、账户、分类、预算和借款的SQL都集中在这里，不依赖Qt"""
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from ledger_schema import (rebuild_daily_balances, rebuild_loan_summary,
+                           rebuild_monthly_rollup, summary_triggers_suspended)
+from money import Money
+
+
+def split_by_month(date_from: str, date_to: str):
+    """
+    把日期区间 [date_from, date_to]（含两端）拆成整月部分和首尾零散部分
+
+    返回值:
+        tuple: (整月区间, 零散区间列表)
+               整月区间为 (起始月份, 结束月份) 半开区间，没有整月时为None；
+               零散区间为 [(起始日期, 结束日期), ...] 半开区间
+    """
+    start = datetime.strptime(date_from[:10], "%Y-%m-%d").date()
+    end = datetime.strptime(date_to[:10], "%Y-%m-%d").date() + timedelta(days=1)
+    if end <= start:
+        return None, []
+
+    first_full = start if start.day == 1 else _next_month(start)
+    last_full = end.replace(day=1)  # 第一个不完整月份的1日
+    if first_full >= last_full:
+        return None, [(start.isoformat(), end.isoformat())]
+
+    edges = [(a.isoformat(), b.isoformat()) for a, b in ((start, first_full), (last_full, end)) if a < b]
+    return (first_full.strftime("%Y-%m"), last_full.strftime("%Y-%m")), edges
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+class LedgerRepository:
+    """
+    账本查询和更新
+
+    只接收一个sqlite3连接，不提交事务（由调用方决定何时commit），
+    可以在后台线程或没有界面的基准测试脚本中直接使用。
+    金额参数和返回值统一使用Money。
+    """
+
+    # 热点查询（所有条件都写成能命中transactions复合索引的形式）
+    # 借款的已还、剩余金额和状态都从loan_summary读取（由触发器维护）
+    SQL_LOAN_SUMMARY = """
+        SELECT principal, repaid, remaining, status FROM loan_summary
+        WHERE loan_id=?
+    """
+
+    # 余额都从daily_balances读取（由ledger_schema中的触发器增量维护）
+    SQL_ACCOUNT_BALANCE = """
+        SELECT balance FROM daily_balances
+        WHERE account_id=?
+        ORDER BY date DESC LIMIT 1
+    """
+
+    SQL_ACCOUNT_BALANCE_AT = """
+        SELECT balance FROM daily_balances
+        WHERE account_id=? AND date <= ?
+        ORDER BY date DESC LIMIT 1
+    """
+
+    # 每个账户取截至该日期的最后一行余额再求和，代价只与账户数有关
+    SQL_TOTAL_BALANCE_AT = """
+        SELECT COALESCE(SUM((
+            SELECT d.balance FROM daily_balances d
+            WHERE d.account_id=a.account_id AND d.date <= ?
+            ORDER BY d.date DESC LIMIT 1
+        )), 0)
+        FROM (SELECT DISTINCT account_id FROM daily_balances) a
+    """
+
+    SQL_PENDING_LOANS = """
+        SELECT t.id, t.amount, t.description, t.date, ls.remaining
+        FROM transactions t
+        JOIN loan_summary ls ON ls.loan_id = t.id
+        WHERE t.type='借款' AND t.status='pending'
+        ORDER BY t.date
+    """
+
+    SQL_PENDING_REPAYMENT = """
+        SELECT SUM(ls.remaining)
+        FROM transactions t1
+        JOIN loan_summary ls ON ls.loan_id = t1.id
+        WHERE t1.type='借款' AND t1.status='pending'
+        AND t1.date BETWEEN ? AND ?
+    """
+
+    SQL_PERIOD_LOANS = """
+        SELECT t.id, t.amount, t.description, t.date, t.status, COALESCE(ls.repaid, 0)
+        FROM transactions t
+        LEFT JOIN loan_summary ls ON ls.loan_id = t.id
+        WHERE t.type='借款' AND t.date BETWEEN ? AND ?
+        ORDER BY t.date ASC
+    """
+
+    # 按月、按分类的统计从monthly_rollup读取（由触发器维护），
+    # 日期区间首尾不满一个月的部分再从交易表补齐
+    SQL_ROLLUP_AMOUNTS = """
+        SELECT type, NULLIF(category, ''), SUM(total)
+        FROM monthly_rollup
+        WHERE year_month >= ? AND year_month < ?
+        GROUP BY type, NULLIF(category, '')
+    """
+
+    SQL_RAW_AMOUNTS = """
+        SELECT type, NULLIF(category, ''), SUM(amount)
+        FROM transactions
+        WHERE date >= ? AND date < ?
+        GROUP BY type, NULLIF(category, '')
+    """
+
+    SQL_MONTH_EXPENSES = """
+        SELECT NULLIF(category, ''), SUM(total)
+        FROM monthly_rollup
+        WHERE year_month=? AND type='expense'
+        GROUP BY category
+    """
+
+    SQL_OVER_BUDGET = """
+        SELECT b.category, b.amount, e.expense
+        FROM budgets b
+        JOIN (
+            SELECT category, SUM(total) AS expense
+            FROM monthly_rollup
+            WHERE year_month=? AND type='expense'
+            GROUP BY category
+        ) e ON e.category = b.category
+        WHERE b.month=? AND e.expense > b.amount
+    """
+
+    SQL_FILTER_BASE = """
+        SELECT t.id, t.type, t.amount, t.category, t.description, t.date,
+            CASE WHEN t.status IS NULL THEN '' ELSE t.status END,
+            CASE WHEN t.related_id IS NULL THEN '' ELSE t.related_id END,
+            a.name, t.tags, ls.remaining
+        FROM transactions t
+        LEFT JOIN accounts a ON t.account_id = a.id
+        LEFT JOIN loan_summary ls ON ls.loan_id = t.id
+    """
+
+    SQL_FILTER_ORDER = " ORDER BY t.date ASC, t.id ASC"
+
+    # EXPLAIN QUERY PLAN检查清单：(名称, SQL, 示例参数)
+    HOT_PATH_QUERIES = [
+        ("filter_transactions 日期范围", SQL_FILTER_BASE + " WHERE t.date BETWEEN ? AND ?" + SQL_FILTER_ORDER,
+         ("2000-01-01", "2000-01-31")),
+        ("filter_transactions 类型", SQL_FILTER_BASE + " WHERE t.type=?" + SQL_FILTER_ORDER, ("expense",)),
+        ("filter_transactions 账户", SQL_FILTER_BASE + " WHERE t.account_id=?" + SQL_FILTER_ORDER, (1,)),
+        ("filter_transactions 状态",
+         SQL_FILTER_BASE + " WHERE t.type IN ('借款', '还款') AND t.status=?" + SQL_FILTER_ORDER,
+         ("pending",)),
+        ("period_amounts 月汇总", SQL_ROLLUP_AMOUNTS, ("2000-01", "2000-03")),
+        ("period_amounts 零散日期", SQL_RAW_AMOUNTS, ("2000-01-01", "2000-01-15")),
+        ("pending_repayment", SQL_PENDING_REPAYMENT, ("2000-01-01", "2000-01-31")),
+        ("period_loans", SQL_PERIOD_LOANS, ("2000-01-01", "2000-01-31")),
+        ("month_expenses_by_category", SQL_MONTH_EXPENSES, ("2000-01",)),
+        ("over_budget_categories", SQL_OVER_BUDGET, ("2000-01", "2000-01")),
+        ("loan_summary", SQL_LOAN_SUMMARY, (1,)),
+        ("pending_loans", SQL_PENDING_LOANS, ()),
+        ("account_balance", SQL_ACCOUNT_BALANCE, (1,)),
+        ("total_balance_at", SQL_TOTAL_BALANCE_AT, ("2000-01-01",)),
+        ("account_balance_at", SQL_ACCOUNT_BALANCE_AT, (1, "2000-01-01")),
+    ]
+
+    # 筛选状态（界面文字 -> 数据库值）
+    STATUS_FILTERS = {"待还款": "pending", "已结清": "settled"}
+
+    # insert_transactions接受的列及缺省值（与transactions表的DEFAULT一致）
+    INSERT_COLUMNS = (
+        "type", "amount", "category", "description", "date", "related_id", "status",
+        "account_id", "tags", "receipt_hash", "is_recurring", "recurring_freq", "recurring_end",
+    )
+    INSERT_DEFAULTS = {"account_id": 1, "is_recurring": 0}
+
+    # 少于该笔数时逐行由触发器维护汇总表，否则暂停触发器、写完后按范围重建
+    BULK_THRESHOLD = 200
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def _scalar(self, sql, params=()):
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    # ---------------- 交易 ----------------
+
+    def filter_transactions(self, date_range: Optional[Tuple[str, str]] = None,
+                            type_: Optional[str] = None, category: Optional[str] = None,
+                            account_id: Optional[int] = None, status: Optional[str] = None,
+                            search_text: str = "",
+                            abbr: Optional[Callable[[str], str]] = None) -> List[tuple]:
+        """
+        按条件查询交易列表（交易表格使用）
+
+        参数:
+            date_range: (开始日期, 结束日期)，None表示全部时间
+            type_: 交易类型（income/expense/借款/还款）
+            category: 分类名
+            account_id: 账户ID
+            status: 'pending' 或 'settled'（只匹配借款和还款）
+            search_text: 搜索文本，匹配描述、金额、分类、标签和账户名
+            abbr: 拼音首字母函数，提供时额外按首字母匹配描述和分类
+
+        返回值:
+            list: 每行为 (id, type, amount, category, description, date, status,
+                  related_id, 账户名, tags, remaining)
+        """
+        conditions = []
+        params = []
+
+        if date_range:
+            conditions.append("t.date BETWEEN ? AND ?")
+            params.extend(date_range)
+
+        if type_:
+            conditions.append("t.type=?")
+            params.append(type_)
+
+        if category:
+            conditions.append("t.category=?")
+            params.append(category)
+
+        if account_id:
+            conditions.append("t.account_id=?")
+            params.append(account_id)
+
+        # 只有借款和还款有状态，带上类型条件以便命中(type, status)索引
+        if status:
+            conditions.append("t.type IN ('借款', '还款') AND t.status=?")
+            params.append(status)
+
+        if search_text:
+            pattern = f"%{search_text}%"
+            search_conditions = [
+                "t.description LIKE ?",
+                "printf('%.2f', t.amount / 100.0) LIKE ?",  # 按元显示格式匹配金额
+                "t.category LIKE ?",
+                "t.tags LIKE ?",
+                "a.name LIKE ?",
+            ]
+            search_params = [pattern] * len(search_conditions)
+
+            if abbr:
+                descriptions, categories = self.distinct_descriptions_and_categories()
+                pinyin_descriptions = [d for d in descriptions if d and abbr(d).startswith(search_text)]
+                pinyin_categories = [c for c in categories if c and abbr(c).startswith(search_text)]
+                for column, values in (("t.description", pinyin_descriptions),
+                                       ("t.category", pinyin_categories)):
+                    if values:
+                        search_conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+                        search_params.extend(values)
+
+            conditions.append("(" + " OR ".join(search_conditions) + ")")
+            params.extend(search_params)
+
+        query = self.SQL_FILTER_BASE
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += self.SQL_FILTER_ORDER
+
+        return self.conn.execute(query, params).fetchall()
+
+    def distinct_descriptions_and_categories(self) -> Tuple[List[str], List[str]]:
+        """交易中出现过的描述和分类（拼音搜索使用）"""
+        descriptions = [row[0] for row in self.conn.execute("SELECT DISTINCT description FROM transactions")]
+        categories = [row[0] for row in self.conn.execute("SELECT DISTINCT category FROM transactions")]
+        return descriptions, categories
+
+    def receipt_hash_of(self, record_id: int) -> Optional[str]:
+        """交易关联的收据哈希"""
+        row = self.conn.execute("SELECT receipt_hash FROM transactions WHERE id=?", (record_id,)).fetchone()
+        return row[0] if row else None
+
+    def insert_transactions(self, records: Iterable[Mapping]) -> int:
+        """
+        批量写入交易记录
+
+        所有记录用一次executemany写入同一个保存点；笔数较多时暂停汇总触发器，
+        写完后对涉及的日期范围和借款统一重建每日余额、借款汇总和按月汇总。
+
+        参数:
+            records: 交易记录，每条为字典，键为INSERT_COLUMNS中的列名，
+                     type、amount、date必填，amount可以是Money或整数分
+
+        返回值:
+            int: 写入的记录数
+
+        异常:
+            ValueError: 记录缺少必填字段
+        """
+        rows = []
+        for record in records:
+            missing = [key for key in ("type", "amount", "date") if record.get(key) is None]
+            if missing:
+                raise ValueError(f"交易记录缺少字段: {', '.join(missing)}")
+            rows.append(tuple(
+                record.get(column, self.INSERT_DEFAULTS.get(column)) for column in self.INSERT_COLUMNS
+            ))
+        if not rows:
+            return 0
+
+        sql = (f"INSERT INTO transactions ({', '.join(self.INSERT_COLUMNS)}) "
+               f"VALUES ({', '.join('?' * len(self.INSERT_COLUMNS))})")
+
+        if len(rows) < self.BULK_THRESHOLD:
+            self.conn.executemany(sql, rows)
+            return len(rows)
+
+        self.conn.execute("SAVEPOINT bulk_insert")
+        try:
+            with summary_triggers_suspended(self.conn):
+                first_id = self._scalar("SELECT COALESCE(MAX(id), 0) FROM transactions") + 1
+                self.conn.executemany(sql, rows)
+
+                dates = [row[4] for row in rows]
+                since, until = min(dates), max(dates)
+                loan_ids = {row[5] for row in rows if row[0] == '还款'}
+                loan_ids.update(row[0] for row in self.conn.execute(
+                    "SELECT id FROM transactions WHERE id >= ? AND type='借款'", (first_id,)
+                ))
+
+                rebuild_daily_balances(self.conn, since=since)
+                rebuild_loan_summary(self.conn, loan_ids=loan_ids)
+                rebuild_monthly_rollup(self.conn, since=since, until=until)
+        except Exception:
+            self.conn.execute("ROLLBACK TO bulk_insert")
+            self.conn.execute("RELEASE bulk_insert")
+            raise
+        self.conn.execute("RELEASE bulk_insert")
+        return len(rows)
+
+    # ---------------- 账户 ----------------
+
+    def list_accounts(self) -> List[Tuple[int, str]]:
+        """所有账户 [(id, name), ...]，按名称排序"""
+        return self.conn.execute("SELECT id, name FROM accounts ORDER BY name").fetchall()
+
+    def account_balance(self, account_id: int) -> Money:
+        """账户当前余额"""
+        return Money(self._scalar(self.SQL_ACCOUNT_BALANCE, (account_id,)))
+
+    def refresh_account_balance(self, account_id: int) -> Money:
+        """把账户当前余额写入accounts表"""
+        balance = self.account_balance(account_id)
+        self.conn.execute("UPDATE accounts SET balance=? WHERE id=?", (balance, account_id))
+        return balance
+
+    def total_balance_at(self, date: str) -> Money:
+        """截至指定日期所有账户的总余额"""
+        return Money(self._scalar(self.SQL_TOTAL_BALANCE_AT, (date,)))
+
+    def account_balance_at(self, account_id: int, date: str) -> Money:
+        """截至指定日期某个账户的余额"""
+        return Money(self._scalar(self.SQL_ACCOUNT_BALANCE_AT, (account_id, date)))
+
+    # ---------------- 分类 ----------------
+
+    def list_categories(self, type_: Optional[str] = None) -> List[str]:
+        """分类名列表，可按类型（income/expense）过滤"""
+        if type_:
+            rows = self.conn.execute("SELECT name FROM categories WHERE type=? ORDER BY name", (type_,))
+        else:
+            rows = self.conn.execute("SELECT DISTINCT name FROM categories ORDER BY name")
+        return [row[0] for row in rows]
+
+    # ---------------- 预算 ----------------
+
+    def budgets_for_month(self, month: str) -> Dict[str, Money]:
+        """指定月份（yyyy-MM）的预算 {分类: 金额}"""
+        rows = self.conn.execute("SELECT category, amount FROM budgets WHERE month=?", (month,))
+        return {category: Money(amount) for category, amount in rows}
+
+    def month_expenses_by_category(self, month: str) -> Dict[str, Money]:
+        """指定月份（yyyy-MM）各分类的实际支出 {分类: 金额}"""
+        rows = self.conn.execute(self.SQL_MONTH_EXPENSES, (month,))
+        return {category: Money(amount) for category, amount in rows}
+
+    def over_budget_categories(self, month: str) -> List[Tuple[str, Money, Money]]:
+        """指定月份实际支出超过预算的分类 [(分类, 预算, 实际支出), ...]"""
+        rows = self.conn.execute(self.SQL_OVER_BUDGET, (month, month))
+        return [(category, Money(budget), Money(expense)) for category, budget, expense in rows]
+
+    # ---------------- 借款 ----------------
+
+    def pending_loans(self) -> List[tuple]:
+        """待还款借款 [(id, amount, description, date, remaining), ...]，按日期排序"""
+        return self.conn.execute(self.SQL_PENDING_LOANS).fetchall()
+
+    def loan_summary(self, loan_id: int) -> Optional[Tuple[Money, Money, Money, str]]:
+        """借款的 (借款金额, 已还金额, 剩余金额, 状态)，不存在时返回None"""
+        row = self.conn.execute(self.SQL_LOAN_SUMMARY, (loan_id,)).fetchone()
+        if not row:
+            return None
+        principal, repaid, remaining, status = row
+        return Money(principal), Money(repaid), Money(remaining), status
+
+    def loan_account_id(self, loan_id: int) -> Optional[int]:
+        """借款关联的账户ID"""
+        return self._scalar("SELECT account_id FROM transactions WHERE id=?", (loan_id,))
+
+    def repaid_total(self, loan_id: int) -> Money:
+        """借款的已还款总额"""
+        summary = self.loan_summary(loan_id)
+        return summary[1] if summary else Money(0)
+
+    def remaining_loan_amount(self, loan_id: int) -> Money:
+        """借款剩余未还金额（不小于0）"""
+        summary = self.loan_summary(loan_id)
+        return summary[2] if summary else Money(0)
+
+    def period_loans(self, date_from: str, date_to: str) -> List[tuple]:
+        """时间段内的借款 [(id, amount, description, date, status, 已还金额), ...]"""
+        return self.conn.execute(self.SQL_PERIOD_LOANS, (date_from, date_to)).fetchall()
+
+    # ---------------- 统计 ----------------
+
+    def period_amounts(self, date_from: str, date_to: str) -> Dict[Tuple[str, Optional[str]], int]:
+        """
+        时间段内按 (类型, 分类) 汇总的金额（分）
+
+        整月部分读取monthly_rollup，首尾零散的日期按索引范围读取交易表，
+        读取的行数只与时间段跨越的月份数有关，与账本大小无关。
+        """
+        months, edges = split_by_month(date_from, date_to)
+        queries = [(self.SQL_RAW_AMOUNTS, edge) for edge in edges]
+        if months:
+            queries.append((self.SQL_ROLLUP_AMOUNTS, months))
+
+        amounts = {}
+        for sql, params in queries:
+            for type_, category, total in self.conn.execute(sql, params):
+                amounts[(type_, category)] = amounts.get((type_, category), 0) + total
+        return amounts
+
+    def period_totals(self, date_from: str, date_to: str) -> Tuple[Money, Money, Money, Money]:
+        """时间段内的 (总收入, 总支出, 总借款, 总还款)"""
+        totals = dict.fromkeys(("income", "expense", "借款", "还款"), 0)
+        for (type_, _), total in self.period_amounts(date_from, date_to).items():
+            if type_ in totals:
+                totals[type_] += total
+        return tuple(Money(total) for total in totals.values())
+
+    def pending_repayment(self, date_from: str, date_to: str) -> Money:
+        """时间段内待还款借款的剩余总额"""
+        return Money(self._scalar(self.SQL_PENDING_REPAYMENT, (date_from, date_to)))
+
+    def category_stats(self, date_from: str, date_to: str) -> List[Tuple[str, Money, Money]]:
+        """时间段内各分类的 (分类, 收入, 支出)，按收支合计降序"""
+        stats = {}
+        for (type_, category), total in self.period_amounts(date_from, date_to).items():
+            income, expense = stats.get(category, (0, 0))
+            if type_ == "income":
+                income += total
+            elif type_ == "expense":
+                expense += total
+            stats[category] = (income, expense)
+        ordered = sorted(stats.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)
+        return [(category, Money(income), Money(expense)) for category, (income, expense) in ordered]
+
+    # ---------------- 诊断 ----------------
+
+    def check_query_plans(self) -> List[Tuple[str, str]]:
+        """
+        用EXPLAIN QUERY PLAN检查热点查询
+
+        返回值:
+            list: 仍在全表扫描transactions的查询 [(名称, 计划明细), ...]
+        """
+        full_scans = []
+        for name, sql, params in self.HOT_PATH_QUERIES:
+            subqueries = set()
+            for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+                detail = row[-1]
+                # 扫描物化后的子查询结果不算全表扫描
+                if detail.startswith(("MATERIALIZE ", "CO-ROUTINE ")):
+                    subqueries.add(detail.split()[1])
+                    continue
+                # "SCAN t USING INDEX ..."是按索引顺序读取，只有裸SCAN才是全表扫描
+                if detail.startswith("SCAN") and "USING" not in detail and "CONSTANT ROW" not in detail:
+                    if detail.split()[1] not in subqueries:
+                        full_scans.append((name, detail))
+        return full_scans
@@ -0,0 +1,429 @@
+"""账本派生表：由触发器随交易表增量维护，避免每次读取时重新聚合全部交易"""
+from contextlib import contextmanager
+
+# 交易对账户余额的影响（分），余额记录等其他类型为0
+SIGNED_AMOUNT = """(CASE {row}.type
+    WHEN 'income' THEN {row}.amount
+    WHEN '还款' THEN {row}.amount
+    WHEN 'expense' THEN -{row}.amount
+    WHEN '借款' THEN -{row}.amount
+    ELSE 0 END)"""
+
+BALANCE_TYPES = "('income', 'expense', '借款', '还款')"
+
+
+def _apply_balance_delta(row, sign):
+    """
+    生成把{row}（NEW/OLD）计入或移出daily_balances的SQL
+
+    当天没有余额行时先按前一天的余额插入一行，再给当天的net加上变动额，
+    并给当天及之后的所有余额加上变动额（后缀更新）。
+    """
+    account = f"COALESCE({row}.account_id, 0)"
+    delta = f"{sign}{SIGNED_AMOUNT.format(row=row)}"
+    return f"""
+        INSERT OR IGNORE INTO daily_balances (account_id, date, net, balance)
+        VALUES ({account}, {row}.date, 0, COALESCE((
+            SELECT balance FROM daily_balances
+            WHERE account_id={account} AND date < {row}.date
+            ORDER BY date DESC LIMIT 1
+        ), 0));
+        UPDATE daily_balances SET net = net + {delta}
+        WHERE account_id={account} AND date = {row}.date;
+        UPDATE daily_balances SET balance = balance + {delta}
+        WHERE account_id={account} AND date >= {row}.date;
+    """
+
+
+def ensure_daily_balance_schema(conn):
+    """
+    创建每日余额表和维护触发器（已存在则跳过）
+
+    daily_balances每个账户每天一行：net为当天净变动，balance为当天结束时的余额。
+    没有账户的交易记在account_id=0下，只计入总余额。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_balances (
+            account_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            net INTEGER NOT NULL DEFAULT 0,  -- 当天净变动，单位：分
+            balance INTEGER NOT NULL DEFAULT 0,  -- 当天结束时的余额，单位：分
+            PRIMARY KEY (account_id, date)
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_balances_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.type IN {BALANCE_TYPES}
+        BEGIN
+            {_apply_balance_delta("NEW", "+")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_balances_delete
+        AFTER DELETE ON transactions
+        WHEN OLD.type IN {BALANCE_TYPES}
+        BEGIN
+            {_apply_balance_delta("OLD", "-")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_balances_update
+        AFTER UPDATE OF type, amount, date, account_id ON transactions
+        WHEN OLD.type IN {BALANCE_TYPES} OR NEW.type IN {BALANCE_TYPES}
+        BEGIN
+            {_apply_balance_delta("OLD", "-")}
+            {_apply_balance_delta("NEW", "+")}
+        END
+    ''')
+
+
+def rebuild_daily_balances(conn, since=None):
+    """
+    根据交易表重建每日余额（升级数据库、手动重新计算或批量写入后使用）
+
+    参数:
+        since (str): 只重建该日期及之后的余额行，之前最后一行余额作为起点；
+                     None表示全部重建
+
+    返回值:
+        int: 生成的余额行数
+    """
+    running = {}
+    date_filter = ""
+    params = ()
+    if since:
+        for account_id, balance in conn.execute('''
+            SELECT a.account_id, (
+                SELECT d.balance FROM daily_balances d
+                WHERE d.account_id=a.account_id AND d.date < ?
+                ORDER BY d.date DESC LIMIT 1
+            )
+            FROM (SELECT DISTINCT account_id FROM daily_balances) a
+        ''', (since,)):
+            running[account_id] = balance or 0
+        date_filter = "AND date >= ?"
+        params = (since,)
+
+    rows = conn.execute(f'''
+        SELECT COALESCE(account_id, 0), date, SUM({SIGNED_AMOUNT.format(row="transactions")})
+        FROM transactions
+        WHERE type IN {BALANCE_TYPES} {date_filter}
+        GROUP BY COALESCE(account_id, 0), date
+        ORDER BY 1, 2
+    ''', params).fetchall()
+
+    balances = []
+    for account_id, date, net in rows:
+        running[account_id] = running.get(account_id, 0) + net
+        balances.append((account_id, date, net, running[account_id]))
+
+    if since:
+        conn.execute("DELETE FROM daily_balances WHERE date >= ?", (since,))
+    else:
+        conn.execute("DELETE FROM daily_balances")
+    conn.executemany(
+        "INSERT INTO daily_balances (account_id, date, net, balance) VALUES (?, ?, ?, ?)",
+        balances
+    )
+    return len(balances)
+
+
+def _sync_loan_status(loan):
+    """把汇总表中的状态写回交易表：借款的status，还清时关联还款也标记为已结清"""
+    return f"""
+        UPDATE transactions SET status = (SELECT status FROM loan_summary WHERE loan_id={loan})
+        WHERE id={loan} AND type='借款'
+        AND status IS NOT (SELECT status FROM loan_summary WHERE loan_id={loan});
+        UPDATE transactions SET status='settled'
+        WHERE related_id={loan} AND type='还款' AND status IS NOT 'settled'
+        AND (SELECT status FROM loan_summary WHERE loan_id={loan})='settled';
+    """
+
+
+def _refresh_loan(loan):
+    """
+    生成重新汇总一笔借款的SQL（loan为借款ID表达式）
+
+    已还金额按(related_id, type)索引只汇总这一笔借款的还款，再同步状态。
+    """
+    return f"""
+        UPDATE loan_summary SET repaid = (
+            SELECT COALESCE(SUM(amount), 0) FROM transactions
+            WHERE related_id={loan} AND type='还款'
+        ) WHERE loan_id={loan};
+        UPDATE loan_summary SET
+            remaining = MAX(principal - repaid, 0),
+            status = CASE WHEN principal - repaid <= 0 THEN 'settled' ELSE 'pending' END
+        WHERE loan_id={loan};
+        {_sync_loan_status(loan)}
+    """
+
+
+# 借款写入汇总表；未还清时沿用交易表中的状态，这样手动标记为已结清的借款
+# 保持已结清，{unsettled}为修改借款金额时使用的未还清状态
+_INSERT_LOAN_SUMMARY = """
+    INSERT OR REPLACE INTO loan_summary (loan_id, principal, repaid, remaining, status)
+    SELECT NEW.id, NEW.amount, r.repaid, MAX(NEW.amount - r.repaid, 0),
+        CASE WHEN NEW.amount - r.repaid <= 0 THEN 'settled'
+             ELSE {unsettled} END
+    FROM (
+        SELECT COALESCE(SUM(amount), 0) AS repaid FROM transactions
+        WHERE related_id=NEW.id AND type='还款'
+    ) r
+    WHERE NEW.type='借款';
+"""
+
+
+def ensure_loan_summary_schema(conn):
+    """
+    创建借款汇总表和维护触发器（已存在则跳过）
+
+    loan_summary每笔借款一行，借款或其还款有增删改时由触发器更新，
+    读取剩余金额和状态不再需要逐笔汇总还款。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loan_summary (
+            loan_id INTEGER PRIMARY KEY,  -- 借款交易ID
+            principal INTEGER NOT NULL,  -- 借款金额，单位：分
+            repaid INTEGER NOT NULL DEFAULT 0,  -- 已还金额，单位：分
+            remaining INTEGER NOT NULL,  -- 剩余未还金额（不小于0），单位：分
+            status TEXT NOT NULL  -- 'pending' or 'settled'
+        )
+    ''')
+
+    # 借款本身的增删改
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_loan_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.type='借款'
+        BEGIN
+            {_INSERT_LOAN_SUMMARY.format(unsettled="COALESCE(NEW.status, 'pending')")}
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_loan_delete
+        AFTER DELETE ON transactions
+        WHEN OLD.type='借款'
+        BEGIN
+            DELETE FROM loan_summary WHERE loan_id=OLD.id;
+        END
+    ''')
+    # 触发器最后把汇总状态同步回借款行，这次写入只改status且与汇总一致，
+    # 不再重新计算（打开recursive_triggers时否则会再次触发自身）
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_loan_update
+        AFTER UPDATE OF type, amount, status ON transactions
+        WHEN (OLD.type='借款' OR NEW.type='借款')
+            AND NOT (NEW.type IS OLD.type AND NEW.amount IS OLD.amount
+                     AND NEW.status IS (SELECT status FROM loan_summary WHERE loan_id=NEW.id))
+        BEGIN
+            DELETE FROM loan_summary WHERE loan_id=OLD.id;
+            {_INSERT_LOAN_SUMMARY.format(unsettled=(
+                "CASE WHEN NEW.amount IS NOT OLD.amount THEN 'pending' "
+                "ELSE COALESCE(NEW.status, 'pending') END"
+            ))}
+            {_sync_loan_status("NEW.id")}
+        END
+    ''')
+
+    # 还款的增删改
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_repayment_insert
+        AFTER INSERT ON transactions
+        WHEN NEW.type='还款' AND NEW.related_id IS NOT NULL
+        BEGIN
+            {_refresh_loan("NEW.related_id")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_repayment_delete
+        AFTER DELETE ON transactions
+        WHEN OLD.type='还款' AND OLD.related_id IS NOT NULL
+        BEGIN
+            {_refresh_loan("OLD.related_id")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_loan_summary_repayment_update
+        AFTER UPDATE OF type, amount, related_id ON transactions
+        WHEN OLD.type='还款' OR NEW.type='还款'
+        BEGIN
+            {_refresh_loan("OLD.related_id")}
+            {_refresh_loan("NEW.related_id")}
+        END
+    ''')
+
+
+def rebuild_loan_summary(conn, loan_ids=None):
+    """
+    根据交易表重建借款汇总，并按汇总结果校正借款和还款的状态
+
+    参数:
+        loan_ids (iterable): 只重建这些借款；None表示全部重建
+
+    返回值:
+        int: 重建的借款笔数
+    """
+    if loan_ids is not None:
+        # 逐笔按(related_id, type)索引汇总，代价只与涉及的借款数有关
+        params = [(loan_id,) for loan_id in set(loan_ids) if loan_id is not None]
+        conn.executemany("DELETE FROM loan_summary WHERE loan_id=?", params)
+        conn.executemany('''
+            INSERT INTO loan_summary (loan_id, principal, repaid, remaining, status)
+            SELECT l.id, l.amount, r.repaid, MAX(l.amount - r.repaid, 0),
+                CASE WHEN l.amount - r.repaid <= 0 THEN 'settled' ELSE 'pending' END
+            FROM transactions l, (
+                SELECT COALESCE(SUM(amount), 0) AS repaid FROM transactions
+                WHERE related_id=:id AND type='还款'
+            ) r
+            WHERE l.id=:id AND l.type='借款'
+        ''', [{"id": loan_id} for loan_id, in params])
+        for statement in _sync_loan_status(":id").split(";"):
+            if statement.strip():
+                conn.executemany(statement, [{"id": loan_id} for loan_id, in params])
+        return len(params)
+
+    conn.execute("DELETE FROM loan_summary")
+    conn.execute('''
+        INSERT INTO loan_summary (loan_id, principal, repaid, remaining, status)
+        SELECT l.id, l.amount, COALESCE(r.repaid, 0),
+            MAX(l.amount - COALESCE(r.repaid, 0), 0),
+            CASE WHEN l.amount - COALESCE(r.repaid, 0) <= 0 THEN 'settled' ELSE 'pending' END
+        FROM transactions l
+        LEFT JOIN (
+            SELECT related_id, SUM(amount) AS repaid FROM transactions
+            WHERE type='还款' AND related_id IS NOT NULL
+            GROUP BY related_id
+        ) r ON r.related_id = l.id
+        WHERE l.type='借款'
+    ''')
+    conn.execute('''
+        UPDATE transactions SET status = (
+            SELECT status FROM loan_summary WHERE loan_id=transactions.id
+        )
+        WHERE type='借款' AND status IS NOT (
+            SELECT status FROM loan_summary WHERE loan_id=transactions.id
+        )
+    ''')
+    conn.execute('''
+        UPDATE transactions SET status='settled'
+        WHERE type='还款' AND status IS NOT 'settled' AND related_id IN (
+            SELECT loan_id FROM loan_summary WHERE status='settled'
+        )
+    ''')
+    return conn.execute("SELECT COUNT(*) FROM loan_summary").fetchone()[0]
+
+
+def _apply_rollup_delta(row, sign):
+    """生成把{row}（NEW/OLD）计入或移出monthly_rollup的SQL"""
+    key = (f"substr({row}.date, 1, 7), COALESCE({row}.account_id, 0), "
+           f"COALESCE({row}.category, ''), {row}.type")
+    match = (f"year_month=substr({row}.date, 1, 7) AND account_id=COALESCE({row}.account_id, 0) "
+             f"AND category=COALESCE({row}.category, '') AND type={row}.type")
+    if sign == "+":
+        return f"""
+            INSERT OR IGNORE INTO monthly_rollup (year_month, account_id, category, type, total, count)
+            VALUES ({key}, 0, 0);
+            UPDATE monthly_rollup SET total = total + {row}.amount, count = count + 1
+            WHERE {match};
+        """
+    return f"""
+        UPDATE monthly_rollup SET total = total - {row}.amount, count = count - 1
+        WHERE {match};
+        DELETE FROM monthly_rollup WHERE {match} AND count <= 0;
+    """
+
+
+def ensure_monthly_rollup_schema(conn):
+    """
+    创建按月分类汇总表和维护触发器（已存在则跳过）
+
+    monthly_rollup按(月份, 账户, 分类, 类型)保存金额合计和笔数，
+    统计和预算按月读取汇总行，不再扫描原始交易。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_rollup (
+            year_month TEXT NOT NULL,  -- YYYY-MM格式
+            account_id INTEGER NOT NULL,  -- 没有账户的交易为0
+            category TEXT NOT NULL,  -- 没有分类的交易为''
+            type TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,  -- 金额合计，单位：分
+            count INTEGER NOT NULL DEFAULT 0,  -- 交易笔数
+            PRIMARY KEY (year_month, account_id, category, type)
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_monthly_rollup_insert
+        AFTER INSERT ON transactions
+        BEGIN
+            {_apply_rollup_delta("NEW", "+")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_monthly_rollup_delete
+        AFTER DELETE ON transactions
+        BEGIN
+            {_apply_rollup_delta("OLD", "-")}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_monthly_rollup_update
+        AFTER UPDATE OF type, amount, date, account_id, category ON transactions
+        BEGIN
+            {_apply_rollup_delta("OLD", "-")}
+            {_apply_rollup_delta("NEW", "+")}
+        END
+    ''')
+
+
+def rebuild_monthly_rollup(conn, since=None, until=None):
+    """
+    根据交易表重建按月分类汇总
+
+    参数:
+        since (str): 起始日期，只重建该日期所在月份及之后的汇总；None表示不限
+        until (str): 结束日期，只重建到该日期所在月份为止；None表示不限
+
+    返回值:
+        int: 重建的汇总行数
+    """
+    month_from = since[:7] if since else ""
+    month_to = until[:7] if until else "9999-99"
+    conn.execute(
+        "DELETE FROM monthly_rollup WHERE year_month >= ? AND year_month <= ?",
+        (month_from, month_to)
+    )
+    # 按整月对齐：month_to当月的日期都小于"yyyy-MM-~"，可以直接用date索引范围查询
+    cursor = conn.execute('''
+        INSERT INTO monthly_rollup (year_month, account_id, category, type, total, count)
+        SELECT substr(date, 1, 7), COALESCE(account_id, 0), COALESCE(category, ''), type,
+            SUM(amount), COUNT(*)
+        FROM transactions
+        WHERE date >= ? AND date < ?
+        GROUP BY 1, 2, 3, 4
+    ''', (month_from, month_to + "-~"))
+    return cursor.rowcount
+
+
+SUMMARY_SCHEMAS = (ensure_daily_balance_schema, ensure_loan_summary_schema, ensure_monthly_rollup_schema)
+
+
+@contextmanager
+def summary_triggers_suspended(conn):
+    """
+    暂时删除交易表上的汇总维护触发器，退出时重新创建
+
+    批量写入时逐行触发的后缀更新代价很高，改为写完后按影响范围统一重建。
+    调用方必须在同一个事务（或保存点）中完成写入和重建。
+    """
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='trigger' AND tbl_name='transactions' AND name LIKE 'trg_%'"
+    )]
+    for name in names:
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    try:
+        yield
+    finally:
+        for ensure_schema in SUMMARY_SCHEMAS:
+            ensure_schema(conn)
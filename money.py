@@ -0,0 +1,118 @@
+"""金额类型：以整数分存储和计算，避免浮点误差"""
+import sqlite3
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import total_ordering
+
+
+@total_ordering
+class Money:
+    """
+    以整数分表示的人民币金额
+
+    数据库中的金额列全部为INTEGER（单位：分），Money实现了sqlite3的
+    __conform__协议，可以直接作为SQL参数传入；查询结果是整数分，
+    用Money(值)包装后再参与比较和显示。
+    """
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        if isinstance(cents, Money):
+            cents = cents.cents
+        if isinstance(cents, float):
+            raise TypeError("Money只接受整数分，浮点金额请使用Money.from_yuan()")
+        self.cents = int(cents or 0)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        解析用户输入的金额文本（单位：元），四舍五入到分
+
+        参数:
+            text (str): 金额文本，如 "12.5"
+
+        返回值:
+            Money: 解析后的金额
+
+        异常:
+            ValueError: 文本不是有效数字
+        """
+        try:
+            value = Decimal(str(text).strip())
+        except InvalidOperation:
+            raise ValueError(f"无效的金额: {text}")
+        if not value.is_finite():
+            raise ValueError(f"无效的金额: {text}")
+        return cls(int((value * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP)))
+
+    @classmethod
+    def from_yuan(cls, value):
+        """从以元为单位的数值（float/Decimal/int）创建金额"""
+        # 用repr得到最短的十进制表示，避免0.1这类浮点数的二进制尾差
+        return cls.parse(repr(value) if isinstance(value, float) else value)
+
+    def to_decimal(self):
+        """转换为以元为单位的Decimal"""
+        return Decimal(self.cents).scaleb(-2)
+
+    def __conform__(self, protocol):
+        if protocol is sqlite3.PrepareProtocol:
+            return self.cents
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __format__(self, spec):
+        return format(self.to_decimal(), spec or ".2f")
+
+    def __str__(self):
+        return format(self, ".2f")
+
+    def __repr__(self):
+        return f"Money({self.cents})"
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.cents == other.cents
+        if other == 0:
+            return self.cents == 0
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Money):
+            return self.cents < other.cents
+        if other == 0:
+            return self.cents < 0
+        return NotImplemented
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if other == 0:
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        if other == 0:
+            return self
+        return NotImplemented
+
+    def __rsub__(self, other):
+        if other == 0:
+            return -self
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
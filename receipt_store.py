@@ -0,0 +1,94 @@
+"""收据图片存储：按内容哈希去重，原始字节单独存放在receipts表"""
+import base64
+import binascii
+import hashlib
+
+
+def ensure_receipt_schema(conn):
+    """创建收据表和交易表上的收据引用索引（已存在则跳过）"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            hash TEXT PRIMARY KEY,  -- 图片内容的SHA-256
+            data BLOB NOT NULL,  -- JPEG原始字节
+            size INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_receipt_hash
+        ON transactions(receipt_hash) WHERE receipt_hash IS NOT NULL
+    ''')
+
+
+def receipt_hash(data):
+    """计算收据内容哈希"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def put_receipt(conn, data):
+    """
+    保存收据图片，相同内容只存一份
+
+    参数:
+        conn: 数据库连接
+        data (bytes): 图片原始字节
+
+    返回值:
+        str: 收据哈希，写入transactions.receipt_hash
+    """
+    digest = receipt_hash(data)
+    conn.execute(
+        "INSERT OR IGNORE INTO receipts (hash, data, size) VALUES (?, ?, ?)",
+        (digest, bytes(data), len(data))
+    )
+    return digest
+
+
+def get_receipt(conn, digest):
+    """读取收据图片原始字节，不存在时返回None"""
+    if not digest:
+        return None
+    row = conn.execute("SELECT data FROM receipts WHERE hash=?", (digest,)).fetchone()
+    return bytes(row[0]) if row else None
+
+
+def release_receipts(conn, digests):
+    """删除不再被任何交易引用的收据"""
+    for digest in set(d for d in digests if d):
+        conn.execute("""
+            DELETE FROM receipts
+            WHERE hash=? AND NOT EXISTS (
+                SELECT 1 FROM transactions WHERE receipt_hash=?
+            )
+        """, (digest, digest))
+
+
+def migrate_inline_receipts(conn):
+    """
+    把transactions.receipt_image中的base64图片迁移到receipts表
+
+    返回值:
+        tuple: (迁移的交易数, 实际存储的收据数)
+    """
+    rows = conn.execute("""
+        SELECT id, receipt_image FROM transactions
+        WHERE receipt_image IS NOT NULL AND receipt_image != ''
+    """).fetchall()
+
+    migrated = 0
+    for record_id, encoded in rows:
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except (binascii.Error, ValueError, TypeError):
+            print(f"[migrate_inline_receipts] 交易 {record_id} 的收据数据无效，已保留原值")
+            continue
+        digest = put_receipt(conn, data)
+        conn.execute(
+            "UPDATE transactions SET receipt_hash=?, receipt_image=NULL WHERE id=?",
+            (digest, record_id)
+        )
+        migrated += 1
+
+    stored = conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+    return migrated, stored
+
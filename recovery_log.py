@@ -0,0 +1,199 @@
+"""
+时间点恢复日志
+
+每次提交后把本次事务改动的行（提交后的完整行内容和被删除的rowid，与加密会话的
+变更日志相同）连同提交时间追加到按时间命名的日志段中。恢复到时间点T时，取T之前
+最近的一份备份作为基准，再按顺序回放基准之后、T之前的记录。恢复的代价与回放的
+提交数成正比，不需要为每个时间点保存一份完整备份。
+
+目录布局: <备份目录>/pitr/<用户>/<开始时间>.log，恢复或更换数据库后开始的日志段
+命名为<开始时间>.base.log，之前的日志段描述的是另一条时间线，不能跨越它回放。
+
+记录是行的最终内容，重复回放同一条记录结果不变，所以基准备份的时刻只要不晚于
+它实际包含的最后一次提交即可。记录编码为[提交时间, 变更]，格式与变更日志相同
+（带版本号的JSON）；加密用户的日志段用与数据库相同的密钥加密，每个日志段有各自
+随机的nonce前缀。
+"""
+import os
+import re
+import threading
+import time
+
+from change_journal import (NONCE_PREFIX_SIZE, JournalHeader, _JournalFile, apply_changes,
+                            decode_record, encode_record, install_capture, read_journal)
+
+# 日志段文件名: <开始时间>[.base].log
+_SEGMENT_NAME = re.compile(r"^(?P<start>\d+\.\d{6})(?P<base>\.base)?\.log$")
+
+
+class RecoveryLog:
+    """
+    一个用户的时间点恢复日志
+
+    参数:
+        log_dir (str): 日志目录
+        key (bytes): 加密用户的密钥；为None时日志段明文保存（带CRC校验）
+        kdf_params (KdfParams): 加密用户的KDF参数，写入日志段文件头，读取时据此取密钥
+    """
+
+    # 当前日志段超过该大小时开始新的日志段，便于按段清理
+    SEGMENT_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, log_dir, key=None, kdf_params=None):
+        self.log_dir = log_dir
+        self.key = key
+        self.kdf_params = kdf_params
+        self._lock = threading.Lock()
+        self._file = None
+        self._conn = None
+
+    def segments(self):
+        """
+        目录中的日志段，按开始时间排序
+
+        返回值:
+            list: [(开始时间, 是否开始新时间线, 路径)]
+        """
+        if not os.path.isdir(self.log_dir):
+            return []
+        result = []
+        for name in os.listdir(self.log_dir):
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                result.append((float(match.group("start")), bool(match.group("base")),
+                               os.path.join(self.log_dir, name)))
+        result.sort()
+        return result
+
+    def start(self, rebase=False):
+        """
+        开始新的日志段
+
+        参数:
+            rebase (bool): 数据库已被整体替换（恢复备份等），之后的记录属于新的时间线
+
+        返回值:
+            bool: 是否开始了新的时间线（调用方需要随后做一次基准备份）
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        rebase = rebase or not self.segments()
+        with self._lock:
+            self._open_segment(rebase)
+        return rebase
+
+    def _open_segment(self, rebase):
+        # 调用方持有_lock
+        if self._file is not None:
+            self._file.close()
+        start = time.time()
+        suffix = ".base.log" if rebase else ".log"
+        path = os.path.join(self.log_dir, f"{start:.6f}{suffix}")
+        if self.key is not None:
+            salt, iterations = self.kdf_params
+        else:
+            salt, iterations = b"", 0
+        header = JournalHeader(b"\0" * 8, salt, iterations, os.urandom(NONCE_PREFIX_SIZE))
+        # 数据库本身已持久化，日志只在每条记录后flush，不逐条fsync
+        self._file = _JournalFile(path, self.key, header, sync=False)
+
+    def attach(self, conn):
+        """开始记录conn（JournaledConnection）上的提交"""
+        install_capture(conn)
+        conn.change_listeners = tuple(conn.change_listeners) + (self,)
+        self._conn = conn
+
+    def append(self, changes):
+        """追加一条提交记录（由JournaledConnection在提交后调用）"""
+        payload = encode_record([time.time(), changes])
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.append(payload)
+            if self._file.size() > self.SEGMENT_SIZE:
+                self._open_segment(False)
+
+    def timeline_start(self, ts):
+        """ts所在时间线的开始时间，ts早于所有日志段时返回None"""
+        start = None
+        for segment_start, rebase, _ in self.segments():
+            if segment_start > ts:
+                break
+            if rebase or start is None:
+                start = segment_start
+        return start
+
+    def replay(self, conn, since, until, key_for=None):
+        """
+        按顺序回放since到until之间的提交（调用方负责暂停汇总触发器并提交）
+
+        只读取until所在时间线的日志段。
+
+        参数:
+            since (float): 基准备份的时刻
+            until (float): 目标时间点
+            key_for: 可调用对象，参数为文件头，返回密钥；默认使用当前密钥
+
+        返回值:
+            int: 回放的提交数
+        """
+        if key_for is None:
+            key_for = lambda header: self.key
+        timeline = self.timeline_start(until)
+        if timeline is None:
+            return 0
+
+        count = 0
+        for segment_start, _, path in self.segments():
+            if segment_start < timeline:
+                continue
+            if segment_start > until:
+                break
+            _, records = read_journal(path, key_for)
+            for payload in records:
+                ts, changes = decode_record(payload)
+                if ts > until:
+                    return count
+                if ts >= since:
+                    apply_changes(conn, changes)
+                    count += 1
+        return count
+
+    def prune(self, before):
+        """
+        删除只包含before之前记录的日志段（当前日志段总是保留）
+
+        返回值:
+            int: 删除的日志段数
+        """
+        segments = self.segments()
+        current = self._file.path if self._file is not None else None
+        removed = 0
+        for (_, _, path), (next_start, _, _) in zip(segments, segments[1:]):
+            if next_start > before:
+                break
+            if path == current:
+                continue
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                print(f"删除恢复日志失败: {str(e)}")
+        return removed
+
+    def close(self):
+        """停止记录并关闭当前日志段"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._conn is not None:
+            self._conn.change_listeners = tuple(
+                listener for listener in self._conn.change_listeners if listener is not self
+            )
+            self._conn = None
+
+    def discard(self):
+        """关闭并删除全部日志段（例如数据库改为加密后，明文日志不能保留）"""
+        self.close()
+        for _, _, path in self.segments():
+            os.remove(path)
@@ -0,0 +1,509 @@
+"""
+加密用户数据库的存储格式
+
+- 二进制快照：整库按SQLite文件格式序列化（dump_database/load_database）
+- 分块加密容器：文件头记录KDF参数，之后是独立认证的定长AES-GCM分块，
+  读写都按块流式进行，单个分块损坏不影响其余分块
+- 各分块由线程池并行加解密（ChunkCipherEngine），benchmark()测试吞吐量
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# SQLite数据库文件头，用于区分二进制快照和旧版SQL文本导出
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# 文件头第18、19字节是读/写格式版本：1为回滚日志，2为WAL
+_FORMAT_VERSION_OFFSET = 18
+
+
+def dump_database(conn):
+    """
+    把连接中的数据库序列化为SQLite文件格式的字节串
+
+    Python 3.11+使用Connection.serialize()直接得到内存镜像；
+    更早的版本用在线备份API写入临时文件再读回。
+    """
+    if hasattr(conn, "serialize"):
+        return _without_wal_flag(conn.serialize())
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        dest = sqlite3.connect(path)
+        try:
+            conn.backup(dest)
+        finally:
+            dest.close()
+        with open(path, "rb") as f:
+            return _without_wal_flag(f.read())
+    finally:
+        os.remove(path)
+
+
+def load_database(data, conn):
+    """
+    把快照字节串加载到conn（通常是:memory:连接），替换其中的main数据库
+
+    参数:
+        data (bytes): dump_database()的结果，或旧版的SQL文本导出
+        conn: 目标连接
+
+    异常:
+        sqlite3.DatabaseError: 数据不是有效的数据库快照
+    """
+    if not is_snapshot(data):
+        # 旧版加密文件：明文是SQL语句
+        conn.executescript(data.decode("utf-8"))
+        return
+
+    if hasattr(conn, "deserialize"):
+        conn.deserialize(_without_wal_flag(data))
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        load_database_file(path, conn)
+    finally:
+        os.remove(path)
+
+
+def load_database_file(path, conn):
+    """用在线备份API把数据库文件path复制到conn（不需要把整个文件读进内存）"""
+    source = sqlite3.connect(path)
+    try:
+        source.backup(conn)
+    finally:
+        source.close()
+
+
+def is_snapshot(data):
+    """明文是否为二进制快照（而不是旧版SQL文本）"""
+    return data[:len(SQLITE_HEADER)] == SQLITE_HEADER
+
+
+def _without_wal_flag(data):
+    """
+    把文件头中的WAL标记改回回滚日志格式
+
+    WAL模式数据库的镜像无法直接反序列化到内存数据库（内存库没有-wal文件），
+    改掉这两个字节后页内容不变，打开文件数据库时再由PRAGMA切回WAL。
+    """
+    data = bytearray(data)
+    start = _FORMAT_VERSION_OFFSET
+    if data[start:start + 2] == b"\x02\x02":
+        data[start:start + 2] = b"\x01\x01"
+    return bytes(data)
+
+
+# ---------------------------------------------------------------------------
+# 分块加密容器
+#
+# 文件布局（整数均为大端）:
+#   magic "FAENC" | 版本(1) | KDF算法(1) | 迭代次数(4) | salt长度(1) | salt
+#   | 分块大小(4) | nonce前缀(8)
+#   之后是若干密文分块，每块为 分块大小+16 字节（最后一块可以更短）
+#
+# 第i块的nonce为 nonce前缀 + i(4字节)，附加认证数据(AAD)为
+# 文件头 + i + 是否最后一块，因此分块被调换顺序、截断或拼接都会校验失败。
+# 分块定长且不带长度字段，一块损坏不会影响其它块的定位。
+# ---------------------------------------------------------------------------
+
+CONTAINER_MAGIC = b"FAENC"
+CONTAINER_VERSION = 1
+KDF_PBKDF2_SHA256 = 1
+
+DEFAULT_ITERATIONS = 100000
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+_TAG_SIZE = 16
+_HEADER_FIXED = struct.Struct(">5sBBIB")  # magic, 版本, KDF, 迭代次数, salt长度
+_HEADER_TAIL = struct.Struct(">I8s")  # 分块大小, nonce前缀
+_CHUNK_AAD = struct.Struct(">IB")  # 分块序号, 是否最后一块
+
+
+class ContainerFormatError(ValueError):
+    """文件不是分块加密容器，或文件头/分块结构不完整"""
+
+
+class ChunkVerificationError(ValueError):
+    """某个分块认证失败（密码错误或数据损坏）"""
+
+    def __init__(self, index):
+        super().__init__(f"第{index}个分块校验失败")
+        self.index = index
+
+
+class ContainerHeader(namedtuple("ContainerHeader",
+                                 "kdf iterations salt chunk_size nonce_prefix")):
+    """容器文件头"""
+
+    @classmethod
+    def new(cls, salt=None, iterations=DEFAULT_ITERATIONS, chunk_size=DEFAULT_CHUNK_SIZE):
+        """生成新文件头，nonce前缀每个文件随机生成，salt可以沿用以复用已派生的密钥"""
+        return cls(KDF_PBKDF2_SHA256, iterations, salt or os.urandom(SALT_SIZE),
+                   chunk_size, os.urandom(8))
+
+    def to_bytes(self):
+        return (_HEADER_FIXED.pack(CONTAINER_MAGIC, CONTAINER_VERSION, self.kdf,
+                                   self.iterations, len(self.salt))
+                + self.salt
+                + _HEADER_TAIL.pack(self.chunk_size, self.nonce_prefix))
+
+    @classmethod
+    def read(cls, f):
+        """从文件对象当前位置读取文件头"""
+        fixed = f.read(_HEADER_FIXED.size)
+        if len(fixed) < _HEADER_FIXED.size:
+            raise ContainerFormatError("文件头不完整")
+        magic, version, kdf, iterations, salt_len = _HEADER_FIXED.unpack(fixed)
+        if magic != CONTAINER_MAGIC:
+            raise ContainerFormatError("不是加密容器文件")
+        if version != CONTAINER_VERSION or kdf != KDF_PBKDF2_SHA256:
+            raise ContainerFormatError(f"不支持的容器版本: {version}/{kdf}")
+
+        salt = f.read(salt_len)
+        tail = f.read(_HEADER_TAIL.size)
+        if len(salt) < salt_len or len(tail) < _HEADER_TAIL.size:
+            raise ContainerFormatError("文件头不完整")
+        chunk_size, nonce_prefix = _HEADER_TAIL.unpack(tail)
+        if chunk_size <= 0:
+            raise ContainerFormatError("分块大小无效")
+        return cls(kdf, iterations, salt, chunk_size, nonce_prefix)
+
+
+def derive_key(password, salt, iterations=DEFAULT_ITERATIONS):
+    """PBKDF2-SHA256从密码派生AES-256密钥"""
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt,
+                               iterations, dklen=KEY_SIZE)
+
+
+def is_container_file(path):
+    """文件是否为分块加密容器（否则按旧版Fernet文件处理）"""
+    with open(path, "rb") as f:
+        return f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+
+
+def read_header(path):
+    """读取容器文件头（用于取出salt和迭代次数派生密钥）"""
+    with open(path, "rb") as f:
+        return ContainerHeader.read(f)
+
+
+def _chunk_nonce_aad(header_bytes, header, index, final):
+    nonce = header.nonce_prefix + struct.pack(">I", index)
+    return nonce, header_bytes + _CHUNK_AAD.pack(index, 1 if final else 0)
+
+
+def _read_chunks(src, chunk_size):
+    # 产出(序号, 明文块, 是否最后一块)；预读下一块才能知道当前块是不是最后一块
+    index = 0
+    chunk = src.read(chunk_size)
+    while True:
+        following = src.read(chunk_size) if chunk else b""
+        final = not following
+        yield index, chunk, final
+        if final:
+            return
+        chunk = following
+        index += 1
+
+
+def _read_frames(src, frame_size):
+    # 产出(序号, 密文块, 是否最后一块)
+    index = 0
+    frame = src.read(frame_size)
+    if len(frame) < _TAG_SIZE:
+        raise ContainerFormatError("容器没有数据分块")
+    while True:
+        following = src.read(frame_size)
+        final = not following
+        if not final and len(frame) != frame_size:
+            raise ContainerFormatError(f"第{index}个分块长度不完整")
+        yield index, frame, final
+        if final:
+            return
+        if len(following) < _TAG_SIZE:
+            raise ContainerFormatError("容器在分块中间被截断")
+        frame = following
+        index += 1
+
+
+class ChunkCipherEngine:
+    """
+    分块并行加解密
+
+    各分块相互独立，交给线程池并行处理（AES-GCM在OpenSSL中计算时释放GIL，
+    线程即可用满多核，不需要进程池来回复制数据）。同时在途的分块不超过
+    线程数的两倍，内存占用与文件大小无关；结果按序号顺序写出。
+    """
+
+    def __init__(self, workers=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.executor = (ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crypto")
+                         if self.workers > 1 else None)
+        self.history = []  # (操作, 字节数, 秒)
+
+    def encrypt_stream(self, src, dst, key, header):
+        """
+        从src流式读取明文，按分块加密写入dst
+
+        参数:
+            src: 可读的二进制文件对象
+            dst: 可写的二进制文件对象
+            key (bytes): derive_key()得到的密钥
+            header (ContainerHeader): 文件头（salt须与派生key时一致）
+
+        返回值:
+            int: 明文字节数
+        """
+        start = time.perf_counter()
+        aead = AESGCM(key)
+        header_bytes = header.to_bytes()
+        dst.write(header_bytes)
+
+        def encrypt_chunk(item):
+            index, chunk, final = item
+            nonce, aad = _chunk_nonce_aad(header_bytes, header, index, final)
+            return len(chunk), aead.encrypt(nonce, chunk, aad)
+
+        total = 0
+        for size, ciphertext in self._map_ordered(encrypt_chunk, _read_chunks(src, header.chunk_size)):
+            dst.write(ciphertext)
+            total += size
+        self._record("encrypt", total, start)
+        return total
+
+    def iter_decrypted_chunks(self, src, key, header=None, strict=True):
+        """
+        从src流式解密分块
+
+        参数:
+            src: 可读的二进制文件对象（位于文件头或文件头之后）
+            key (bytes): 密钥
+            header (ContainerHeader): 已读取的文件头，为None时从src读取
+            strict (bool): True时遇到校验失败的分块抛出ChunkVerificationError；
+                False时该分块产出None并继续处理后面的分块
+
+        产出:
+            (序号, 明文或None, 该块明文长度)
+
+        异常:
+            ContainerFormatError: 容器在分块中间被截断
+        """
+        if header is None:
+            header = ContainerHeader.read(src)
+        aead = AESGCM(key)
+        header_bytes = header.to_bytes()
+
+        def decrypt_chunk(item):
+            index, frame, final = item
+            nonce, aad = _chunk_nonce_aad(header_bytes, header, index, final)
+            try:
+                return index, aead.decrypt(nonce, frame, aad), len(frame) - _TAG_SIZE
+            except InvalidTag:
+                return index, None, len(frame) - _TAG_SIZE
+
+        frames = _read_frames(src, header.chunk_size + _TAG_SIZE)
+        for index, data, size in self._map_ordered(decrypt_chunk, frames):
+            if data is None and strict:
+                raise ChunkVerificationError(index)
+            yield index, data, size
+
+    def decrypt_stream(self, src, dst, key, header=None, strict=True):
+        """
+        把容器解密写入dst
+
+        strict=False时，校验失败的分块用等长的零字节代替，
+        其余分块的数据仍在原来的偏移上（SQLite页不会错位）。
+
+        返回值:
+            list: 校验失败的分块序号（strict=True时总是空列表）
+        """
+        start = time.perf_counter()
+        total = 0
+        bad_chunks = []
+        for index, data, size in self.iter_decrypted_chunks(src, key, header, strict):
+            if data is None:
+                bad_chunks.append(index)
+                data = bytes(size)
+            dst.write(data)
+            total += size
+        self._record("decrypt", total, start)
+        return bad_chunks
+
+    def throughput(self, operation):
+        """
+        最近一次加密/解密的吞吐量
+
+        返回值:
+            float: MB/s，没有记录时返回None
+        """
+        for op, nbytes, seconds in reversed(self.history):
+            if op == operation:
+                return nbytes / (1024 * 1024) / seconds if seconds > 0 else None
+        return None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def _map_ordered(self, fn, items):
+        if self.executor is None:
+            for item in items:
+                yield fn(item)
+            return
+
+        pending = deque()
+        for item in items:
+            pending.append(self.executor.submit(fn, item))
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _record(self, operation, nbytes, start):
+        self.history.append((operation, nbytes, time.perf_counter() - start))
+        # 只保留最近的记录
+        if len(self.history) > 100:
+            del self.history[:-100]
+
+
+_default_engine = None
+
+
+def get_engine():
+    """进程内共享的加解密引擎（线程数等于CPU核数）"""
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = ChunkCipherEngine()
+    return _default_engine
+
+
+def encrypt_stream(src, dst, key, header):
+    """用共享引擎加密，参见ChunkCipherEngine.encrypt_stream"""
+    return get_engine().encrypt_stream(src, dst, key, header)
+
+
+def iter_decrypted_chunks(src, key, header=None, strict=True):
+    """用共享引擎解密，参见ChunkCipherEngine.iter_decrypted_chunks"""
+    return get_engine().iter_decrypted_chunks(src, key, header, strict)
+
+
+def decrypt_stream(src, dst, key, header=None, strict=True):
+    """用共享引擎解密，参见ChunkCipherEngine.decrypt_stream"""
+    return get_engine().decrypt_stream(src, dst, key, header, strict)
+
+
+def write_container(path, data, key, header):
+    """把明文字节串加密写入path（先写临时文件再替换，中途失败不会破坏原文件）"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as dst:
+        encrypt_stream(io.BytesIO(data), dst, key, header)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, path)
+
+
+def decrypt_container(path, key, strict=True):
+    """流式解密容器文件，返回明文字节串（明文只在内存中，不写临时文件）"""
+    buffer = io.BytesIO()
+    with open(path, "rb") as src:
+        decrypt_stream(src, buffer, key, strict=strict)
+    return buffer.getvalue()
+
+
+def decrypt_container_to_file(path, key, target_path, strict=True):
+    """流式解密容器文件到target_path，返回校验失败的分块序号"""
+    with open(path, "rb") as src, open(target_path, "wb") as dst:
+        return decrypt_stream(src, dst, key, strict=strict)
+
+
+def convert_fernet_file(path, fernet, key, header, target_path=None):
+    """
+    把旧版Fernet整文件加密的数据库转换为分块容器
+
+    参数:
+        path (str): Fernet加密的文件
+        fernet: 旧密钥对应的Fernet对象
+        key (bytes): 新容器的密钥
+        header (ContainerHeader): 新容器的文件头
+        target_path (str): 输出路径，默认原地替换
+
+    旧版明文可能是SQL文本导出，先加载到内存库再转成二进制快照。
+    """
+    with open(path, "rb") as f:
+        plain = fernet.decrypt(f.read())
+
+    if not is_snapshot(plain):
+        conn = sqlite3.connect(":memory:")
+        try:
+            load_database(plain, conn)
+            plain = dump_database(conn)
+        finally:
+            conn.close()
+
+    write_container(target_path or path, plain, key, header)
+
+
+def benchmark(size_mb=64, worker_counts=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    测试不同线程数下的加解密吞吐量
+
+    参数:
+        size_mb (int): 测试数据大小（MB）
+        worker_counts (list): 要测试的线程数，默认1、2、4……直到CPU核数
+        chunk_size (int): 分块大小
+
+    返回值:
+        list: [(线程数, 加密MB/s, 解密MB/s), ...]
+    """
+    if worker_counts is None:
+        cpus = os.cpu_count() or 1
+        worker_counts = []
+        n = 1
+        while n < cpus:
+            worker_counts.append(n)
+            n *= 2
+        worker_counts.append(cpus)
+
+    data = os.urandom(size_mb * 1024 * 1024)
+    key = os.urandom(KEY_SIZE)
+    header = ContainerHeader.new(salt=os.urandom(SALT_SIZE), chunk_size=chunk_size)
+
+    results = []
+    for workers in worker_counts:
+        engine = ChunkCipherEngine(workers)
+        try:
+            encrypted = io.BytesIO()
+            engine.encrypt_stream(io.BytesIO(data), encrypted, key, header)
+            encrypted.seek(0)
+            engine.decrypt_stream(encrypted, io.BytesIO(), key)
+            results.append((workers, engine.throughput("encrypt"), engine.throughput("decrypt")))
+        finally:
+            engine.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    # python secure_storage.py [数据大小MB]
+    import sys
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    print(f"分块加解密吞吐量（{size} MB，分块 {DEFAULT_CHUNK_SIZE // 1024} KB）")
+    print("线程数    加密 MB/s    解密 MB/s")
+    for workers, encrypt_rate, decrypt_rate in benchmark(size):
+        print(f"{workers:>6} {encrypt_rate:>12.1f} {decrypt_rate:>12.1f}")
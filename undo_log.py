@@ -0,0 +1,246 @@
+"""
+基于行镜像的多级撤销/重做
+
+每个命令开始前调用begin_step()，结束后调用end_step()。命令第一次改动某一行之前，
+TEMP触发器把该行的原始内容复制到TEMP镜像表；新插入的行只记下rowid。命令结束时
+镜像被取出作为一个撤销步骤保存在内存中，不属于任何命令的写入不会被记录。
+撤销时把涉及的行恢复为镜像，同时记下恢复前的内容作为重做步骤。撤销、重做的代价
+只与命令改动的行数有关，与数据库大小无关。
+
+历史全部保存在内存中（TEMP表随temp_store=MEMORY也在内存），加密用户的内存数据库
+撤销时不需要写临时文件或重新加密；总大小超过内存上限时丢弃最早的步骤。
+"""
+import json
+from collections import deque
+
+from ledger_schema import summary_triggers_suspended
+
+# 默认保留的撤销步数
+DEFAULT_MAX_STEPS = 200
+
+# 撤销/重做历史默认的内存上限（字节）
+DEFAULT_MEMORY_BUDGET = 32 * 1024 * 1024
+
+# 估算内存占用时每行、每个值的固定开销（元组和对象头）
+_ROW_OVERHEAD = 64
+_VALUE_OVERHEAD = 16
+
+
+class UndoStep:
+    """
+    一个命令的撤销信息
+
+    tables为[(表名, 行镜像列表[(rowid, 各列...)], 命令前不存在的rowid列表)]
+    """
+
+    __slots__ = ("tables", "size")
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.size = _estimate_size(tables)
+
+    def row_count(self):
+        return sum(len(rows) + len(absent) for _, rows, absent in self.tables)
+
+
+class UndoLog:
+    """
+    一个连接上的撤销/重做历史
+
+    连接被替换（切换用户、恢复备份等）后历史随之失效，调用方据conn判断是否需要新建。
+    须在没有进行中的事务时创建：记录用的TEMP表和触发器不能随调用方的事务回滚。
+
+    参数:
+        conn: 数据库连接
+        max_steps (int): 最多保留的撤销步数，超出时丢弃最早的步骤
+        memory_budget (int): 撤销和重做步骤合计的内存上限（字节），超出时先丢弃最早的撤销步骤，
+            再丢弃离当前最远的重做步骤
+    """
+
+    def __init__(self, conn, max_steps=DEFAULT_MAX_STEPS, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.conn = conn
+        self.memory_budget = memory_budget
+        self.undo_stack = deque(maxlen=max_steps)
+        self.redo_stack = []
+        self._recording = False
+        self._columns = {}  # 表名 -> 列名列表（与SELECT *顺序一致）
+        self._install()
+
+    def _install(self):
+        conn = self.conn
+        # 触发器通过该函数判断是否记录；撤销、重做自身的写入不记录
+        conn.create_function("undo_recording", 0, lambda: self._recording)
+        # INSERT OR REPLACE删除冲突行时默认不触发DELETE触发器，打开后被替换的行也有镜像；
+        # 汇总表的触发器用WHEN条件避免被自身的写入再次触发
+        conn.execute("PRAGMA recursive_triggers = ON")
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS undo_new (tbl TEXT NOT NULL, rid INTEGER NOT NULL, PRIMARY KEY (tbl, rid))"
+        )
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM main.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )]
+        for table in tables:
+            self._columns[table] = [row[1] for row in conn.execute(f'PRAGMA main.table_info("{table}")')]
+            conn.execute(f'''
+                CREATE TEMP TABLE IF NOT EXISTS "undo_img_{table}" AS
+                    SELECT rowid AS undo_rid, * FROM main."{table}" WHERE 0
+            ''')
+            conn.execute(
+                f'CREATE UNIQUE INDEX IF NOT EXISTS temp."undo_img_{table}_rid" ON "undo_img_{table}"(undo_rid)'
+            )
+            conn.execute(f'''
+                CREATE TEMP TRIGGER IF NOT EXISTS undo_{table}_update BEFORE UPDATE ON main."{table}"
+                WHEN undo_recording()
+                BEGIN
+                    INSERT OR IGNORE INTO "undo_img_{table}" SELECT rowid, * FROM main."{table}"
+                    WHERE rowid = OLD.rowid
+                        AND NOT EXISTS (SELECT 1 FROM undo_new WHERE tbl='{table}' AND rid=OLD.rowid);
+                    INSERT OR IGNORE INTO undo_new SELECT '{table}', NEW.rowid
+                    WHERE NEW.rowid != OLD.rowid
+                        AND NOT EXISTS (SELECT 1 FROM "undo_img_{table}" WHERE undo_rid=NEW.rowid);
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TEMP TRIGGER IF NOT EXISTS undo_{table}_delete BEFORE DELETE ON main."{table}"
+                WHEN undo_recording()
+                BEGIN
+                    INSERT OR IGNORE INTO "undo_img_{table}" SELECT rowid, * FROM main."{table}"
+                    WHERE rowid = OLD.rowid
+                        AND NOT EXISTS (SELECT 1 FROM undo_new WHERE tbl='{table}' AND rid=OLD.rowid);
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TEMP TRIGGER IF NOT EXISTS undo_{table}_insert AFTER INSERT ON main."{table}"
+                WHEN undo_recording()
+                BEGIN
+                    INSERT OR IGNORE INTO undo_new SELECT '{table}', NEW.rowid
+                    WHERE NOT EXISTS (SELECT 1 FROM "undo_img_{table}" WHERE undo_rid=NEW.rowid);
+                END
+            ''')
+
+    def begin_step(self):
+        """一个可撤销的命令开始：开始记录"""
+        self._harvest()
+        self._recording = True
+
+    def end_step(self):
+        """命令结束（包括出错返回）：停止记录，记录到的镜像保存为一个撤销步骤"""
+        self._harvest()
+
+    def can_undo(self):
+        self._harvest()
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        self._harvest()
+        return bool(self.redo_stack)
+
+    def undo(self):
+        """
+        撤销最近的步骤
+
+        返回值:
+            bool: 没有可撤销的步骤时为False
+        """
+        self._harvest()
+        if not self.undo_stack:
+            return False
+        # 恢复成功后才出栈，失败时步骤留在原处
+        self.redo_stack.append(self._apply(self.undo_stack[-1]))
+        self.undo_stack.pop()
+        self._trim()
+        return True
+
+    def redo(self):
+        """重做最近撤销的步骤，没有时返回False"""
+        self._harvest()
+        if not self.redo_stack:
+            return False
+        self.undo_stack.append(self._apply(self.redo_stack[-1]))
+        self.redo_stack.pop()
+        self._trim()
+        return True
+
+    def _harvest(self):
+        # 把TEMP表中记录的镜像取出为一个步骤；之后的写入在下一个begin_step()之前不再记录
+        self._recording = False
+        conn = self.conn
+        # 调用方的事务还没结束时清空镜像的写入随它一起提交
+        own_transaction = not conn.in_transaction
+        tables = []
+        for table in self._columns:
+            rows = [tuple(row) for row in conn.execute(f'SELECT * FROM temp."undo_img_{table}"')]
+            absent = [row[0] for row in conn.execute("SELECT rid FROM temp.undo_new WHERE tbl=?", (table,))]
+            if rows or absent:
+                tables.append((table, rows, absent))
+                conn.execute(f'DELETE FROM temp."undo_img_{table}"')
+        if not tables:
+            return
+        conn.execute("DELETE FROM temp.undo_new")
+        if own_transaction:
+            conn.commit()
+        self.undo_stack.append(UndoStep(tables))
+        # 有了新的改动，之前撤销的步骤不能再重做
+        self.redo_stack.clear()
+        self._trim()
+
+    def memory_used(self):
+        """撤销和重做步骤估算的内存占用（字节）"""
+        return sum(step.size for step in self.undo_stack) + sum(step.size for step in self.redo_stack)
+
+    def _trim(self):
+        # 两个栈合计超出内存上限时先从最早的撤销步骤开始丢弃，仍超限时再从栈底（离当前
+        # 最远）丢弃重做步骤；单个步骤本身就超限时也不保留
+        used = self.memory_used()
+        while self.undo_stack and used > self.memory_budget:
+            used -= self.undo_stack.popleft().size
+        while self.redo_stack and used > self.memory_budget:
+            used -= self.redo_stack.pop(0).size
+
+    def _apply(self, step):
+        # 把步骤涉及的行恢复为镜像，返回恢复前内容组成的反向步骤
+        conn = self.conn
+        inverse = []
+        # 显式开始事务，暂停汇总触发器的DROP/CREATE与数据写入一起提交或回滚
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN")
+        try:
+            # 汇总表的镜像也在步骤中，恢复时不能再由触发器重复累加
+            with summary_triggers_suspended(conn):
+                for table, rows, absent in step.tables:
+                    rowids = [row[0] for row in rows] + absent
+                    current = [tuple(row) for row in conn.execute(
+                        f'SELECT rowid, * FROM main."{table}" WHERE rowid IN (SELECT value FROM json_each(?))',
+                        (json.dumps(rowids),)
+                    )]
+                    present = {row[0] for row in current}
+                    inverse.append((table, current, [rowid for rowid in rowids if rowid not in present]))
+
+                    conn.executemany(f'DELETE FROM main."{table}" WHERE rowid=?', [(rowid,) for rowid in rowids])
+                    if rows:
+                        columns = self._columns[table]
+                        column_list = ", ".join(["rowid"] + [f'"{name}"' for name in columns])
+                        placeholders = ", ".join(["?"] * (len(columns) + 1))
+                        conn.executemany(
+                            f'INSERT INTO main."{table}" ({column_list}) VALUES ({placeholders})', rows
+                        )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return UndoStep(inverse)
+
+
+def _estimate_size(tables):
+    # 粗略估算行镜像占用的内存：字符串和BLOB按长度计，其它值按固定开销计
+    size = 0
+    for _, rows, absent in tables:
+        size += len(absent) * _VALUE_OVERHEAD
+        for row in rows:
+            size += _ROW_OVERHEAD
+            for value in row:
+                size += _VALUE_OVERHEAD
+                if isinstance(value, (str, bytes)):
+                    size += len(value)
+    return size